@@ -0,0 +1,107 @@
+import argparse
+import copy
+import json
+import time
+
+import torch
+import torch.nn.functional as F
+from torchsso.optim import VIOptimizer
+
+from benchmark_step import INPUT_SHAPES, load_arch_class
+
+
+def build(config, device, model_state=None):
+    torch.manual_seed(1)
+    model = load_arch_class(config['arch_file'], config['arch_name'])(**config.get('arch_args', {})).to(device)
+    if model_state is not None:
+        # loaded before the optimizer initializes the posterior (and registers the hooks of the curvatures)
+        model.load_state_dict(model_state)
+    optimizer = VIOptimizer(model, dataset_size=60000, **config['optim_args'], curv_kwargs=config['curv_args'])
+    return model, optimizer
+
+
+def train(model, optimizer, batches, num_steps):
+    losses = []
+    for _ in range(num_steps):
+        data, target = batches[optimizer.optim_state['step'] % len(batches)]
+
+        def closure(surrogate_loss):
+            optimizer.zero_grad()
+            output = model(data)
+            network_loss = F.cross_entropy(output, target)
+            total_loss = network_loss - surrogate_loss
+            total_loss.backward()
+            return total_loss, output, network_loss
+
+        _, _, network_loss = optimizer.step(closure)
+        losses.append(network_loss.item())
+
+    return losses
+
+
+def steps_to_steady_state(losses, reference, window, tolerance):
+    # first step from which the running mean of the loss stays within the tolerance of the reference
+    for i in range(len(losses) - window + 1):
+        if all(abs(sum(losses[j:j + window]) - sum(reference[j:j + window])) / window <= tolerance
+               for j in range(i, len(losses) - window + 1)):
+            return i
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='configs/mnist/mlp_madam.json',
+                        help='config file path')
+    parser.add_argument('--num_batches', type=int, default=20,
+                        help='number of the (synthetic) minibatches')
+    parser.add_argument('--warmup_steps', type=int, default=200,
+                        help='number of steps before the checkpoint')
+    parser.add_argument('--eval_steps', type=int, default=200,
+                        help='number of steps after resuming')
+    parser.add_argument('--window', type=int, default=10,
+                        help='window of the running mean of the loss')
+    parser.add_argument('--tolerance', type=float, default=0.05,
+                        help='tolerance of the running mean of the loss to the uninterrupted run')
+    parser.add_argument('--no_cuda', action='store_true', default=False,
+                        help='disables CUDA')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if not args.no_cuda and torch.cuda.is_available() else 'cpu')
+    with open(args.config) as f:
+        config = json.load(f)
+
+    torch.manual_seed(0)
+    batch_size = config['batch_size']
+    model, optimizer = build(config, device)
+    data = [torch.randn(batch_size, *INPUT_SHAPES[config['dataset']], device=device) for _ in range(args.num_batches)]
+    with torch.no_grad():
+        num_outputs = model(data[0]).shape[1]
+    batches = [(x, torch.randint(num_outputs, (batch_size,), device=device)) for x in data]
+
+    train(model, optimizer, batches, args.warmup_steps)
+    model_state = copy.deepcopy(model.state_dict())
+    optim_states = {'warm': optimizer.state_dict(), 'warm (no inverses)': optimizer.state_dict(include_inverses=False)}
+    reference = train(model, optimizer, batches, args.eval_steps)
+
+    print('{}: resume after {} steps'.format(args.config, args.warmup_steps))
+    for name in ['cold', 'warm', 'warm (no inverses)']:
+        start = time.perf_counter()
+        # only the weights are restored for the cold resume
+        model, optimizer = build(config, device, model_state)
+        if name != 'cold':
+            optimizer.load_state_dict(copy.deepcopy(optim_states[name]))
+        load_time = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        losses = train(model, optimizer, batches, args.eval_steps)
+        step_time = (time.perf_counter() - start) / args.eval_steps * 1000
+
+        steps = steps_to_steady_state(losses, reference, args.window, args.tolerance)
+        print('{}: load {:.1f} ms, {:.3f} ms/step, loss of the first {} steps {:.4f} (uninterrupted {:.4f}), '
+              'steps to steady state: {}'.format(
+                name, load_time, step_time, args.window, sum(losses[:args.window]) / args.window,
+                sum(reference[:args.window]) / args.window, steps if steps is not None else 'not reached'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import argparse
+import json
+import os
+import time
+from importlib import import_module
+
+import torch
+import torch.nn.functional as F
+from torchsso.optim import VIOptimizer
+
+INPUT_SHAPES = {'TINY': (1,), 'MNIST': (1, 28, 28), 'CIFAR-10': (3, 32, 32), 'CIFAR-100': (3, 32, 32)}
+
+
+def load_arch_class(arch_file, arch_name):
+    _, ext = os.path.splitext(arch_file)
+    dirname = os.path.dirname(arch_file)
+
+    if dirname == '':
+        module_path = arch_file.replace(ext, '')
+    elif dirname == '.':
+        module_path = os.path.basename(arch_file).replace(ext, '')
+    else:
+        module_path = '.'.join(os.path.split(arch_file)).replace(ext, '')
+
+    return getattr(import_module(module_path), arch_name)
+
+
+def benchmark(config, compile_step, num_steps, num_warmup_steps, device):
+    torch.manual_seed(1)
+    model = load_arch_class(config['arch_file'], config['arch_name'])(**config.get('arch_args', {})).to(device)
+    optimizer = VIOptimizer(model, dataset_size=60000, compile_step=compile_step,
+                            **config['optim_args'], curv_kwargs=config['curv_args'])
+
+    data = torch.randn(config['batch_size'], *INPUT_SHAPES[config['dataset']], device=device)
+    with torch.no_grad():
+        num_outputs = model(data).shape[1]
+    target = torch.randint(num_outputs, (config['batch_size'],), device=device)
+
+    def closure(surrogate_loss):
+        optimizer.zero_grad()
+        output = model(data)
+        network_loss = F.cross_entropy(output, target)
+        total_loss = network_loss - surrogate_loss
+        total_loss.backward()
+        return total_loss, output, network_loss
+
+    # the first steps include the compilation
+    for _ in range(num_warmup_steps):
+        optimizer.step(closure)
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        optimizer.step(closure)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+    return (time.perf_counter() - start) / num_steps * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', nargs='+', default=['configs/tiny.json', 'configs/mnist/mlp_madam.json'],
+                        help='config file paths')
+    parser.add_argument('--num_steps', type=int, default=50,
+                        help='number of steps to be measured')
+    parser.add_argument('--num_warmup_steps', type=int, default=5,
+                        help='number of steps before the measurement')
+    parser.add_argument('--no_cuda', action='store_true', default=False,
+                        help='disables CUDA')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if not args.no_cuda and torch.cuda.is_available() else 'cpu')
+
+    for path in args.config:
+        with open(path) as f:
+            config = json.load(f)
+        eager = benchmark(config, False, args.num_steps, args.num_warmup_steps, device)
+        compiled = benchmark(config, True, args.num_steps, args.num_warmup_steps, device)
+        print('{}: eager {:.3f} ms/step, compiled {:.3f} ms/step (x{:.2f})'.format(
+            path, eager, compiled, eager / compiled))
+
+
+if __name__ == '__main__':
+    main()
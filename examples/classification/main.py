@@ -3,13 +3,14 @@ import argparse
 from importlib import import_module
 import shutil
 import json
+import warnings
 
 import torch
 import torch.nn.functional as F
 from torchvision import datasets, transforms, models
 import torchsso
-from torchsso.optim import SecondOrderOptimizer, VIOptimizer
-from torchsso.utils import Logger
+from torchsso.optim import SecondOrderOptimizer, VIOptimizer, AsyncValidator
+from torchsso.utils import Logger, AsyncCheckpointWriter, LazyCheckpoint
 from torchsso.utils.generate_data import TinyDataset
 
 DATASET_CIFAR10 = 'CIFAR-10'
@@ -72,6 +73,8 @@ def main():
                         help='how many batches to wait before logging training status')
     parser.add_argument('--log_file_name', type=str, default='log',
                         help='log file name')
+    parser.add_argument('--async_validation', action='store_true', default=False,
+                        help='validates in a background process while training continues (CPU only)')
     parser.add_argument('--checkpoint_interval', type=int, default=50,
                         help='how many epochs to wait before logging training status')
     parser.add_argument('--resume', type=str, default=None,
@@ -200,8 +203,21 @@ def main():
     if args.resume is not None:
         print('==> Resuming from checkpoint..')
         assert os.path.exists(args.resume), 'Error: no checkpoint file found'
-        checkpoint = torch.load(args.resume)
-        model.load_state_dict(checkpoint['model'])
+        if os.path.isdir(args.resume):
+            # directory of AsyncCheckpointWriter (the latest checkpoint), whose layers are loaded at their first use
+            checkpoint = LazyCheckpoint(args.resume)
+            checkpoint.attach(model, optimizer if isinstance(optimizer, SecondOrderOptimizer) else None)
+        else:
+            checkpoint = torch.load(args.resume)
+            model.load_state_dict(checkpoint['model'])
+            if isinstance(optimizer, SecondOrderOptimizer) and 'optimizer' in checkpoint:
+                if 'version' in checkpoint['optimizer']:
+                    # the posterior and the curvatures are restored for a warm resume
+                    optimizer.load_state_dict(checkpoint['optimizer'])
+                else:
+                    # written before the versioned state_dict of the optimizer
+                    warnings.warn('The optimizer state in {} has no version and is not restored '
+                                  '(only the weights of the model are resumed).'.format(args.resume))
         start_epoch = checkpoint['epoch']
 
     # All config
@@ -229,33 +245,58 @@ def main():
     logger = Logger(args.out, args.log_file_name)
     logger.start()
 
+    # the checkpoints of the (second-order) optimizers are written in the background
+    writer = None
+    if isinstance(optimizer, SecondOrderOptimizer):
+        writer = AsyncCheckpointWriter(os.path.join(args.out, 'checkpoints'))
+
+    # the metrics of the background validation are written to the logger when they are ready
+    validator = None
+    if args.async_validation:
+        async_val_loader = torch.utils.data.DataLoader(
+            val_dataset, batch_size=args.val_batch_size, shuffle=False)
+        validator = AsyncValidator(model, async_val_loader,
+                                   optimizer if isinstance(optimizer, VIOptimizer) else None, logger)
+
     # Run training
     for epoch in range(start_epoch, args.epochs + 1):
 
         # train
         accuracy, loss, confidence = train(model, device, train_loader, optimizer, scheduler, epoch, args, logger)
 
-        # val
-        val_accuracy, val_loss = validate(model, device, val_loader, optimizer)
-
         # save log
         iteration = epoch * len(train_loader)
         log = {'epoch': epoch, 'iteration': iteration,
                'accuracy': accuracy, 'loss': loss, 'confidence': confidence,
-               'val_accuracy': val_accuracy, #'val_loss': val_loss,
                'lr': optimizer.param_groups[0]['lr'],
                'momentum': optimizer.param_groups[0].get('momentum', 0)}
+
+        # val
+        if validator is not None:
+            validator.poll()
+            validator.submit(epoch=epoch, iteration=iteration)
+        else:
+            val_accuracy, val_loss = validate(model, device, val_loader, optimizer)
+            log['val_accuracy'] = val_accuracy  # 'val_loss': val_loss
         logger.write(log)
 
         # save checkpoint
         if epoch % args.checkpoint_interval == 0 or epoch == args.epochs:
-            path = os.path.join(args.out, 'epoch{}.ckpt'.format(epoch))
-            data = {
-                'model': model.state_dict(),
-                'optimizer': optimizer.state_dict(),
-                'epoch': epoch
-            }
-            torch.save(data, path)
+            if writer is not None:
+                writer.save(model, optimizer, tag='epoch{}'.format(epoch), epoch=epoch)
+            else:
+                path = os.path.join(args.out, 'epoch{}.ckpt'.format(epoch))
+                data = {
+                    'model': model.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'epoch': epoch
+                }
+                torch.save(data, path)
+
+    if validator is not None:
+        validator.close()
+    if writer is not None:
+        writer.close()
 
 
 def train(model, device, train_loader, optimizer, scheduler, epoch, args, logger):
@@ -293,8 +334,6 @@ def train(model, device, train_loader, optimizer, scheduler, epoch, args, logger
             total_loss = network_loss - surrogate_loss
             # loss = F.cross_entropy(output, target) + surrogate_loss
             total_loss.backward(create_graph=args.create_graph)
-            if torch.isnan(torch.sum(total_loss)):
-                print("inside closure isnan")
             return total_loss, output, network_loss
 
         if isinstance(optimizer, SecondOrderOptimizer) and optimizer.curv_type == 'Fisher':
@@ -353,6 +392,10 @@ def train(model, device, train_loader, optimizer, scheduler, epoch, args, logger
                          'g_norm': g_norm, 'upd_norm': upd_norm, 'noise_scale': noise_scale}
                 log[name] = p_log
 
+            if isinstance(optimizer, VIOptimizer) and optimizer.health_monitor.enabled:
+                # the only host sync of the health statistics
+                log['health'] = optimizer.health_monitor.flush()
+
             logger.write(log)
 
     if scheduler_type(scheduler) == 'epoch':
@@ -332,7 +332,9 @@ def main():
         assert os.path.exists(args.resume), 'Error: no checkpoint file found'
         checkpoint = torch.load(args.resume)
         model.load_state_dict(checkpoint['model'])
-        optimizer.load_state_dict(checkpoint['optimizer'])
+        optim_path = args.resume.replace('.ckpt', '.rank{}.optim'.format(rank))
+        if os.path.exists(optim_path):
+            optimizer.load_state_dict(torch.load(optim_path, map_location=device))
         start_epoch = checkpoint['epoch']
 
     if rank == 0:
@@ -415,11 +417,15 @@ def main():
                 path = os.path.join(args.out, 'epoch{}.ckpt'.format(epoch))
                 data = {
                     'model': model.state_dict(),
-                    'optimizer': optimizer.state_dict(),
                     'epoch': epoch
                 }
                 torch.save(data, path)
 
+        if epoch % args.checkpoint_interval == 0 or epoch > args.epochs - 3:
+            # the curvatures of the local layers are saved by each process
+            path = os.path.join(args.out, 'epoch{}.rank{}.optim'.format(epoch, rank))
+            torch.save(optimizer.state_dict(), path)
+
 
 def train(rank, epoch, model, device, train_loader, optimizer, scheduler,
           args, master_group, data_group_id=0, data_group=None, logger=None):
@@ -0,0 +1,789 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from torchsso.optim import SecondOrderOptimizer, VIOptimizer, NoiseScaleTuner, StepTimeController, prune_posterior
+from torchsso.optim.distillation import distillation_loss, distill_predictive
+from torchsso.optim.lr_scheduler import HyperParamScheduler
+from torchsso.utils import PosteriorSnapshot, save_posterior_snapshot, AsyncCheckpointWriter, read_checkpoint, \
+    LazyCheckpoint
+from torchsso.utils.inference_server import PredictiveServer
+
+
+class MLP(nn.Module):
+    def __init__(self, input_size=4, hidden_size=8, num_classes=3):
+        super().__init__()
+        self.fc1 = nn.Linear(input_size, hidden_size)
+        self.fc2 = nn.Linear(hidden_size, num_classes)
+
+    def forward(self, x):
+        out = F.relu(self.fc1(x))
+        out = self.fc2(out)
+        return out
+
+
+def get_optimizer(model, num_gmm_components=2, dataset_size=1000, init_precision=1., **kwargs):
+    curv_shapes = {'Linear': 'Diag'}
+    curv_kwargs = {'damping': 0, 'ema_decay': 0.01}
+    return VIOptimizer(model, dataset_size=dataset_size, curv_type='GMM', curv_shapes=curv_shapes,
+                       curv_kwargs=curv_kwargs, num_gmm_components=num_gmm_components,
+                       init_precision=init_precision, **kwargs)
+
+
+def get_closure(model, optimizer, x, t):
+    def closure(surrogate_loss):
+        optimizer.zero_grad()
+        output = model(x)
+        network_loss = F.cross_entropy(output, t)
+        total_loss = network_loss - surrogate_loss
+        total_loss.backward()
+        return total_loss, output, network_loss
+
+    return closure
+
+
+def test_cascade_prediction():
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model, val_num_mc_samples=5)
+    x = torch.randn(16, 4)
+
+    # nothing takes the MC path
+    prob, mc_fraction = optimizer.cascade_prediction(x, threshold=0.)
+    assert mc_fraction == 0
+    assert torch.allclose(prob, optimizer.prediction(x, mc=0))
+
+    # everything takes the MC path
+    prob, mc_fraction = optimizer.cascade_prediction(x, threshold=1.1)
+    assert mc_fraction == 1
+    assert torch.allclose(prob, optimizer.prediction(x))
+
+    # empty batch
+    prob, mc_fraction = optimizer.cascade_prediction(x[:0], threshold=1.1)
+    assert mc_fraction == 0
+    assert prob.shape == (0, 3)
+
+
+def test_prediction_cache():
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model, val_num_mc_samples=5, prediction_cache_bytes=2**20)
+    x = torch.randn(16, 4)
+
+    prob = optimizer.prediction(x)
+    # the cached prediction is not modified through the returned one
+    optimizer.prediction(x).zero_()
+    assert torch.equal(optimizer.prediction(x), prob)
+    assert optimizer.prediction_cache.hits == 2
+
+    # a new posterior version invalidates the entry
+    optimizer.optim_state['step'] += 1
+    optimizer.prediction(x)
+    assert optimizer.prediction_cache.misses == 2
+    optimizer.set_dataset_size(500)
+    optimizer.prediction(x)
+    assert optimizer.prediction_cache.misses == 3
+
+
+def test_analytic_prediction():
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model)
+    x = torch.randn(32, 4)
+
+    mc_prob = optimizer.prediction(x, mc=2000)
+    analytic_prob = optimizer.analytic_prediction(x)
+
+    error = (analytic_prob - mc_prob).abs().mean()
+    assert error < 0.02
+    assert analytic_prob.argmax(dim=1).eq(mc_prob.argmax(dim=1)).float().mean() > 0.9
+
+    # last layer only
+    last_layer_prob = optimizer.analytic_prediction(x, last_layer_only=True)
+    assert torch.allclose(last_layer_prob.sum(dim=1), torch.ones(32))
+
+
+def test_posterior_snapshot():
+    model = MLP()
+    optimizer = get_optimizer(model)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'posterior.bin')
+        save_posterior_snapshot(optimizer, path)
+
+        snapshot = PosteriorSnapshot(path)
+        assert snapshot.num_gmm_components == 2
+        assert sorted(snapshot.names) == sorted(name for name, _ in model.named_parameters())
+
+        group = optimizer.param_groups[0]
+        assert all(torch.equal(a, b) for a, b in zip(snapshot.mean('fc1.weight'), group['mean'][0]))
+        assert all(torch.equal(a, b) for a, b in zip(snapshot.pai('fc1.weight'), group['pais'][0]))
+        assert snapshot.sample('fc1.weight').shape == model.fc1.weight.shape
+
+
+def test_export_predictive():
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model)
+    x = torch.randn(8, 4)
+
+    predictive = optimizer.export_predictive(num_samples=4, seed=1)
+    prob = predictive(x)
+
+    # same samples evaluated one by one
+    bank = optimizer.sample_bank(4, seed=1)
+    expected = 0
+    for i in range(4):
+        for module in [model.fc1, model.fc2]:
+            module.weight.data.copy_(bank[module][0][i])
+            module.bias.data.copy_(bank[module][1][i])
+        expected += F.softmax(model(x), dim=1) / 4
+    optimizer.copy_mean_to_params()
+
+    assert torch.allclose(prob, expected, atol=1e-6)
+    assert torch.allclose(torch.jit.script(predictive)(x), prob, atol=1e-6)
+
+
+def test_distill_predictive():
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model)
+    data = [torch.randn(32, 4) for _ in range(4)]
+    x = torch.cat(data)
+    teacher_prob = optimizer.export_predictive(num_samples=8, seed=0)(x)
+
+    def distill_loss(student):
+        with torch.no_grad():
+            return distillation_loss(student(x), teacher_prob).item()
+
+    student = MLP()
+    init_loss = distill_loss(student)
+    student = distill_predictive(optimizer, data, student=student, epochs=50, lr=1e-2, num_samples=8, seed=0)
+
+    # the student approaches the MC predictive distribution of the teacher
+    assert not student.training
+    assert distill_loss(student) < init_loss / 2
+    prob = F.softmax(student(x), dim=1)
+    assert prob.argmax(dim=1).eq(teacher_prob.argmax(dim=1)).float().mean() > 0.8
+    assert (prob - teacher_prob).abs().mean() < (F.softmax(MLP()(x), dim=1) - teacher_prob).abs().mean()
+
+
+def test_predictive_server():
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model)
+    predictive = optimizer.export_predictive(num_samples=4)
+    inputs = [torch.randn(2, 4) for _ in range(10)]
+
+    async def run():
+        server = PredictiveServer(predictive, max_batch_size=64, max_latency=0.05)
+        await server.start()
+        results = await asyncio.gather(*[server.predict(x) for x in inputs])
+        await server.stop()
+
+        # a micro-batch never exceeds max_batch_size
+        small_server = PredictiveServer(predictive, max_batch_size=5, max_latency=0.05)
+        await small_server.start()
+        await asyncio.gather(*[small_server.predict(x) for x in inputs])
+        await small_server.stop()
+        assert small_server.num_batches == 5
+
+        # the pending requests fail when the server is stopped
+        await small_server.start()
+        tasks = [asyncio.ensure_future(small_server.predict(x)) for x in inputs]
+        await asyncio.sleep(0)
+        await small_server.stop()
+        errors = await asyncio.gather(*tasks, return_exceptions=True)
+        assert all(isinstance(e, RuntimeError) for e in errors)
+
+        return results, server.metrics()
+
+    results, metrics = asyncio.run(run())
+
+    for x, (prob, entropy) in zip(inputs, results):
+        assert torch.allclose(prob, predictive(x), atol=1e-6)
+        assert entropy.shape == (2,)
+    assert metrics['num_requests'] == 10
+    assert metrics['num_batches'] < 10
+
+
+def test_prune_posterior():
+    torch.manual_seed(0)
+    model = MLP(hidden_size=8)
+    optimizer = get_optimizer(model)
+    x = torch.randn(16, 4)
+
+    kept = prune_posterior(optimizer, ratio=0.5)
+    assert list(kept.keys()) == ['fc1']
+    assert model.fc1.weight.shape == (4, 4) and model.fc2.weight.shape == (3, 4)
+    assert optimizer.param_groups[0]['mean'][0][0].shape == (4, 4)
+    assert optimizer.param_groups[1]['pais'][0][0].shape == (3, 4)
+
+    prob = optimizer.prediction(x, mc=2)
+    assert prob.shape == (16, 3)
+
+
+def test_deterministic_params():
+    torch.manual_seed(0)
+    model = MLP()
+    x = torch.randn(16, 4)
+
+    optimizer = get_optimizer(model, deterministic_tol=0.)
+    assert optimizer.frozen_fraction() == 0
+
+    optimizer = get_optimizer(model, deterministic_tol=1e8)
+    assert optimizer.frozen_fraction() == 1
+
+    # every sample is the posterior mean
+    optimizer.sample_params()
+    moments = optimizer.posterior_moments()
+    assert torch.allclose(model.fc1.weight, moments[model.fc1][0].mean)
+    probs = optimizer.prediction(x, mc=3, keep_probs=True)[1]
+    assert torch.allclose(probs[0], probs[1])
+
+    # partially deterministic params
+    moments = get_optimizer(model).posterior_moments()[model.fc1][0]
+    ratio = (moments.var.sqrt() / moments.mean.abs()).view(-1)
+    sorted_ratio = ratio.sort()[0]
+    tol = (sorted_ratio[len(ratio) // 2] + sorted_ratio[len(ratio) // 2 + 1]).item() / 2
+    optimizer = get_optimizer(model, deterministic_tol=tol)
+    index = optimizer.param_groups[0]['frozen'][0][0]
+    assert torch.equal(index, torch.nonzero(ratio > tol, as_tuple=False).view(-1))
+    ent_loss, _ = optimizer.surrogate_terms()
+    assert torch.isfinite(ent_loss)
+
+
+def test_stochastic_modules():
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model, val_num_mc_samples=5, stochastic_modules=['fc2'])
+    x = torch.randn(16, 4)
+
+    assert len(optimizer.param_groups) == 1
+    assert optimizer.param_groups[0]['curv'].module is model.fc2
+
+    num_calls = []
+    model.fc1.register_forward_hook(lambda *args: num_calls.append(1))
+
+    # the deterministic prefix (fc1) is evaluated once for all the MC samples
+    prob = optimizer.prediction(x)
+    assert prob.shape == (16, 3)
+    assert len(num_calls) == 1
+
+    # the forward of the model is not replaced
+    assert 'forward' not in vars(model)
+    optimizer.sample_params()
+    forward = optimizer.prefix_cached_forward
+    assert torch.allclose(forward(x), model(x))
+    assert len(num_calls) == 3
+    forward(x)
+    assert len(num_calls) == 3
+
+    # the cached prefix is not reused after the prefix params are modified
+    state = model.state_dict()
+    state['fc1.weight'] = state['fc1.weight'] + 1
+    model.load_state_dict(state)
+    assert torch.allclose(forward(x), model(x))
+    assert len(num_calls) == 5
+
+
+def test_recycle_samples():
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model, num_mc_samples=3, recycle_buffer_size=4, recycle_ess_threshold=0.)
+    x, t = torch.randn(16, 4), torch.randint(3, (16,))
+    closure = get_closure(model, optimizer, x, t)
+
+    # nothing to be recycled
+    optimizer.step(closure)
+    assert optimizer.recycle_stats['num_fresh'] == 3
+    assert len(optimizer.recycle_buffer) == 3
+
+    optimizer.step(closure)
+    assert optimizer.recycle_stats['num_fresh'] == 1
+    assert optimizer.recycle_stats['num_recycled'] == 3
+    assert len(optimizer.recycle_buffer) == 4
+    assert 1 <= optimizer.recycle_stats['ess'] <= 3
+
+    # the importance weights are normalized for each layer
+    recycled = optimizer.recycled_samples()
+    assert len(recycled) == 4
+    for i in range(len(optimizer.param_groups)):
+        assert abs(sum(weights[i] for _, weights in recycled) - 1) < 1e-6
+
+
+def test_control_variates():
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model, num_mc_samples=4, control_variates=True, linearized_baseline=True)
+    x, t = torch.randn(16, 4), torch.randint(3, (16,))
+    surrogates = []
+
+    def closure(surrogate_loss):
+        surrogates.append(surrogate_loss)
+        optimizer.zero_grad()
+        output = model(x)
+        network_loss = F.cross_entropy(output, t)
+        total_loss = network_loss - surrogate_loss
+        total_loss.backward()
+        return total_loss, output, network_loss
+
+    expected = optimizer.closed_form_surrogate()
+    optimizer.step(closure)
+    assert all(torch.equal(s, expected) for s in surrogates)
+    assert not any(s.requires_grad for s in surrogates)
+
+    stats = optimizer.control_variate_stats
+    assert stats['grad_var'] > 0
+    assert stats['grad_var_cv'] >= 0
+    assert stats['variance_reduction'] == 1 - stats['grad_var_cv'] / stats['grad_var']
+
+    # the curvature of the previous step is used for the linearized baseline
+    optimizer.step(closure)
+
+
+def test_hyperparam_scheduler():
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model)
+    scheduler = HyperParamScheduler(optimizer, {'num_mc_samples': [[0, 2], [10, 10]]}, interpolation='linear')
+    assert optimizer.defaults['num_mc_samples'] == 2
+
+    for _ in range(5):
+        scheduler.step()
+    assert optimizer.defaults['num_mc_samples'] == 5
+    assert optimizer.param_groups[0]['lr'] == optimizer.param_groups[0]['initial_lr']
+
+    # the precision of VIOptimizer does not use the EMA of the curvature
+    with pytest.raises(ValueError):
+        HyperParamScheduler(optimizer, {'ema_decay': [[0, 0.1]]})
+    second_order = SecondOrderOptimizer(MLP(), 'Fisher', {'Linear': 'Diag'}, {})
+    scheduler = HyperParamScheduler(second_order, {'ema_decay': [[0, 0.1], [10, 0.5]]}, interpolation='linear')
+    for _ in range(5):
+        scheduler.step()
+    assert abs(second_order.param_groups[0]['curv'].ema_decay - 0.26) < 1e-8
+
+    # resume
+    state = scheduler.state_dict()
+    scheduler = HyperParamScheduler(get_optimizer(MLP()), {'num_mc_samples': [[0, 1]]})
+    scheduler.load_state_dict(state)
+    scheduler.step()
+    assert scheduler.optimizer.defaults['num_mc_samples'] == 6
+
+
+def test_step_time_controller():
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model, num_mc_samples=4)
+    x, t = torch.randn(16, 4), torch.randint(3, (16,))
+    closure = get_closure(model, optimizer, x, t)
+
+    # nothing fits in the budget
+    controller = StepTimeController(optimizer, target_step_time=1e-9, patience=1, max_interval=4)
+    for _ in range(10):
+        controller.step(closure)
+
+    assert len(controller.adjustments) > 0
+    for log in controller.adjustments:
+        if log['knob'] == 'num_mc_samples':
+            assert log['new'] < log['old']
+        else:
+            assert log['new'] > log['old']
+            # applied at the boundary of the interval
+            assert log['step'] % log['old'] == 0
+    assert optimizer.defaults['num_mc_samples'] == 1
+    assert optimizer.defaults['curv_interval'] == 4
+
+
+def test_noise_scale_tuner():
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model, num_mc_samples=2)
+    x, t = torch.randn(16, 4), torch.randint(3, (16,))
+    closure = get_closure(model, optimizer, x, t)
+
+    tuner = NoiseScaleTuner(optimizer, apply=True, max_acc_steps=8)
+    for _ in range(3):
+        tuner.step(closure)
+
+    assert tuner.batch_size == 16
+    assert tuner.noise_scale > 0
+    assert model.fc1.weight.noise_scale > 0
+    assert tuner.recommended_batch_size() >= 1
+    assert 1 <= optimizer.defaults['acc_steps'] <= 8
+
+
+def test_ensemble_step():
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model, num_gmm_components=3)
+    x, t = torch.randn(16, 4), torch.randint(3, (16,))
+    means = [m.clone() for m in optimizer.param_groups[0]['mean'][0]]
+
+    for per_layer in [False, True]:
+        loss, prob, network_loss = optimizer.ensemble_step(x, t, per_layer=per_layer)
+        assert network_loss.shape == (3,)
+        assert prob.shape == (16, 3)
+        assert torch.allclose(prob.sum(dim=1), torch.ones(16))
+
+    # every component is updated with its own gradient
+    for m, m_init in zip(optimizer.param_groups[0]['mean'][0], means):
+        assert not torch.equal(m, m_init)
+    assert optimizer.optim_state['step'] == 2
+    assert torch.equal(model.fc1.weight, optimizer.param_groups[0]['mean'][0][0])
+
+    # the folded prior is applied as in step()
+    optimizer.fold_posterior_into_prior()
+    loss, prob, network_loss = optimizer.ensemble_step(x, t, per_layer=True)
+    assert torch.isfinite(loss)
+
+
+def test_compiled_step():
+    x, t = torch.randn(16, 4), torch.randint(3, (16,))
+    params = []
+    for compile_step in [False, True]:
+        torch.manual_seed(0)
+        model = MLP()
+        optimizer = get_optimizer(model, compile_step=compile_step)
+        closure = get_closure(model, optimizer, x, t)
+
+        for _ in range(3):
+            optimizer.step(closure)
+        group = optimizer.param_groups[0]
+        params.append([m for m in group['mean'][0]] + [p for p in group['pais'][0]])
+
+    for eager, compiled in zip(*params):
+        assert torch.allclose(eager, compiled, atol=1e-6)
+
+
+def test_health_monitor():
+    from torchsso.utils import HealthMonitor
+
+    monitor = HealthMonitor(flush_interval=2, raise_on_nonfinite=True)
+    monitor.track('x', [torch.tensor([1., -2.]), torch.tensor([float('nan'), float('inf'), 3.])])
+    monitor.track('x', torch.tensor([5.]))
+    stats = monitor.flush()
+    assert stats['x'] == {'nan': 1, 'inf': 1, 'min': -2., 'max': 5.}
+    assert monitor.flush() == {}
+
+    # non-finite values are raised lazily at the flush interval
+    monitor.track('x', torch.tensor([float('nan')]))
+    monitor.step()
+    with pytest.raises(FloatingPointError):
+        monitor.step()
+
+    torch.manual_seed(0)
+    model = MLP()
+    x, t = torch.randn(16, 4), torch.randint(3, (16,))
+    for monitor_health in [True, False]:
+        optimizer = get_optimizer(model, monitor_health=monitor_health)
+        closure = get_closure(model, optimizer, x, t)
+
+        optimizer.step(closure)
+        stats = optimizer.health_monitor.flush()
+        if monitor_health:
+            assert set(stats.keys()) >= {'loss', 'grads', 'deltas', 'mean', 'prec', 'pais'}
+            assert all(s['nan'] == 0 and s['inf'] == 0 for s in stats.values())
+        else:
+            assert stats == {}
+
+
+def test_mc_generator():
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model)
+    x, t = torch.randn(16, 4), torch.randint(3, (16,))
+    closure = get_closure(model, optimizer, x, t)
+
+    # the global RNG is not touched
+    state = torch.get_rng_state()
+    optimizer.step(closure)
+    optimizer.prediction(x)
+    assert torch.equal(state, torch.get_rng_state())
+
+    # the noise of each (layer, MC sample) does not depend on the order of sampling
+    optimizer.sample_params(mc_index=1)
+    sample = [p.clone() for p in model.parameters()]
+    optimizer.sample_params(mc_index=0)
+    optimizer.sample_params(mc_index=1)
+    assert all(torch.equal(p, q) for p, q in zip(model.parameters(), sample))
+    optimizer.sample_params(mc_index=2)
+    assert not torch.equal(model.fc1.weight, sample[0])
+
+
+def test_mc_worker_pool():
+    from torchsso.optim import MCWorkerPool
+
+    x, t = torch.randn(16, 4), torch.randint(3, (16,))
+    params = []
+    for use_pool in [False, True]:
+        torch.manual_seed(0)
+        model = MLP()
+        optimizer = get_optimizer(model, num_mc_samples=4)
+        closure = get_closure(model, optimizer, x, t)
+
+        if use_pool:
+            with MCWorkerPool(optimizer, num_workers=2) as pool:
+                pool.step(x, t)
+                # the folded prior is published to the workers
+                optimizer.fold_posterior_into_prior()
+                pool.step(x, t)
+            # the minibatch and the prior are copied into the buffers of the pool
+            assert not x.is_shared() and not t.is_shared()
+            assert not optimizer.param_groups[0]['prior_mean'][0].is_shared()
+        else:
+            optimizer.step(closure)
+            optimizer.fold_posterior_into_prior()
+            optimizer.step(closure)
+        group = optimizer.param_groups[0]
+        params.append([m for m in group['mean'][0]] + [p for p in group['pais'][0]])
+
+    # the same MC samples are evaluated by the workers
+    for serial, parallel in zip(*params):
+        assert torch.allclose(serial, parallel, atol=1e-5)
+
+
+def test_streaming_vi():
+    from torchsso.optim import StreamingVI
+
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model, dataset_size=100)
+    stream = StreamingVI(optimizer, forgetting_factor=0.5, fold_interval=2)
+    l2_reg = optimizer.param_groups[0]['l2_reg']
+
+    for _ in range(4):
+        x, t = torch.randn(16, 4), torch.randint(3, (16,))
+        stream.partial_fit(x, t)
+
+    # N <- 0.5 * N + 16, and it is reset by the folds (after the 2nd and 4th updates)
+    assert stream.num_folds == 2
+    assert stream.dataset_size == 0
+    assert abs(optimizer.defaults['dataset_size'] - (16 * 0.5 + 16)) < 1e-6
+    group = optimizer.param_groups[0]
+    assert abs(group['l2_reg'] - l2_reg * 100 / (16 * 0.5 + 16)) < 1e-9
+
+    # only the data after the fold is counted
+    stream.partial_fit(torch.randn(16, 4), torch.randint(3, (16,)))
+    assert optimizer.defaults['dataset_size'] == 16
+    assert group['prior_mean'][0].shape == model.fc1.weight.shape
+    assert torch.all(group['prior_prec'][0] > 0)
+
+    # the folded prior keeps the variance of the samples when the dataset size is reset
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model, num_gmm_components=1)
+    stream = StreamingVI(optimizer, forgetting_factor=0.99, fold_interval=4)
+
+    def sample_variance():
+        return torch.cat([mo.var.view(-1) for moments in optimizer.posterior_moments().values()
+                          for mo in moments]).mean().item()
+
+    for i in range(5):
+        if i == 3:
+            variance = sample_variance()
+        # folded after the 4th update
+        stream.partial_fit(torch.randn(16, 4), torch.randint(3, (16,)))
+    assert stream.num_folds == 1 and optimizer.defaults['dataset_size'] == 16
+    assert 0.5 < sample_variance() / variance < 2
+
+
+def test_folded_prior_control_variates():
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model, num_mc_samples=2, control_variates=True)
+    x, t = torch.randn(16, 4), torch.randint(3, (16,))
+    optimizer.fold_posterior_into_prior()
+    for group in optimizer.param_groups:
+        group['prior_mean'] = [mean + 1 for mean in group['prior_mean']]
+    closure = get_closure(model, optimizer, x, t)
+    expected = optimizer.closed_form_surrogate()
+
+    def checked_closure(surrogate_loss):
+        # the value is the closed form, and the gradient is that of the folded prior
+        assert torch.allclose(surrogate_loss, expected)
+        for group in optimizer.param_groups:
+            params = group['params']
+            grads = torch.autograd.grad(surrogate_loss, params, retain_graph=True)
+            for p, g, mean, prec in zip(params, grads, group['prior_mean'], group['prior_prec']):
+                assert torch.allclose(g, -2 * group['l2_reg'] * prec * (p - mean))
+        return closure(surrogate_loss)
+
+    optimizer.step(checked_closure)
+
+
+def test_state_dict():
+    x, t = torch.randn(16, 4), torch.randint(3, (16,))
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model)
+
+    def run(model, optimizer, num_steps):
+        closure = get_closure(model, optimizer, x, t)
+        for _ in range(num_steps):
+            optimizer.step(closure)
+
+    run(model, optimizer, 2)
+    state_dict = optimizer.state_dict(include_inverses=False)
+    assert state_dict['version'] == 1
+    assert 'inv' not in state_dict['param_groups'][0]['curv']
+
+    resumed_model = MLP()
+    resumed_model.load_state_dict(model.state_dict())
+    resumed = get_optimizer(resumed_model)
+    resumed.load_state_dict(state_dict)
+    assert resumed.optim_state['step'] == 2
+
+    # the resumed optimizer continues as the original one
+    run(model, optimizer, 2)
+    run(resumed_model, resumed, 2)
+    for group, resumed_group in zip(optimizer.param_groups, resumed.param_groups):
+        for key in ['mean', 'prec', 'pais']:
+            for t_list, resumed_list in zip(group[key], resumed_group[key]):
+                for a, b in zip(t_list, resumed_list):
+                    assert torch.allclose(a, b)
+
+    with pytest.raises(ValueError):
+        resumed.load_state_dict(dict(state_dict, version=2))
+
+
+def test_checkpoint_writer():
+    x, t = torch.randn(16, 4), torch.randint(3, (16,))
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model)
+    closure = get_closure(model, optimizer, x, t)
+
+    optimizer.step(closure)
+    with tempfile.TemporaryDirectory() as directory:
+        writer = AsyncCheckpointWriter(directory, keep_last=2)
+        writer.save(model, optimizer, tag='first', epoch=1)
+        writer.wait()
+        assert sorted(writer.written_shards) == ['layer0', 'layer1', 'meta', 'model']
+
+        # nothing has changed
+        writer.save(model, optimizer, tag='second', epoch=1)
+        writer.wait()
+        assert sorted(writer.skipped_shards) == ['layer0', 'layer1', 'meta', 'model']
+
+        # the shards of a removed checkpoint are kept while another manifest refers to them
+        optimizer.step(closure)
+        writer.save(model, optimizer, tag='third', epoch=2)
+        writer.close()
+        assert not os.path.exists(os.path.join(directory, 'first.json'))
+        other_run = AsyncCheckpointWriter(directory, keep_last=1)
+        for tag in ['fourth', 'fifth']:
+            other_run.save(model, optimizer, tag=tag, epoch=2)
+        other_run.close()
+        assert read_checkpoint(directory, 'second')['epoch'] == 1
+
+        checkpoint = read_checkpoint(directory)
+        assert checkpoint['epoch'] == 2
+
+        resumed_model = MLP()
+        resumed_model.load_state_dict(checkpoint['model'])
+        resumed = get_optimizer(resumed_model)
+        resumed.load_state_dict(checkpoint['optimizer'])
+        assert resumed.optim_state['step'] == optimizer.optim_state['step']
+        for group, resumed_group in zip(optimizer.param_groups, resumed.param_groups):
+            for t_list, resumed_list in zip(group['mean'], resumed_group['mean']):
+                for a, b in zip(t_list, resumed_list):
+                    assert torch.equal(a, b)
+
+
+def test_lazy_checkpoint():
+    x, t = torch.randn(16, 4), torch.randint(3, (16,))
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model)
+    closure = get_closure(model, optimizer, x, t)
+
+    optimizer.step(closure)
+    with tempfile.TemporaryDirectory() as directory:
+        writer = AsyncCheckpointWriter(directory)
+        writer.save(model, optimizer, epoch=1)
+        writer.close()
+
+        # only the layer which is used is loaded
+        resumed_model = MLP()
+        checkpoint = LazyCheckpoint(directory)
+        checkpoint.attach(resumed_model)
+        assert checkpoint['epoch'] == 1 and len(checkpoint.loaded_layers) == 0
+        resumed_model.fc1(x)
+        assert checkpoint.loaded_layers == {0}
+        assert torch.equal(resumed_model.fc1.weight, model.fc1.weight)
+
+        # the state of a param group is loaded at its first access
+        resumed_model = MLP()
+        resumed = get_optimizer(resumed_model)
+        checkpoint = LazyCheckpoint(directory)
+        checkpoint.attach(resumed_model, resumed)
+        assert resumed.optim_state['step'] == optimizer.optim_state['step']
+        mean = resumed.param_groups[1]['mean']
+        assert checkpoint.loaded_layers == {1}
+        for m_list, resumed_list in zip(optimizer.param_groups[1]['mean'], mean):
+            for a, b in zip(m_list, resumed_list):
+                assert torch.equal(a, b)
+        checkpoint.materialize()
+        assert checkpoint.loaded_layers == {0, 1}
+
+
+def test_async_validator():
+    from torchsso.optim import AsyncValidator
+
+    x, t = torch.randn(16, 4), torch.randint(3, (16,))
+    torch.manual_seed(0)
+    model = MLP()
+    optimizer = get_optimizer(model, val_num_mc_samples=2)
+    val_loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(x, t), batch_size=8)
+    closure = get_closure(model, optimizer, x, t)
+
+    with AsyncValidator(model, val_loader, optimizer) as validator:
+        optimizer.step(closure)
+        validator.submit(epoch=1)
+        step = optimizer.optim_state['step']
+        with torch.no_grad():
+            prob = torch.cat([optimizer.prediction(data) for data, _ in val_loader])
+
+        # the training continues while the snapshot is validated
+        optimizer.step(closure)
+        log, = validator.wait()
+    assert log['step'] == step and log['epoch'] == 1
+
+    # the same as the synchronous validation at the step of the snapshot
+    val_loss = F.nll_loss(prob.log(), t).item()
+    assert abs(log['val_loss'] - val_loss) < 1e-5
+    assert log['val_accuracy'] == 100. * prob.argmax(dim=1).eq(t).sum().item() / len(t)
+
+
+if __name__ == '__main__':
+    test_cascade_prediction()
+    test_prediction_cache()
+    test_analytic_prediction()
+    test_posterior_snapshot()
+    test_export_predictive()
+    test_distill_predictive()
+    test_predictive_server()
+    test_prune_posterior()
+    test_deterministic_params()
+    test_stochastic_modules()
+    test_recycle_samples()
+    test_control_variates()
+    test_hyperparam_scheduler()
+    test_step_time_controller()
+    test_noise_scale_tuner()
+    test_ensemble_step()
+    test_compiled_step()
+    test_health_monitor()
+    test_mc_generator()
+    test_mc_worker_pool()
+    test_streaming_vi()
+    test_folded_prior_control_variates()
+    test_state_dict()
+    test_checkpoint_writer()
+    test_lazy_checkpoint()
+    test_async_validator()
@@ -47,6 +47,14 @@ class Curvature(object):
         self.inv = None
         self.std = None
 
+        # whether the curvature is computed in the hooks (see SecondOrderOptimizer.curv_interval)
+        self.update_enabled = True
+        # whether the std has to be recomputed with the inverse (see load_state_dict)
+        self._restore_std = False
+        # version of the EMA, and the version and the damping of the last inversion (see refresh_inv)
+        self._ema_version = 0
+        self._inv_key = None
+
         self.use_sqrt_ema = use_sqrt_ema
         self.use_max_ema = use_max_ema
 
@@ -136,6 +144,9 @@ class Curvature(object):
         setattr(module, 'data_input', data_input)
         setattr(module, 'data_output', output)
 
+        if not self.update_enabled:
+            return
+
         self.update_in_forward(data_input)
 
     def backward_postprocess(self, module, grad_input, grad_output):
@@ -149,6 +160,9 @@ class Curvature(object):
         setattr(module, 'grad_input', grad_input)
         setattr(module, 'grad_output', grad_output)
 
+        if not self.update_enabled:
+            return
+
         self.update_in_backward(grad_output)  # hessian of nn stored in curv.data
 
         # print(self.data)
@@ -173,7 +187,7 @@ class Curvature(object):
         # TODO(oosawak): Add check for ema/inv timing
         self.update_ema()
         if update_inv:
-            self.update_inv()
+            self.refresh_inv()
         if update_std:
             self.update_std()
 
@@ -195,11 +209,58 @@ class Curvature(object):
         if self.use_max_ema:
             for e, e_max in zip(self.ema, self.ema_max):
                 torch.max(e, e_max, out=e_max)
+        self._ema_version += 1
 
     def update_inv(self):
         ema = self.ema if not self.use_max_ema else self.ema_max
         self.inv = [self._inv(e) for e in ema]
 
+    def refresh_inv(self):
+        """Updates the inverse only if the EMA (or the damping) has changed since the last inversion."""
+        key = (self._ema_version, self.damping)
+        if self.inv is not None and key == self._inv_key:
+            return
+        self.update_inv()
+        self._inv_key = key
+
+    def ensure_inv(self):
+        """Recomputes the inverse (and std) which were not loaded (see state_dict(include_inverses=False))."""
+        if self.inv is not None or self.ema is None:
+            return
+        self.refresh_inv()
+        if self._restore_std:
+            self.update_std()
+            self._restore_std = False
+
+    def state_dict(self, include_inverses=True, copy_tensors=True):
+        """Returns the state (data, EMA and, optionally, inverse and std) of the curvature."""
+        copy = _clone if copy_tensors else (lambda value: value)
+        state = {'ema_decay': self.ema_decay, 'l2_reg': self._l2_reg, 'l2_reg_ema': self._l2_reg_ema,
+                 'data': copy(self.data), 'ema': copy(self.ema), 'ema_max': copy(self.ema_max)}
+        if include_inverses:
+            state['inv'] = copy(self.inv)
+            state['std'] = copy(self.std)
+        else:
+            state['has_std'] = self.std is not None
+
+        return state
+
+    def load_state_dict(self, state):
+        device = self.device
+        self.ema_decay = state['ema_decay']
+        self._l2_reg, self._l2_reg_ema = state['l2_reg'], state['l2_reg_ema']
+        data = _to_device(state['data'], device)
+        if data is not None:
+            self.data = data
+        self.ema = _to_device(state['ema'], device)
+        self.ema_max = _to_device(state['ema_max'], device)
+        # the inverses are recomputed lazily (see ensure_inv) if they are not included
+        self.inv = _to_device(state.get('inv', None), device)
+        self.std = _to_device(state.get('std', None), device)
+        self._restore_std = state.get('has_std', False)
+        self._ema_version += 1
+        self._inv_key = None if self.inv is None else (self._ema_version, self.damping)
+
     def _inv(self, X):
         X_damp = add_value_to_diagonal(X, self.damping)
 
@@ -255,7 +316,7 @@ class DiagCurvature(Curvature):
         if self.std is None:
             return 0
 
-        return sum(std.norm().item() for std in self.std)
+        return sum(std.norm() for std in self.std)
 
 
 class KronCurvature(Curvature):
@@ -334,13 +395,25 @@ class KronCurvature(Curvature):
             return 0
 
         A_ic, G_ic = self.std
-        return A_ic.norm().item() * G_ic.norm().item()
+        return A_ic.norm() * G_ic.norm()
+
+
+def _clone(value):
+    # (nested lists of) tensors are copied, and the other values (e.g., None) are returned as they are
+    if isinstance(value, torch.Tensor):
+        return value.detach().clone()
+    if isinstance(value, (list, tuple)):
+        return [_clone(v) for v in value]
+    return value
+
+
+def _to_device(value, device):
+    if isinstance(value, torch.Tensor):
+        return value.to(device)
+    if isinstance(value, (list, tuple)):
+        return [_to_device(v, device) for v in value]
+    return value
 
 
 def add_value_to_diagonal(X, value):
-    if torch.cuda.is_available():
-        indices = torch.cuda.LongTensor([[i, i] for i in range(X.shape[0])])
-    else:
-        indices = torch.LongTensor([[i, i] for i in range(X.shape[0])])
-    values = X.new_ones(X.shape[0]).mul(value)
-    return X.index_put(tuple(indices.t()), values, accumulate=True)
+    return X + torch.diag(X.new_ones(X.shape[0]).mul(value))
@@ -112,8 +112,8 @@ class KronHessian(KronCurvature):
         module = self._module
         setattr(module, 'derivative_order', 1)
 
-    def step(self, update_std=False):
-        super(KronHessian, self).step(update_std)
+    def step(self, update_std=False, update_inv=True):
+        super(KronHessian, self).step(update_std, update_inv)
         self.reset_derivative_order()
 
 
@@ -2,3 +2,10 @@ from torchsso.optim.firstorder import DistributedFirstOrderOptimizer  # NOQA
 from torchsso.optim.secondorder import SecondOrderOptimizer, DistributedSecondOrderOptimizer  # NOQA
 from torchsso.optim.vi import VIOptimizer, DistributedVIOptimizer, VOGN  # NOQA
 from torchsso.optim import lr_scheduler  # NOQA
+from torchsso.optim.distillation import distill_predictive  # NOQA
+from torchsso.optim.pruning import prune_posterior  # NOQA
+from torchsso.optim.budget import StepTimeController  # NOQA
+from torchsso.optim.noise_scale import NoiseScaleTuner  # NOQA
+from torchsso.optim.mc_pool import MCWorkerPool  # NOQA
+from torchsso.optim.streaming import StreamingVI  # NOQA
+from torchsso.optim.async_validation import AsyncValidator  # NOQA
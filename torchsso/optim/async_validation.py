@@ -0,0 +1,186 @@
+import queue
+import time
+
+import torch
+import torch.nn.functional as F
+from torchsso.optim.vi import VIOptimizer
+from torchsso.utils.shared_posterior import SharedPosterior, fork_context
+
+
+def _validation_worker(model, optimizer, val_loader, num_threads, model_state, posterior, commands, results):
+    torch.set_num_threads(num_threads)
+    model.eval()
+
+    # the posterior is read from the shared buffers (updated by the main process before each command)
+    if optimizer is not None:
+        posterior.attach(optimizer)
+
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+        step, std_scales, tags = command
+
+        try:
+            start = time.perf_counter()
+            model.load_state_dict(model_state)
+            if optimizer is not None:
+                optimizer.optim_state['step'] = step
+                for group, std_scale in zip(optimizer.param_groups, std_scales):
+                    group['std_scale'] = std_scale
+                    optimizer.update_frozen(group)
+                if optimizer.prediction_cache is not None:
+                    optimizer.prediction_cache.clear()
+
+            val_loss, correct, num_data = 0., 0, 0
+            with torch.no_grad():
+                for data, target in val_loader:
+                    if optimizer is not None:
+                        # negative log-likelihood of the predictive distribution
+                        prob = optimizer.prediction(data)
+                        val_loss += F.nll_loss(prob.clamp(min=1e-12).log(), target, reduction='sum').item()
+                        pred = prob.argmax(dim=1)
+                    else:
+                        output = model(data)
+                        val_loss += F.cross_entropy(output, target, reduction='sum').item()
+                        pred = output.argmax(dim=1)
+                    correct += pred.eq(target).sum().item()
+                    num_data += len(target)
+
+            log = {'step': step}
+            log.update(tags)
+            log.update({'val_loss': val_loss / num_data, 'val_accuracy': 100. * correct / num_data,
+                        'val_time': time.perf_counter() - start})
+            results.put((None, log))
+        except Exception as e:
+            results.put((repr(e), None))
+
+
+class AsyncValidator(object):
+    r"""Validation in a background worker process on a snapshot of the model (and the posterior).
+
+    submit() only copies the state of the model and the posterior (mean, covariance and mixture weights)
+        of VIOptimizer into buffers in shared memory (see torchsso.utils.SharedPosterior), and the worker
+        process (forked from the main process, with a copy of the model and the optimizer) evaluates
+        the (MC) predictions for the whole val_loader while the training continues. The metrics are written to the logger (and returned) by poll()
+        when they are ready, tagged with the step of the snapshot (and the tags passed to submit()).
+    As the predictions are drawn from the evaluation streams of the step (see VIOptimizer.mc_generator),
+        the metrics are the same as those of the synchronous validation at the step.
+    Only one snapshot is evaluated at a time, i.e., submit() waits for the previous validation.
+    Only the models on CPU are supported, and the val_loader has to load the data in the worker process
+        (num_workers=0).
+    As the worker is forked, the validator has to be created before CUDA is initialized in the main process
+        (see torchsso.utils.shared_posterior.fork_context).
+
+    Args:
+        model (torch.nn.Module): model (for classification) to be validated
+        val_loader (torch.utils.data.DataLoader): loader of the validation data
+        optimizer (torchsso.optim.VIOptimizer, optional): optimizer whose predictive distribution
+            (with val_num_mc_samples) is validated (the model itself is validated if None)
+        logger (torchsso.utils.Logger, optional): logger to which the metrics are written
+        num_threads (int, optional): number of threads of the worker
+
+    Example:
+        >>> with AsyncValidator(model, val_loader, optimizer, logger) as validator:
+        >>>     for epoch in range(1, epochs + 1):
+        >>>         train(model, train_loader, optimizer)
+        >>>         validator.poll()
+        >>>         validator.submit(epoch=epoch)
+    """
+
+    def __init__(self, model, val_loader, optimizer: VIOptimizer = None, logger=None, num_threads=1):
+        if optimizer is not None and not isinstance(optimizer, VIOptimizer):
+            raise ValueError("Invalid optimizer for AsyncValidator: {}".format(type(optimizer).__name__))
+        if getattr(val_loader, 'num_workers', 0) != 0:
+            raise ValueError("Invalid number of workers of val_loader for AsyncValidator: {}".format(
+                val_loader.num_workers))
+        if num_threads < 1:
+            raise ValueError("Invalid number of threads: {}".format(num_threads))
+        for p in model.parameters():
+            if p.device.type != 'cpu':
+                raise ValueError("Invalid device for AsyncValidator: {}".format(p.device))
+
+        self.model = model
+        self.optimizer = optimizer
+        self.logger = logger
+        self.results = []
+        self._pending = False
+
+        ctx = fork_context(type(self).__name__)
+        self._model_state = {key: value.detach().clone().share_memory_()
+                             for key, value in model.state_dict().items()}
+        self._posterior = SharedPosterior(optimizer) if optimizer is not None else None
+
+        # the model and the optimizer are inherited by fork
+        self._commands = ctx.Queue()
+        self._results = ctx.Queue()
+        self._worker = ctx.Process(target=_validation_worker,
+                                   args=(model, optimizer, val_loader, num_threads, self._model_state,
+                                         self._posterior, self._commands, self._results),
+                                   daemon=True)
+        self._worker.start()
+
+    def _publish(self):
+        with torch.no_grad():
+            for key, value in self.model.state_dict().items():
+                self._model_state[key].copy_(value)
+        if self._posterior is not None:
+            self._posterior.publish(self.optimizer)
+
+    def submit(self, **tags):
+        """Starts the validation on a snapshot of the current model (and posterior)."""
+        assert self._worker is not None, 'The validator has already been closed.'
+        if self._pending:
+            self.wait()
+
+        optimizer = self.optimizer
+        step = None
+        std_scales = None
+        if optimizer is not None:
+            step = optimizer.optim_state['step']
+            std_scales = [group['std_scale'] for group in optimizer.param_groups]
+        self._publish()
+        self._commands.put((step, std_scales, tags))
+        self._pending = True
+
+    def _collect(self, block):
+        try:
+            error, log = self._results.get(block=block)
+        except queue.Empty:
+            return []
+        self._pending = False
+        if error is not None:
+            raise RuntimeError('Validation worker failed: {}'.format(error))
+        self.results.append(log)
+        if self.logger is not None:
+            self.logger.write(log)
+
+        return [log]
+
+    def poll(self):
+        """Returns (and writes to the logger) the metrics of the finished validation, if any."""
+        if not self._pending:
+            return []
+        return self._collect(block=False)
+
+    def wait(self):
+        """Waits for the pending validation and returns (and writes to the logger) its metrics."""
+        if not self._pending:
+            return []
+        return self._collect(block=True)
+
+    def close(self):
+        if self._worker is None:
+            return
+        try:
+            self.wait()
+        finally:
+            self._commands.put(None)
+            self._worker.join()
+            self._worker = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,174 @@
+import math
+import time
+
+from torchsso.optim.secondorder import SecondOrderOptimizer
+from torchsso.optim.vi import VIOptimizer
+from torchsso.utils.timing import TimedClosure, synchronize
+
+
+class StepTimeController(object):
+    r"""Holds the wall time of optimizer.step() around a target by adjusting the cost-driving knobs live.
+
+    The time of each step is split into the forward/backward passes (the closure) and the rest,
+        i.e., the curvature, inverse and posterior updates. When the (EMA of the) step time exceeds
+        the budget, the knob of the dominant phase is degraded: num_mc_samples is decreased for
+        the passes, and inv_interval/curv_interval are increased for the updates. When the step is
+        well within the budget, the knobs are restored in the reverse order, i.e., the estimator
+        quality is recovered as much as the budget allows.
+    A new value is applied at the boundary of its window (see SecondOrderOptimizer.is_boundary), i.e.,
+        never in the middle of an accumulation or of an interval.
+    Every adjustment is recorded in adjustments (and written to the logger) when it is applied.
+
+    Args:
+        optimizer (torchsso.optim.SecondOrderOptimizer): optimizer to be controlled
+        target_step_time (float): budget (sec) of each step
+        tolerance (float, optional): relative band around the target in which nothing is adjusted
+        ema_decay (float, optional): decay rate for EMA of the measured times
+        patience (int, optional): number of steps between two adjustments
+        min_num_mc_samples (int, optional): lower bound of num_mc_samples (VIOptimizer)
+        max_interval (int, optional): upper bound of curv_interval and inv_interval
+        logger (torchsso.utils.Logger, optional): logger to which every adjustment is written
+
+    Example:
+        >>> controller = StepTimeController(optimizer, target_step_time=0.2)
+        >>> loss, prob, network_loss = controller.step(closure)
+    """
+
+    def __init__(self, optimizer: SecondOrderOptimizer, target_step_time, tolerance=0.1, ema_decay=0.1,
+                 patience=10, min_num_mc_samples=1, max_interval=100, logger=None):
+        if target_step_time <= 0:
+            raise ValueError("Invalid target step time: {}".format(target_step_time))
+        if tolerance < 0 or 1 <= tolerance:
+            raise ValueError("Invalid tolerance: {}".format(tolerance))
+        if ema_decay <= 0 or 1 < ema_decay:
+            raise ValueError("Invalid ema_decay: {}".format(ema_decay))
+        if patience < 1:
+            raise ValueError("Invalid patience: {}".format(patience))
+        if min_num_mc_samples < 1:
+            raise ValueError("Invalid min_num_mc_samples: {}".format(min_num_mc_samples))
+        if max_interval < 1:
+            raise ValueError("Invalid max_interval: {}".format(max_interval))
+
+        self.optimizer = optimizer
+        self.target_step_time = target_step_time
+        self.tolerance = tolerance
+        self.ema_decay = ema_decay
+        self.patience = patience
+        self.min_num_mc_samples = min_num_mc_samples
+        self.max_interval = max_interval
+        self.logger = logger
+
+        defaults = optimizer.defaults
+        self.max_num_mc_samples = defaults.get('num_mc_samples', None)
+        # VIOptimizer has no inverse of the curvature
+        self.knobs = ['curv_interval'] if isinstance(optimizer, VIOptimizer) else ['curv_interval', 'inv_interval']
+        if self.max_num_mc_samples is not None:
+            self.knobs.append('num_mc_samples')
+        self.initial_values = {knob: defaults[knob] for knob in self.knobs}
+
+        self.step_time = None
+        self.closure_time = None
+        self.adjustments = []
+        self.pending = {}
+        self._num_closures = 0
+        self._steps_since_adjustment = 0
+
+    def step(self, closure=None):
+        timed_closure = TimedClosure(closure) if closure is not None else None
+
+        synchronize()
+        start = time.perf_counter()
+        ret = self.optimizer.step(timed_closure)
+        synchronize()
+        step_time = time.perf_counter() - start
+
+        self._update_ema(step_time, timed_closure.time if timed_closure is not None else 0.)
+        self._num_closures = timed_closure.num_calls if timed_closure is not None else 0
+        self._steps_since_adjustment += 1
+        if self._steps_since_adjustment >= self.patience:
+            self.adjust()
+        self.apply_pending()
+
+        return ret
+
+    def _update_ema(self, step_time, closure_time):
+        beta = self.ema_decay
+        if self.step_time is None:
+            self.step_time, self.closure_time = step_time, closure_time
+        else:
+            self.step_time = beta * step_time + (1 - beta) * self.step_time
+            self.closure_time = beta * closure_time + (1 - beta) * self.closure_time
+
+    def adjust(self):
+        """Adjusts (at most) one knob according to the measured step time."""
+        target = self.target_step_time
+        step_time, closure_time = self.step_time, self.closure_time
+        if step_time is None:
+            return
+
+        passes_dominant = closure_time >= step_time - closure_time
+        if step_time > target * (1 + self.tolerance):
+            order = ['num_mc_samples', 'curv_interval', 'inv_interval'] if passes_dominant \
+                else ['inv_interval', 'curv_interval', 'num_mc_samples']
+            for knob in order:
+                if knob in self.knobs and self._degrade(knob, step_time - target):
+                    return
+        elif step_time < target * (1 - self.tolerance):
+            for knob in ['num_mc_samples', 'curv_interval', 'inv_interval']:
+                if knob in self.knobs and self._restore(knob, target - step_time):
+                    return
+
+    def _time_per_sample(self):
+        return self.closure_time / max(self._num_closures, 1)
+
+    def _value(self, knob):
+        return self.pending.get(knob, self.optimizer.defaults[knob])
+
+    def _degrade(self, knob, excess):
+        value = self._value(knob)
+        if knob == 'num_mc_samples':
+            per_sample = self._time_per_sample()
+            num = math.ceil(excess / per_sample) if per_sample > 0 else 1
+            new_value = max(self.min_num_mc_samples, value - num)
+        else:
+            new_value = min(self.max_interval, value * 2)
+
+        return self._set(knob, value, new_value)
+
+    def _restore(self, knob, slack):
+        value = self._value(knob)
+        if knob == 'num_mc_samples':
+            per_sample = self._time_per_sample()
+            num = math.floor(slack / per_sample) if per_sample > 0 else 0
+            new_value = min(self.max_num_mc_samples, value + num)
+        else:
+            new_value = max(self.initial_values[knob], value // 2)
+
+        return self._set(knob, value, new_value)
+
+    def _set(self, knob, value, new_value):
+        if new_value == value:
+            return False
+
+        self.pending[knob] = new_value
+        self._steps_since_adjustment = 0
+
+        return True
+
+    def apply_pending(self):
+        """Applies the adjusted values whose windows have ended."""
+        optimizer = self.optimizer
+        for knob in list(self.pending.keys()):
+            if not optimizer.is_boundary(knob):
+                continue
+            value, new_value = optimizer.defaults[knob], self.pending.pop(knob)
+            if new_value == value:
+                continue
+            optimizer.defaults[knob] = new_value
+
+            log = {'step': optimizer.optim_state['step'], 'knob': knob, 'old': value, 'new': new_value,
+                   'step_time': self.step_time, 'closure_time': self.closure_time,
+                   'target_step_time': self.target_step_time}
+            self.adjustments.append(log)
+            if self.logger is not None:
+                self.logger.write(log)
@@ -0,0 +1,88 @@
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torchsso.optim.vi import VIOptimizer
+from torchsso.utils.posterior_predictive import prediction_entropy
+
+
+def distillation_loss(output, teacher_prob, entropy_weight=0.):
+    r"""KL divergence from the teacher's predictive to the student's one (up to a constant).
+
+    Args:
+        output (torch.Tensor): output (logits) of the student
+        teacher_prob (torch.Tensor): predictive probabilities of the teacher
+        entropy_weight (float, optional): weight of the squared error between the predictive entropies
+    """
+    if output.ndim == 2:
+        log_prob = F.log_softmax(output, dim=1)
+        loss = F.kl_div(log_prob, teacher_prob, reduction='batchmean')
+        prob = log_prob.exp()
+    elif output.ndim == 1:
+        loss = F.binary_cross_entropy_with_logits(output, teacher_prob)
+        prob = torch.sigmoid(output)
+    else:
+        raise ValueError(f'Invalid ndim {output.ndim}')
+
+    if entropy_weight > 0:
+        entropy_error = prediction_entropy(prob) - prediction_entropy(teacher_prob)
+        loss = loss + entropy_weight * entropy_error.pow(2).mean()
+
+    return loss
+
+
+def distill_predictive(optimizer: VIOptimizer, data_loader, student: nn.Module = None,
+                       epochs=1, lr=1e-3, entropy_weight=0., num_samples=None, seed=None):
+    r"""Trains a deterministic network to match the MC-averaged predictive of the posterior.
+
+    The teacher is the module built by VIOptimizer.export_predictive(), i.e., the params are
+        sampled once into a bank which is shared by all the batches of the data stream.
+
+    Args:
+        optimizer (torchsso.optim.VIOptimizer): optimizer which manages the posterior
+        data_loader (iterable): stream of inputs (or of tuples whose first element is the input)
+        student (torch.nn.Module, optional): network to be trained
+            (a copy of optimizer.model initialized with the posterior mean is used if None)
+        epochs (int, optional): number of passes over the data_loader
+        lr (float, optional): learning rate (Adam) for the student
+        entropy_weight (float, optional): weight of the predictive entropy matching term
+        num_samples (int, optional): number of MC samples of the teacher
+            (val_num_mc_samples is used if None)
+        seed (int, optional): seed of the generator for the samples of the teacher
+
+    Returns:
+        torch.nn.Module: the trained student
+    """
+    teacher = optimizer.export_predictive(num_samples, seed)
+    teacher.eval()
+
+    if student is None:
+        optimizer.copy_mean_to_params()
+        student = copy.deepcopy(optimizer.model)
+        # detach the curvature hooks copied with the model
+        for module in student.modules():
+            module._forward_hooks.clear()
+            module._backward_hooks.clear()
+        # and the prefix-cached forward (see VIOptimizer.stochastic_modules)
+        student.__dict__.pop('forward', None)
+
+    student_optimizer = torch.optim.Adam(student.parameters(), lr=lr)
+    student.train()
+
+    for _ in range(epochs):
+        for data in data_loader:
+            if isinstance(data, (tuple, list)):
+                data = data[0]
+
+            with torch.no_grad():
+                teacher_prob = teacher(data)
+
+            student_optimizer.zero_grad()
+            loss = distillation_loss(student(data), teacher_prob, entropy_weight)
+            loss.backward()
+            student_optimizer.step()
+
+    student.eval()
+
+    return student
@@ -1,4 +1,5 @@
 from torch.optim import Optimizer
+from torchsso.optim.vi import VIOptimizer
 
 
 class _IterLRScheduler(object):
@@ -131,3 +132,91 @@ class MomentumCorrectionLR(object):
 
     def __setattr__(self, key, value):
         setattr(self.scheduler, key, value)
+
+
+class HyperParamScheduler(_IterLRScheduler):
+    """Set the cost-driving hyperparameters (num_mc_samples, acc_steps and ema_decay
+    of the curvature) of the optimizer by milestones. The learning rate is kept as it is.
+    A new acc_steps or num_mc_samples is applied at the boundary of the accumulation.
+    ema_decay is supported only for SecondOrderOptimizer, as VIOptimizer updates the precision
+    with the curvature of each step (not with its EMA).
+    Args:
+        optimizer (Optimizer): Wrapped optimizer (SecondOrderOptimizer or VIOptimizer).
+        schedules (dict): name of the hyperparameter -> list of [iter, value] milestones.
+        interpolation (str): 'step' (the value of the last milestone) or 'linear'
+            (interpolated between the milestones, rounded for the integers). Default: 'step'.
+        scheduler_type (str): whether step() is called every 'iter' or 'epoch'. Default: 'iter'.
+        last_iter (int): The index of last iter. Default: -1.
+    Example:
+        >>> schedules = {'num_mc_samples': [[0, 2], [5000, 10]], 'acc_steps': [[0, 1], [20000, 4]]}
+        >>> scheduler = HyperParamScheduler(optimizer, schedules, interpolation='linear')
+    """
+
+    int_params = ('num_mc_samples', 'acc_steps')
+    float_params = ('ema_decay',)
+
+    def __init__(self, optimizer, schedules, interpolation='step', scheduler_type='iter', last_iter=-1):
+        if interpolation not in ['step', 'linear']:
+            raise ValueError("Invalid interpolation: {}".format(interpolation))
+        if scheduler_type not in ['iter', 'epoch']:
+            raise ValueError("Invalid scheduler_type: {}".format(scheduler_type))
+
+        for name, milestones in schedules.items():
+            if name not in self.int_params + self.float_params:
+                raise ValueError("Invalid hyperparameter: {}".format(name))
+            if name in self.int_params and name not in optimizer.defaults \
+                    or name == 'ema_decay' and isinstance(optimizer, VIOptimizer):
+                raise ValueError("Invalid hyperparameter for {}: {}".format(type(optimizer).__name__, name))
+            if len(milestones) == 0:
+                raise ValueError("Invalid milestones for {}: {}".format(name, milestones))
+            for _, value in milestones:
+                if name in self.int_params and value < 1:
+                    raise ValueError("Invalid {}: {}".format(name, value))
+                if name in self.float_params and (value < 0 or 1 < value):
+                    raise ValueError("Invalid {}: {}".format(name, value))
+
+        self.schedules = {name: sorted([list(m) for m in milestones], key=lambda m: m[0])
+                          for name, milestones in schedules.items()}
+        self.interpolation = interpolation
+        super(HyperParamScheduler, self).__init__(optimizer, last_iter)
+        self.scheduler_type = scheduler_type
+
+    def get_lr(self):
+        return [param_group['lr'] for param_group in self.optimizer.param_groups]
+
+    def get_value(self, name):
+        milestones = self.schedules[name]
+        count = self.last_iter
+        if count <= milestones[0][0]:
+            value = milestones[0][1]
+        elif count >= milestones[-1][0]:
+            value = milestones[-1][1]
+        else:
+            i = max(i for i, m in enumerate(milestones) if m[0] <= count)
+            (start, v0), (end, v1) = milestones[i], milestones[i + 1]
+            if self.interpolation == 'step':
+                value = v0
+            else:
+                value = v0 + (v1 - v0) * (count - start) / (end - start)
+
+        if name in self.int_params:
+            value = int(round(value))
+
+        return value
+
+    def step(self, iter=None):
+        super(HyperParamScheduler, self).step(iter)
+
+        optimizer = self.optimizer
+        for name in self.schedules:
+            value = self.get_value(name)
+            if name == 'ema_decay':
+                for group in optimizer.param_groups:
+                    curv = group.get('curv', None)
+                    if curv is not None:
+                        curv.ema_decay = value
+            elif hasattr(optimizer, 'is_boundary') and not optimizer.is_boundary(name):
+                # wait for the boundary of the accumulation
+                continue
+            else:
+                optimizer.defaults[name] = value
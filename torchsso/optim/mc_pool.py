@@ -0,0 +1,237 @@
+import torch
+import torch.nn.functional as F
+from torchsso.curv.curvature import DiagCurvature
+from torchsso.optim.vi import VIOptimizer, TRAIN_STREAM
+from torchsso.utils.shared_posterior import SharedPosterior, fork_context
+
+
+def _zeros_like_shared(shape_list, num_slots):
+    return [torch.zeros(num_slots, *shape).share_memory_() for shape in shape_list]
+
+
+def _mc_worker(optimizer, criterion, rank, num_threads, posterior, shared, commands, results):
+    torch.set_num_threads(num_threads)
+    model = optimizer.model
+
+    # the posterior is read from the shared buffers (updated by the main process before each command)
+    posterior.attach(optimizer)
+
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+        step, mc_indices, data, target, is_curv_step, scalars, folded = command
+
+        try:
+            optimizer.optim_state['step'] = step
+            optimizer.enable_curvature_update(is_curv_step)
+            posterior.attach(optimizer, folded)
+            for group, (std_scale, l2_reg) in zip(optimizer.param_groups, scalars):
+                group['std_scale'], group['l2_reg'] = std_scale, l2_reg
+
+            for key in ['grads', 'curv', 'deltas']:
+                for buf_list in shared[key]:
+                    for buf in buf_list:
+                        buf[rank].zero_()
+
+            loss_sum, network_loss_sum, prob_sum = 0., 0., 0.
+            for i in mc_indices:
+                optimizer.sample_params(mc_index=i, stream=TRAIN_STREAM)
+                ent_loss, reg_loss = optimizer.surrogate_terms()
+
+                optimizer.zero_grad()
+                output = model(data)
+                network_loss = criterion(output, target)
+                loss = network_loss - (ent_loss - reg_loss)
+                loss.backward()
+
+                loss_sum += loss.item()
+                network_loss_sum += network_loss.item()
+                prob = F.softmax(output, dim=1) if output.ndim == 2 else torch.sigmoid(output)
+                prob_sum = prob_sum + prob.detach()
+
+                # reduced in place into the slot of this worker
+                for j, group in enumerate(optimizer.param_groups):
+                    for buf, p in zip(shared['grads'][j], group['params']):
+                        buf[rank].add_(p.grad)
+                    for buf, d in zip(shared['curv'][j], group['curv'].data):
+                        buf[rank].add_(d)
+                    deltas = optimizer.calculate_deltas(group['mean'], group['cov'], group['pais'],
+                                                        group['params'], group['frozen'])
+                    for buf, d_list in zip(shared['deltas'][j], deltas):
+                        buf[rank].add_(torch.stack(d_list))
+
+            results.put((rank, None, loss_sum, network_loss_sum, prob_sum))
+        except Exception as e:
+            results.put((rank, repr(e), None, None, None))
+
+
+class MCWorkerPool(object):
+    r"""Pool of local worker processes which evaluate the MC samples of VIOptimizer.step() in parallel.
+
+    The workers are forked from the main process (with a copy of the model and the optimizer), read the
+        posterior (mean, covariance, mixture weights and the folded prior) from buffers in shared memory
+        (see torchsso.utils.SharedPosterior), and evaluate disjoint slices of the num_mc_samples draws
+        for the minibatch (passed through shared memory).
+        The gradients, curvatures and deltas are reduced in place into the slot of each worker in
+        shared buffers, which are summed and applied by the main process.
+    As the noise of each MC sample is drawn from its own stream (see VIOptimizer.mc_generator),
+        the samples are the same as those of VIOptimizer.step() regardless of the number of workers.
+    Only diagonal curvatures on CPU are supported, and control variates, sample recycling and
+        deterministic_tol are not supported.
+    As the workers are forked, the pool has to be created before CUDA is initialized in the main process
+        (see torchsso.utils.shared_posterior.fork_context).
+    The minibatches are copied into the buffers of the pool in shared memory, i.e., the tensors passed to
+        step() are not moved to shared memory.
+
+    Args:
+        optimizer (torchsso.optim.VIOptimizer): optimizer whose MC samples are evaluated
+        num_workers (int, optional): number of the worker processes
+        criterion (callable, optional): loss function (with mean reduction) of output and target
+        num_threads (int, optional): number of threads of each worker
+            (the threads of the main process are shared by the workers if None)
+
+    Example:
+        >>> with MCWorkerPool(optimizer, num_workers=8) as pool:
+        >>>     for data, target in train_loader:
+        >>>         loss, prob, network_loss = pool.step(data, target)
+    """
+
+    def __init__(self, optimizer: VIOptimizer, num_workers=2, criterion=F.cross_entropy, num_threads=None):
+        if num_workers < 1:
+            raise ValueError("Invalid number of workers: {}".format(num_workers))
+        if num_threads is not None and num_threads < 1:
+            raise ValueError("Invalid number of threads: {}".format(num_threads))
+        for key in ['control_variates', 'linearized_baseline']:
+            if optimizer.defaults[key]:
+                raise ValueError("Invalid {} for MCWorkerPool: {}".format(key, optimizer.defaults[key]))
+        if optimizer.recycle_buffer is not None:
+            raise ValueError("Invalid recycle buffer size for MCWorkerPool: {}".format(
+                optimizer.recycle_buffer.maxlen))
+        if optimizer.defaults['deterministic_tol'] != 0:
+            raise ValueError("Invalid deterministic tolerance for MCWorkerPool: {}".format(
+                optimizer.defaults['deterministic_tol']))
+        for group in optimizer.param_groups:
+            if not isinstance(group['curv'], DiagCurvature):
+                raise ValueError("Invalid curvature for MCWorkerPool: {}".format(type(group['curv']).__name__))
+            if group['params'][0].device.type != 'cpu':
+                raise ValueError("Invalid device for MCWorkerPool: {}".format(group['params'][0].device))
+
+        self.optimizer = optimizer
+        self.num_workers = num_workers
+        if num_threads is None:
+            num_threads = max(torch.get_num_threads() // num_workers, 1)
+
+        ctx = fork_context(type(self).__name__)
+        K = optimizer.num_gmm_components
+        self._posterior = SharedPosterior(optimizer, prior=True)
+        shared = {key: [] for key in ['grads', 'curv', 'deltas']}
+        for group in optimizer.param_groups:
+            shapes = [p.shape for p in group['params']]
+            shared['grads'].append(_zeros_like_shared(shapes, num_workers))
+            shared['curv'].append(_zeros_like_shared(shapes, num_workers))
+            shared['deltas'].append(_zeros_like_shared([(K,) + tuple(s) for s in shapes], num_workers))
+        self._shared = shared
+        self._batch = {'data': None, 'target': None}
+        self.publish_posterior()
+
+        # the model and the optimizer (with the hooks) are inherited by fork
+        self._results = ctx.Queue()
+        self._commands = [ctx.Queue() for _ in range(num_workers)]
+        self._workers = [ctx.Process(target=_mc_worker,
+                                     args=(optimizer, criterion, rank, num_threads, self._posterior, shared,
+                                           commands, self._results),
+                                     daemon=True)
+                         for rank, commands in enumerate(self._commands)]
+        for worker in self._workers:
+            worker.start()
+
+    def publish_posterior(self):
+        """Copies the current posterior (and the folded prior) of the optimizer to the shared buffers.
+
+        Returns:
+            list: whether the prior of each param group is folded
+        """
+        return self._posterior.publish(self.optimizer)
+
+    def _copy_to_shared(self, key, tensor):
+        # the buffer is reallocated only when the shape changes (e.g., for the last minibatch of an epoch)
+        buf = self._batch[key]
+        if buf is None or buf.shape != tensor.shape or buf.dtype != tensor.dtype:
+            buf = torch.empty_like(tensor, device='cpu').share_memory_()
+            self._batch[key] = buf
+        buf.copy_(tensor)
+        return buf
+
+    def step(self, data, target):
+        """Performs a single optimization step of the optimizer with the MC samples evaluated by the workers.
+
+        Returns:
+            tuple: loss and predictive probabilities (averaged over the MC samples),
+                and the network loss (only at the end of the accumulation, see acc_steps)
+        """
+        assert self._workers is not None, 'The pool has already been closed.'
+        optimizer = self.optimizer
+        m = optimizer.defaults['num_mc_samples']
+        n = optimizer.defaults['acc_steps']
+        is_curv_step = optimizer.is_curv_step()
+
+        # only the buffers (and python scalars) are sent to the workers, so that no tensor of the optimizer
+        # is moved to shared memory by the queues
+        folded = self.publish_posterior()
+        data, target = self._copy_to_shared('data', data), self._copy_to_shared('target', target)
+        scalars = [(group['std_scale'], group['l2_reg']) for group in optimizer.param_groups]
+        for rank, commands in enumerate(self._commands):
+            mc_indices = list(range(rank, m, self.num_workers))
+            commands.put((optimizer.optim_state['step'], mc_indices, data, target, is_curv_step, scalars, folded))
+
+        loss, network_loss, prob = 0., 0., 0.
+        errors = []
+        for _ in range(self.num_workers):
+            rank, error, loss_sum, network_loss_sum, prob_sum = self._results.get()
+            if error is not None:
+                errors.append('worker {}: {}'.format(rank, error))
+                continue
+            loss += loss_sum / m
+            network_loss += network_loss_sum / m
+            prob = prob + prob_sum / m
+        if len(errors) > 0:
+            raise RuntimeError('MC workers failed: {}'.format(', '.join(errors)))
+
+        shared = self._shared
+        for i, group in enumerate(optimizer.param_groups):
+            group['acc_grads'].update([buf.sum(dim=0) for buf in shared['grads'][i]], scale=1/m/n)
+            group['acc_curv'].update([buf.sum(dim=0) for buf in shared['curv'][i]], scale=1/m/n)
+            group['acc_delta'].update([list(buf.sum(dim=0).unbind(0)) for buf in shared['deltas'][i]],
+                                      scale=1/m/n)
+        loss = torch.tensor(loss)
+
+        # update acc step
+        optimizer.optim_state['acc_step'] += 1
+        if optimizer.optim_state['acc_step'] < n:
+            return loss, prob
+        else:
+            optimizer.optim_state['acc_step'] = 0
+
+        for group in optimizer.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    p.grad = torch.zeros_like(p)
+        optimizer.update_posterior(loss, is_curv_step)
+
+        return loss, prob, torch.tensor(network_loss)
+
+    def close(self):
+        if self._workers is None:
+            return
+        for commands in self._commands:
+            commands.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
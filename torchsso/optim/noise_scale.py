@@ -0,0 +1,177 @@
+import math
+import time
+
+from torchsso.autograd import save_sample_grads
+from torchsso.optim.secondorder import SecondOrderOptimizer
+from torchsso.utils.timing import TimedClosure, synchronize
+
+
+class NoiseScaleTuner(object):
+    r"""Tunes acc_steps (and recommends the batch size) by the gradient noise scale estimated online.
+
+    The simple noise scale B_noise = tr(Sigma) / |G|^2 (https://arxiv.org/abs/1812.06162) is estimated
+        from the per-sample gradients (torchsso.autograd.save_sample_grads) of each step, where
+        tr(Sigma) and |G|^2 are the (unbiased) trace of the covariance and squared norm of the mean of them.
+    With the measured time of the passes (t0 + c * batch_size for a micro-batch) and of the update
+        of the optimizer (u), the effective batch size which maximizes the training progress per second,
+        (B / (B + B_noise)) / (time per update), is sqrt(B_noise * (t0 + u) / c) when the batch size
+        is changed, or sqrt(B_noise * u * b / (t0 + c * b)) when acc_steps is changed for a batch size b.
+    The noise scale of each param is stored as p.noise_scale.
+
+    Args:
+        optimizer (torchsso.optim.SecondOrderOptimizer): optimizer (whose model consists of the layers
+            supported by save_sample_grads) to be tuned
+        ema_decay (float, optional): decay rate for EMA of the statistics
+        apply (bool, optional): whether the recommended acc_steps is applied to the optimizer
+            (at the boundary of the accumulation) or only recommended
+        min_acc_steps (int, optional): lower bound of acc_steps
+        max_acc_steps (int, optional): upper bound of acc_steps
+        logger (torchsso.utils.Logger, optional): logger to which every change of acc_steps is written
+
+    Example:
+        >>> tuner = NoiseScaleTuner(optimizer, apply=True)
+        >>> loss, prob, network_loss = tuner.step(closure)
+        >>> tuner.noise_scale, tuner.recommended_batch_size()
+    """
+
+    def __init__(self, optimizer: SecondOrderOptimizer, ema_decay=0.1, apply=False,
+                 min_acc_steps=1, max_acc_steps=64, logger=None):
+        if ema_decay <= 0 or 1 < ema_decay:
+            raise ValueError("Invalid ema_decay: {}".format(ema_decay))
+        if min_acc_steps < 1:
+            raise ValueError("Invalid min_acc_steps: {}".format(min_acc_steps))
+        if max_acc_steps < min_acc_steps:
+            raise ValueError("Invalid max_acc_steps: {}".format(max_acc_steps))
+
+        self.optimizer = optimizer
+        self.ema_decay = ema_decay
+        self.apply = apply
+        self.min_acc_steps = min_acc_steps
+        self.max_acc_steps = max_acc_steps
+        self.logger = logger
+
+        self.trace = None
+        self.sq_norm = None
+        self.batch_size = None
+        self.update_time = None
+        # EMA of the moments of (batch size, time of the passes) for the fit of t0 + c * batch_size
+        self._time_moments = None
+        self.adjustments = []
+
+    def _ema(self, old, new):
+        if old is None:
+            return new
+        return self.ema_decay * new + (1 - self.ema_decay) * old
+
+    def step(self, closure=None):
+        timed_closure = TimedClosure(closure) if closure is not None else None
+
+        synchronize()
+        start = time.perf_counter()
+        with save_sample_grads(self.optimizer.model):
+            ret = self.optimizer.step(timed_closure)
+        synchronize()
+        step_time = time.perf_counter() - start
+
+        batch_size = self.update_noise_scale()
+        if batch_size is not None and timed_closure is not None:
+            self.update_time_model(batch_size, timed_closure.time, step_time - timed_closure.time)
+            if self.apply:
+                self.apply_acc_steps()
+
+        return ret
+
+    def update_noise_scale(self):
+        """Updates the statistics with the per-sample gradients (p.grads) and returns the batch size."""
+        trace, sq_norm = 0., 0.
+        batch_size = None
+        for group in self.optimizer.param_groups:
+            for p in group['params']:
+                grads = getattr(p, 'grads', None)
+                if grads is None or grads.shape[0] < 2:
+                    continue
+                batch_size = grads.shape[0]
+                grads = grads.reshape(batch_size, -1)
+                p_trace = grads.var(dim=0).sum().item()
+                p_sq_norm = grads.mean(dim=0).pow(2).sum().item() - p_trace / batch_size
+                p.noise_scale = p_trace / p_sq_norm if p_sq_norm > 0 else math.inf
+                trace += p_trace
+                sq_norm += p_sq_norm
+
+        if batch_size is None:
+            return None
+
+        self.trace = self._ema(self.trace, trace)
+        self.sq_norm = self._ema(self.sq_norm, sq_norm)
+        self.batch_size = batch_size
+
+        return batch_size
+
+    def update_time_model(self, batch_size, pass_time, update_time):
+        if self.optimizer.optim_state['acc_step'] == 0:
+            # the params have been updated in this step
+            self.update_time = self._ema(self.update_time, max(update_time, 0.))
+
+        moments = [batch_size, pass_time, batch_size ** 2, batch_size * pass_time]
+        if self._time_moments is None:
+            self._time_moments = moments
+        else:
+            self._time_moments = [self._ema(old, new) for old, new in zip(self._time_moments, moments)]
+
+    @property
+    def noise_scale(self):
+        if self.sq_norm is None:
+            return None
+        return self.trace / self.sq_norm if self.sq_norm > 0 else math.inf
+
+    def pass_time_model(self):
+        """Returns (t0, c) of the time of the passes for a micro-batch, t0 + c * batch_size."""
+        if self._time_moments is None:
+            return None
+        b, t, bb, bt = self._time_moments
+        var = bb - b ** 2
+        if var > 1e-8 * bb:
+            c = (bt - b * t) / var
+            if c > 0:
+                return max(t - c * b, 0.), c
+        # the batch size has not varied
+        return 0., t / b
+
+    def recommended_batch_size(self):
+        noise_scale, time_model = self.noise_scale, self.pass_time_model()
+        if noise_scale is None or time_model is None or self.update_time is None:
+            return None
+        if math.isinf(noise_scale):
+            return self.batch_size * self.max_acc_steps
+        t0, c = time_model
+        return max(1, int(round(math.sqrt(noise_scale * (t0 + self.update_time) / c))))
+
+    def recommended_acc_steps(self, batch_size=None):
+        noise_scale, time_model = self.noise_scale, self.pass_time_model()
+        if noise_scale is None or time_model is None or self.update_time is None:
+            return None
+        if batch_size is None:
+            batch_size = self.batch_size
+        if math.isinf(noise_scale):
+            return self.max_acc_steps
+        t0, c = time_model
+        effective_batch_size = math.sqrt(noise_scale * self.update_time * batch_size / (t0 + c * batch_size))
+        acc_steps = int(round(effective_batch_size / batch_size))
+        return min(max(acc_steps, self.min_acc_steps), self.max_acc_steps)
+
+    def apply_acc_steps(self):
+        optimizer = self.optimizer
+        if optimizer.optim_state['acc_step'] != 0:
+            # wait for the boundary of the accumulation
+            return
+        acc_steps = self.recommended_acc_steps()
+        old = optimizer.defaults['acc_steps']
+        if acc_steps is None or acc_steps == old:
+            return
+
+        optimizer.defaults['acc_steps'] = acc_steps
+        log = {'step': optimizer.optim_state['step'], 'acc_steps': acc_steps, 'old_acc_steps': old,
+               'noise_scale': self.noise_scale, 'batch_size': self.batch_size}
+        self.adjustments.append(log)
+        if self.logger is not None:
+            self.logger.write(log)
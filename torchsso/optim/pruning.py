@@ -0,0 +1,194 @@
+import torch
+import torch.nn as nn
+from torch.fx import symbolic_trace
+from torchsso.optim.vi import VIOptimizer
+
+# ops between two layers which keep the units (features/channels) as they are
+_PASS_THROUGH_MODULES = (nn.ReLU, nn.Dropout, nn.MaxPool2d, nn.AvgPool2d, nn.Flatten)
+_PASS_THROUGH_FUNCTIONS = ('relu', 'dropout', 'max_pool2d', '_max_pool2d', 'avg_pool2d', 'flatten')
+_PASS_THROUGH_METHODS = ('relu', 'view', 'reshape', 'flatten')
+_IGNORED_METHODS = ('size', 'dim')
+
+
+def _next_layer(node, modules):
+    # follows the (only) consumer of the node until the next Linear/Conv2d layer
+    while True:
+        users = [u for u in node.users
+                 if not (u.op == 'call_method' and u.target in _IGNORED_METHODS)]
+        if len(users) != 1:
+            return None
+        user = users[0]
+        if len(user.args) == 0 or user.args[0] is not node:
+            return None
+
+        if user.op == 'call_module':
+            module = modules[user.target]
+            if isinstance(module, (nn.Linear, nn.Conv2d)):
+                return module
+            if not isinstance(module, _PASS_THROUGH_MODULES):
+                return None
+        elif user.op == 'call_function':
+            if getattr(user.target, '__name__', None) not in _PASS_THROUGH_FUNCTIONS:
+                return None
+        elif user.op == 'call_method':
+            if user.target not in _PASS_THROUGH_METHODS:
+                return None
+        else:
+            return None
+
+        node = user
+
+
+def find_prunable_layers(model: nn.Module):
+    r"""Returns pairs of (layer, next layer) whose units (output features/channels) can be pruned.
+
+    A pair is found when the output of a Linear/Conv2d layer is consumed only by the next
+        Linear/Conv2d layer through element-wise, pooling or flattening ops.
+    """
+    graph_module = symbolic_trace(model)
+    modules = dict(graph_module.named_modules())
+
+    pairs = []
+    for node in graph_module.graph.nodes:
+        if node.op != 'call_module':
+            continue
+        module = modules[node.target]
+        if not isinstance(module, (nn.Linear, nn.Conv2d)):
+            continue
+        next_module = _next_layer(node, modules)
+        if next_module is None:
+            continue
+        if isinstance(module, nn.Linear) and not isinstance(next_module, nn.Linear):
+            continue
+        if any(isinstance(m, nn.Conv2d) and m.groups != 1 for m in [module, next_module]):
+            continue
+        pairs.append((node.target, module, next_module))
+
+    return pairs
+
+
+def unit_snr(moments):
+    r"""Signal-to-noise ratio (norm of the mean / norm of the std) of each output unit of a layer.
+
+    Args:
+        moments (list): Moments of the params (weight and bias) of the layer
+    """
+    mean_sq, var = 0, 0
+    for m in moments:
+        mean_sq = mean_sq + m.mean.reshape(m.mean.shape[0], -1).pow(2).sum(dim=1)
+        var = var + m.var.reshape(m.var.shape[0], -1).sum(dim=1)
+
+    return mean_sq.sqrt() / var.clamp(min=1e-30).sqrt()
+
+
+def _slice_param(optimizer, group, index, dim, keep):
+    module = group['curv'].module
+    p = group['params'][index]
+    name = [n for n, q in module.named_parameters() if q is p][0]
+
+    new_p = nn.Parameter(p.data.index_select(dim, keep), requires_grad=p.requires_grad)
+    setattr(module, name, new_p)
+    group['params'][index] = new_p
+
+    for m in group['mean'][index]:
+        optimizer.state.pop(m, None)
+    for key in ['mean', 'prec', 'cov', 'pais']:
+        group[key][index] = [t.index_select(dim, keep) for t in group[key][index]]
+    for key in ['prior_mean', 'prior_prec']:
+        if group[key] is not None:
+            group[key][index] = group[key][index].index_select(dim, keep)
+    optimizer.init_buffer([group['mean'][index]])
+
+
+def _reset_curvature(group):
+    curv = group['curv']
+    curv.ema = curv.ema_max = curv.inv = curv.std = None
+    curv._data = None
+    if hasattr(curv, '_A'):
+        curv._A = curv._G = None
+    for key in ['acc_delta', 'acc_grads', 'acc_curv']:
+        group[key].clear()
+
+
+def prune_posterior(optimizer: VIOptimizer, ratio=None, threshold=None):
+    r"""Prunes the units with low posterior signal-to-noise ratio from the model (in place).
+
+    The output features (channels) of each prunable Linear (Conv2d) layer are ranked by unit_snr()
+        of the (mixture) posterior, and the pruned units are removed from the layer and from
+        the input of the next layer together with their posterior (mean, precision and mixture weights).
+    The optimizer keeps managing the (physically smaller) model, so that step() and prediction()
+        work as before with less FLOPs per MC sample.
+
+    Args:
+        optimizer (torchsso.optim.VIOptimizer): optimizer which manages the posterior
+        ratio (float, optional): ratio of the units to be pruned in each layer
+        threshold (float, optional): units whose SNR is below this value are pruned
+            (at least one unit is kept in each layer)
+
+    Returns:
+        dict: name of the layer -> indices of the kept units
+    """
+    if (ratio is None) == (threshold is None):
+        raise ValueError("Either ratio or threshold has to be specified.")
+    if ratio is not None and (ratio < 0 or 1 <= ratio):
+        raise ValueError("Invalid ratio: {}".format(ratio))
+
+    groups = {group['curv'].module: group for group in optimizer.param_groups}
+    kept = {}
+
+    for name, module, next_module in find_prunable_layers(optimizer.model):
+        if module not in groups or next_module not in groups:
+            continue
+
+        # recomputed since the inputs of the layer may have been pruned
+        snr = unit_snr(optimizer.posterior_moments()[module])
+        num_units = len(snr)
+        if ratio is not None:
+            num_keep = num_units - int(ratio * num_units)
+        else:
+            num_keep = max(int((snr >= threshold).sum().item()), 1)
+        if num_keep == num_units:
+            continue
+
+        keep = torch.sort(torch.topk(snr, num_keep)[1])[0]
+
+        # output units of the layer
+        group = groups[module]
+        for i in range(len(group['params'])):
+            _slice_param(optimizer, group, i, 0, keep)
+        if isinstance(module, nn.Linear):
+            module.out_features = num_keep
+        else:
+            module.out_channels = num_keep
+
+        # input units of the next layer
+        next_group = groups[next_module]
+        weight = next_module.weight
+        if isinstance(next_module, nn.Linear) and isinstance(module, nn.Conv2d):
+            # channels are flattened into (channel)(h)(w) features
+            spatial = weight.shape[1] // num_units
+            index = (keep.view(-1, 1) * spatial + torch.arange(spatial, device=keep.device)).view(-1)
+        else:
+            index = keep
+        _slice_param(optimizer, next_group, 0, 1, index)
+        if isinstance(next_module, nn.Linear):
+            next_module.in_features = next_module.weight.shape[1]
+        else:
+            next_module.in_channels = num_keep
+
+        _reset_curvature(group)
+        _reset_curvature(next_group)
+        optimizer.update_frozen(group)
+        optimizer.update_frozen(next_group)
+        kept[name] = keep
+
+    optimizer._traced_model = None
+    if optimizer.recycle_buffer is not None:
+        optimizer.recycle_buffer.clear()
+    if optimizer.prefix_cached_forward is not None:
+        optimizer.prefix_cached_forward.clear()
+    if optimizer.prediction_cache is not None:
+        optimizer.prediction_cache.clear()
+    optimizer.bump_posterior_version()
+
+    return kept
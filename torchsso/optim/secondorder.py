@@ -7,11 +7,46 @@ import torch
 import torch.nn as nn
 from torch.optim import Optimizer
 import torchsso
+from torchsso.curv.curvature import _clone, _to_device
 from torchsso.utils import TensorAccumulator
 from torchsso.utils.chainer_communicators import create_communicator
 from torchsso.utils.chainer_communicators import _utility
 
 
+STATE_DICT_VERSION = 1
+
+
+class _LazyParamGroup(dict):
+    # param group whose state is loaded on the first access to any key other than 'params'
+
+    def __init__(self, group, loader):
+        super(_LazyParamGroup, self).__init__(group)
+        self._loader = loader
+
+    def _materialize(self):
+        loader, self._loader = self._loader, None
+        if loader is not None:
+            loader()
+
+    def __getitem__(self, key):
+        if key != 'params':
+            self._materialize()
+        return super(_LazyParamGroup, self).__getitem__(key)
+
+    def get(self, key, default=None):
+        if key != 'params':
+            self._materialize()
+        return super(_LazyParamGroup, self).get(key, default)
+
+    def items(self):
+        self._materialize()
+        return super(_LazyParamGroup, self).items()
+
+    def values(self):
+        self._materialize()
+        return super(_LazyParamGroup, self).values()
+
+
 class SecondOrderOptimizer(Optimizer):
     r"""An optimizer for Second-Order Optimization.
 
@@ -19,6 +54,8 @@ class SecondOrderOptimizer(Optimizer):
         of torchsso.Curvature instance.
     This optimizer updates the params with the gradients pre-conditioned
         by the inverse of the curvature for each layer.
+    The step of this optimizer (the accumulation by TensorAccumulator and Curvature.precondition_grad())
+        is not compiled by torch.compile; only the GMM kernels of VIOptimizer are (see its compile_step).
 
     Args:
         model (torch.nn.Module): model with parameters to be trained
@@ -47,6 +84,10 @@ class SecondOrderOptimizer(Optimizer):
         update_inv (bool, optional): whether to update curvature inverses at each step
         precondition_grad (bool, optional): whether to apply preconditioning
             (if False, this optimizer works as SGD)
+        target_modules (list, optional): names of the layers (or of their parents)
+            managed by this optimizer (all the layers are managed if None)
+        curv_interval (int, optional): interval (steps) of computing and updating the curvature
+        inv_interval (int, optional): interval (steps) of refreshing the inverse of the curvature
 
     Example:
         >>> curv_shapes = {"Conv2d": "Kron", "Linear": "Diag"}
@@ -63,12 +104,19 @@ class SecondOrderOptimizer(Optimizer):
         >>> optimizer.step(closure=closure)
     """
 
+    # keys of a param group which are not saved (kept as constructed), or saved as accumulations
+    _skipped_group_keys = ('params', 'curv')
+    _accumulator_group_keys = ('acc_curv', 'acc_grads')
+    # defaults which are specific to the process (not overwritten by load_state_dict)
+    _preserved_defaults = ()
+
     def __init__(self, model: nn.Module, curv_type: str, curv_shapes: dict, curv_kwargs: dict,
                  lr=0.01, momentum=0., momentum_type='preconditioned',
                  grad_ema_decay=1., grad_ema_type='raw', l2_reg=0., weight_decay=0.,
                  normalizing_weights=False, weight_scale=None,
                  acc_steps=1, non_reg_for_bn=False, bias_correction=False,
-                 lars=False, lars_type='preconditioned', update_inv=True, precondition_grad=True):
+                 lars=False, lars_type='preconditioned', update_inv=True, precondition_grad=True,
+                 target_modules=None, curv_interval=1, inv_interval=1):
 
         if lr < 0:
             raise ValueError("Invalid learning rate: {}".format(lr))
@@ -86,6 +134,10 @@ class SecondOrderOptimizer(Optimizer):
             raise ValueError("Invalid weight_decay value: {}".format(weight_decay))
         if acc_steps < 1:
             raise ValueError("Invalid acc_steps: {}".format(acc_steps))
+        if curv_interval < 1:
+            raise ValueError("Invalid curv_interval: {}".format(curv_interval))
+        if inv_interval < 1:
+            raise ValueError("Invalid inv_interval: {}".format(inv_interval))
         if lars and lars_type not in ['raw', 'preconditioned']:
             raise ValueError("Invalid LARS type: {}".format(lars_type))
         if normalizing_weights and weight_scale is not None and weight_scale <= 0:
@@ -97,7 +149,8 @@ class SecondOrderOptimizer(Optimizer):
                     'l2_reg': l2_reg, 'weight_decay': weight_decay,
                     'normalizing_weights': normalizing_weights, 'weight_scale': weight_scale,
                     'acc_steps': acc_steps, 'bias_correction': bias_correction,
-                    'lars': lars, 'lars_type': lars_type}
+                    'lars': lars, 'lars_type': lars_type,
+                    'curv_interval': curv_interval, 'inv_interval': inv_interval}
         defaults.update(curv_kwargs)
         self.defaults = defaults
         self.state = defaultdict(dict)
@@ -109,9 +162,12 @@ class SecondOrderOptimizer(Optimizer):
         self.update_inv = update_inv
         self.precondition_grad = precondition_grad
 
-        for module in model.modules():
+        for name, module in model.named_modules():
             if len(list(module.children())) > 0:
                 continue
+            if target_modules is not None and \
+                    not any(name == t or name.startswith(t + '.') for t in target_modules):
+                continue
             params = list(module.parameters())
             if len(params) == 0:
                 continue
@@ -141,10 +197,150 @@ class SecondOrderOptimizer(Optimizer):
             state['momentum_buffer'] = torch.zeros_like(p.data)
             state['grad_ema_buffer'] = torch.zeros_like(p.data)
 
+    def _group_state_keys(self, group):
+        # tensors which key self.state (in a fixed order)
+        return group['params']
+
+    def _state_keys(self):
+        return [p for group in self.param_groups for p in self._group_state_keys(group)]
+
+    def state_dict(self, include_inverses=True, copy_tensors=True):
+        r"""Returns the (versioned) state of the optimizer for a warm resume.
+
+        The state includes the hyperparameters and the accumulations of each param group, the buffers
+            (momentum, etc.) of the params, and the state of the curvatures (data, EMA and inverse).
+
+        Args:
+            include_inverses (bool, optional): whether the inverses (and std) of the curvatures are included
+                (otherwise they are recomputed from the EMA when they are first used after loading)
+            copy_tensors (bool, optional): whether the tensors are copied (otherwise the state refers to
+                the tensors of the optimizer, which must not be modified until the state is consumed)
+        """
+        copy = _clone if copy_tensors else (lambda value: value)
+        groups = []
+        for group in self.param_groups:
+            group_state = {}
+            for key, value in group.items():
+                if key in self._skipped_group_keys:
+                    continue
+                if key in self._accumulator_group_keys:
+                    value = value._accumulation
+                group_state[key] = copy(value)
+            curv = group['curv']
+            group_state['curv'] = None if curv is None else curv.state_dict(include_inverses, copy_tensors)
+            groups.append(group_state)
+
+        state = [{key: copy(value) for key, value in self.state[p].items()} for p in self._state_keys()]
+
+        return {'version': STATE_DICT_VERSION,
+                'defaults': copy(self.defaults),
+                'optim_state': dict(self.optim_state),
+                'param_groups': groups,
+                'state': state}
+
+    def load_state_dict(self, state_dict):
+        r"""Loads the state returned by state_dict() into the optimizer (constructed for the same model).
+
+        Args:
+            state_dict (dict): optimizer state
+        """
+        if len(state_dict['param_groups']) != len(self.param_groups):
+            raise ValueError("Invalid number of param groups: {}".format(len(state_dict['param_groups'])))
+        if len(state_dict['state']) != len(self._state_keys()):
+            raise ValueError("Invalid number of param states: {}".format(len(state_dict['state'])))
+        self._load_meta_state(state_dict)
+
+        self.state = defaultdict(dict)
+        offset = 0
+        for i, group_state in enumerate(state_dict['param_groups']):
+            num_states = len(self._group_state_keys(self.param_groups[i]))
+            self.load_group_state(i, group_state, state_dict['state'][offset:offset + num_states])
+            offset += num_states
+
+    def _load_meta_state(self, state_dict):
+        # the state other than that of the param groups
+        version = state_dict.get('version', None)
+        if version is None or version > STATE_DICT_VERSION:
+            raise ValueError("Invalid state_dict version: {}".format(version))
+
+        self.defaults.update({key: value for key, value in state_dict['defaults'].items()
+                              if key not in self._preserved_defaults})
+        self.optim_state.update(state_dict['optim_state'])
+
+    def load_group_state(self, index, group_state, param_states):
+        r"""Loads the state of a param group (and of its params) returned by state_dict().
+
+        Args:
+            index (int): index of the param group
+            group_state (dict): state_dict()['param_groups'][index]
+            param_states (list): the states of state_dict()['state'] for the params of the group
+        """
+        group = self.param_groups[index]
+        device = group['params'][0].device
+        for key, value in group_state.items():
+            if key == 'curv':
+                continue
+            value = _to_device(value, device)
+            if key in self._accumulator_group_keys:
+                group[key]._accumulation = value
+            else:
+                group[key] = value
+        if group['curv'] is not None and group_state['curv'] is not None:
+            group['curv'].load_state_dict(group_state['curv'])
+        self._load_group_postprocess(group)
+
+        keys = self._group_state_keys(group)
+        if len(param_states) != len(keys):
+            raise ValueError("Invalid number of param states: {}".format(len(param_states)))
+        for p, p_state in zip(keys, param_states):
+            self.state[p] = {key: _to_device(value, p.device) for key, value in p_state.items()}
+
+    def set_lazy_group_state(self, index, loader):
+        r"""Defers loading the state of a param group until the group is first accessed.
+
+        Args:
+            index (int): index of the param group
+            loader (callable): function which loads the state of the group (e.g., by load_group_state)
+        """
+        self.param_groups[index] = _LazyParamGroup(self.param_groups[index], loader)
+
+    def _load_group_postprocess(self, group):
+        pass
+
     @property
     def local_param_groups(self):
         return self.param_groups
 
+    def is_curv_step(self):
+        return self.optim_state['step'] % self.defaults['curv_interval'] == 0
+
+    def is_inv_step(self):
+        return self.optim_state['step'] % self.defaults['inv_interval'] == 0
+
+    def is_boundary(self, name):
+        """Returns whether a new value of the hyperparameter can be applied now without splitting its window.
+
+        The window is the accumulation (of acc_steps steps with num_mc_samples samples) for all of them,
+            and also the interval itself for curv_interval and inv_interval.
+        """
+        if self.optim_state['acc_step'] != 0:
+            return False
+        if name in ['curv_interval', 'inv_interval']:
+            return self.optim_state['step'] % self.defaults[name] == 0
+        return True
+
+    def enable_curvature_update(self, enabled=None):
+        """Sets whether the curvature is computed in the forward/backward of the layers.
+
+        By default, it is computed only for the steps in which the curvature is updated.
+        """
+        if enabled is None:
+            enabled = self.is_curv_step()
+        for group in self.param_groups:
+            curv = group['curv']
+            if curv is not None:
+                curv.update_enabled = enabled
+
     def get_curv_class(self, module):
         module_name = module.__class__.__name__
         curv_shape = self.curv_shapes.get(module_name, '')
@@ -166,6 +362,9 @@ class SecondOrderOptimizer(Optimizer):
         n = self.defaults['acc_steps']
         loss = None
 
+        is_curv_step, is_inv_step = self.is_curv_step(), self.is_inv_step() and self.update_inv
+        self.enable_curvature_update(is_curv_step)
+
         if closure is not None:
             # forward and backward
             loss = closure()
@@ -199,7 +398,13 @@ class SecondOrderOptimizer(Optimizer):
             # update curvature
             params, curv = group['params'], group['curv']
             if curv is not None:
-                curv.step(update_inv=self.update_inv)
+                if is_curv_step:
+                    curv.step(update_inv=is_inv_step)
+                elif is_inv_step:
+                    # only if the EMA has been updated since the last inversion
+                    curv.refresh_inv()
+                if self.update_inv:
+                    curv.ensure_inv()
                 if self.precondition_grad:
                     curv.precondition_grad(params)
 
@@ -208,6 +413,8 @@ class SecondOrderOptimizer(Optimizer):
             self.update(group)
             self.update_postprocess(group)
 
+        self.enable_curvature_update()
+
         return loss
 
     def backward_postprocess(self, target='params'):
@@ -367,6 +574,22 @@ class DistributedSecondOrderOptimizer(SecondOrderOptimizer):
         extractors = [_utility.extract_attr_from_params('data')]
         return extractors
 
+    def state_dict(self, include_inverses=True, copy_tensors=True):
+        # the curvatures are updated only for the local param groups, so that each process saves its own state
+        state_dict = self.actual_optimizer.state_dict(self, include_inverses, copy_tensors)
+        state_dict['local_indices'] = self.local_indices
+        return state_dict
+
+    def _load_meta_state(self, state_dict):
+        local_indices = state_dict.get('local_indices', None)
+        if local_indices is not None and local_indices != self.local_indices:
+            raise ValueError("Invalid local indices: {}".format(local_indices))
+        self.actual_optimizer._load_meta_state(self, state_dict)
+
+    def set_lazy_group_state(self, index, loader):
+        self.actual_optimizer.set_lazy_group_state(self, index, loader)
+        self._local_param_groups = [self.param_groups[i] for i in self.local_indices]
+
     def backward_postprocess(self, target='params'):
         self.actual_optimizer.backward_postprocess(self, target)
         # reduce_scatter_v
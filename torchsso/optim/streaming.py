@@ -0,0 +1,77 @@
+import torch.nn.functional as F
+from torchsso.optim.vi import VIOptimizer
+
+
+class StreamingVI(object):
+    r"""partial_fit-style training of VIOptimizer on a data stream with bounded memory.
+
+    The effective dataset size is maintained with exponential forgetting, i.e., it is updated as
+        N <- forgetting_factor * N + (batch size) for each incoming minibatch, and it rescales the prior term
+        and the std of the samples of the optimizer (see VIOptimizer.set_dataset_size).
+    Every fold_interval updates, the current posterior is folded into the prior
+        (see VIOptimizer.fold_posterior_into_prior), so that the past data is summarized by the prior
+        instead of the fixed prior_variance, and the effective dataset size is reset, i.e., it counts only
+        the data after the last fold (the data before it would be counted twice otherwise).
+    Nothing grows with the amount of seen data, so that the memory and the time per update are constant.
+
+    Args:
+        optimizer (torchsso.optim.VIOptimizer): optimizer to be trained on the stream
+        forgetting_factor (float, optional): decay of the effective dataset size per minibatch
+            (1 for no forgetting)
+        fold_interval (int, optional): interval (updates of the posterior) of folding the posterior
+            into the prior (None for never)
+        criterion (callable, optional): loss function (with mean reduction) of output and target
+
+    Example:
+        >>> stream = StreamingVI(optimizer, forgetting_factor=0.999, fold_interval=1000)
+        >>> for data, target in data_stream:
+        >>>     loss, prob, network_loss = stream.partial_fit(data, target)
+    """
+
+    def __init__(self, optimizer: VIOptimizer, forgetting_factor=1., fold_interval=None, criterion=F.cross_entropy):
+        if forgetting_factor <= 0 or 1 < forgetting_factor:
+            raise ValueError("Invalid forgetting factor: {}".format(forgetting_factor))
+        if fold_interval is not None and fold_interval < 1:
+            raise ValueError("Invalid fold interval: {}".format(fold_interval))
+
+        self.optimizer = optimizer
+        self.forgetting_factor = forgetting_factor
+        self.fold_interval = fold_interval
+        self.criterion = criterion
+
+        self.dataset_size = optimizer.defaults['dataset_size']
+        self.num_seen = 0
+        self.num_folds = 0
+
+    def partial_fit(self, data, target):
+        """Updates the posterior with a minibatch of the stream.
+
+        Returns:
+            tuple: the return values of VIOptimizer.step()
+        """
+        optimizer = self.optimizer
+        model = optimizer.model
+
+        self.dataset_size = self.forgetting_factor * self.dataset_size + len(data)
+        self.num_seen += len(data)
+        optimizer.set_dataset_size(self.dataset_size)
+
+        def closure(surrogate_loss):
+            optimizer.zero_grad()
+            output = model(data)
+            network_loss = self.criterion(output, target)
+            total_loss = network_loss - surrogate_loss
+            total_loss.backward()
+            return total_loss, output, network_loss
+
+        step = optimizer.optim_state['step']
+        ret = optimizer.step(closure)
+
+        updated = optimizer.optim_state['step'] != step
+        if updated and self.fold_interval is not None and optimizer.optim_state['step'] % self.fold_interval == 0:
+            optimizer.fold_posterior_into_prior()
+            self.num_folds += 1
+            # the folded data is in the prior (set to the optimizer with the next minibatch)
+            self.dataset_size = 0
+
+        return ret
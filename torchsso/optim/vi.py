@@ -1,12 +1,24 @@
 import math
+from collections import deque
+from contextlib import contextmanager
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.fx import symbolic_trace
+from torch.func import functional_call, grad_and_value, vmap
 from torchsso.optim import SecondOrderOptimizer, DistributedSecondOrderOptimizer
-from torchsso.utils import TensorAccumulator, MixtureAccumulator
+from torchsso.utils import TensorAccumulator, MixtureAccumulator, HealthMonitor
+from torchsso.utils.moment_propagation import Moments, propagate_moments, probit_approximation
+from torchsso.utils.posterior_predictive import build_posterior_predictive, prediction_margin, prediction_entropy
+from torchsso.utils.predictive_cache import PredictiveCache
+from torchsso.utils.prefix_cache import PrefixCachedForward
 from torchsso.utils.chainer_communicators import _utility
 
+# purposes of the random streams of the MC samples (see VIOptimizer.mc_generator)
+TRAIN_STREAM = 0
+EVAL_STREAM = 1
+
 
 class VIOptimizer(SecondOrderOptimizer):
     r"""An optimizer for Variational Inference (VI) based on torch.optim.SecondOrderOptimizer.
@@ -45,8 +57,42 @@ class VIOptimizer(SecondOrderOptimizer):
         warmup_kl_weighting_steps (float, optional): number of steps until the value reaches the kl_weighting
         prior_variance (float, optional): variance of the prior distribution (Gaussian) of each param
         init_precision (float, optional): initial (diagonal) precision of the posterior of params
+        prediction_cache_bytes (int, optional): budget (bytes) of the cache of prediction() results
+            keyed by the input, the step and the MC settings (0 disables the cache)
+        deterministic_tol (float, optional): params whose posterior std is below deterministic_tol * |mean|
+            are treated as deterministic, i.e., they are fixed to the mean and excluded from
+            sampling and density evaluation (0 disables it)
+        stochastic_modules (list, optional): names of the layers (or of their parents) whose params
+            are inferred by VI, e.g., ['fc'] for last-layer VI (all the layers if None).
+            The other layers are kept deterministic (as they are), and the part of the forward
+            which does not depend on the stochastic layers is evaluated only once for the same input
+            (e.g., for all the MC samples of a step), see torchsso.utils.PrefixCachedForward
+        recycle_buffer_size (int, optional): number of recent MC samples (with their gradients and
+            curvatures) which are kept to be recycled in the following steps (0 disables recycling)
+        recycle_ess_threshold (float, optional): the buffered samples, importance-weighted by the ratio
+            of the current posterior density to the one they were drawn from, are recycled
+            (and only one fresh sample is evaluated) while their effective sample size (weighted and
+            evaluated for each layer) is at least recycle_ess_threshold * (number of buffered samples)
+        control_variates (bool, optional): whether the entropy and prior terms of the surrogate loss
+            are replaced by their (closed-form) expectations under the posterior, i.e., their
+            zero-mean MC noise is removed from the gradients (see control_variate_stats).
+            The gradient of the folded prior (see fold_posterior_into_prior) is kept.
+        linearized_baseline (bool, optional): whether the linearization of the loss gradient around
+            the posterior mean (with the curvature of the previous step) is subtracted from the gradients
+            of each MC sample as a zero-mean control variate
+        curv_interval (int, optional): interval (steps) of computing the curvature and updating
+            the precision of the posterior
+        compile_step (bool, optional): whether the sampling, density and update phases of the GMM
+            (written as tensor programs without graph breaks) are compiled by torch.compile(fullgraph=True);
+            the accumulation and preconditioning inherited from SecondOrderOptimizer are not compiled
+        monitor_health (bool, optional): whether NaN/Inf counts and min/max of the loss, gradients and
+            posterior are accumulated on the device (see health_monitor, flushed by health_monitor.flush())
     """
 
+    _skipped_group_keys = SecondOrderOptimizer._skipped_group_keys + ('cov', 'frozen', 'q_entropy')
+    _accumulator_group_keys = SecondOrderOptimizer._accumulator_group_keys + ('acc_delta',)
+    _preserved_defaults = ('mc_group_id',)
+
     def __init__(self, model: nn.Module, dataset_size: float, curv_type: str, curv_shapes: dict, curv_kwargs: dict,
                  num_gmm_components=1,
                  lr=0.01, momentum=0., momentum_type='preconditioned',
@@ -57,7 +103,10 @@ class VIOptimizer(SecondOrderOptimizer):
                  num_mc_samples=10, val_num_mc_samples=10,
                  kl_weighting=1, warmup_kl_weighting_init=0.01, warmup_kl_weighting_steps=None,
                  prior_variance=1, init_precision=None,
-                 seed=1, total_steps=1000):
+                 seed=1, total_steps=1000, prediction_cache_bytes=0, deterministic_tol=0.,
+                 stochastic_modules=None, recycle_buffer_size=0, recycle_ess_threshold=0.5,
+                 control_variates=False, linearized_baseline=False, curv_interval=1, compile_step=False,
+                 monitor_health=False):
 
         if dataset_size < 0:
             raise ValueError("Invalid dataset size: {}".format(dataset_size))
@@ -73,6 +122,19 @@ class VIOptimizer(SecondOrderOptimizer):
             raise ValueError("Invalid prior variance: {}".format(prior_variance))
         if init_precision is not None and init_precision < 0:
             raise ValueError("Invalid initial precision: {}".format(init_precision))
+        if prediction_cache_bytes < 0:
+            raise ValueError("Invalid prediction cache size: {}".format(prediction_cache_bytes))
+        if deterministic_tol < 0:
+            raise ValueError("Invalid deterministic tolerance: {}".format(deterministic_tol))
+        if recycle_buffer_size < 0:
+            raise ValueError("Invalid recycle buffer size: {}".format(recycle_buffer_size))
+        if not 0 <= recycle_ess_threshold <= 1:
+            raise ValueError("Invalid recycle ESS threshold: {}".format(recycle_ess_threshold))
+        if stochastic_modules is not None:
+            names = [name for name, _ in model.named_modules()]
+            for t in stochastic_modules:
+                if t not in names:
+                    raise ValueError("Invalid stochastic module: {}".format(t))
 
         init_kl_weighting = kl_weighting if warmup_kl_weighting_steps is None else warmup_kl_weighting_init
         l2_reg = init_kl_weighting / dataset_size / prior_variance if prior_variance != 0 else 0
@@ -85,10 +147,32 @@ class VIOptimizer(SecondOrderOptimizer):
                                           normalizing_weights=normalizing_weights, weight_scale=weight_scale,
                                           acc_steps=acc_steps, non_reg_for_bn=non_reg_for_bn,
                                           bias_correction=bias_correction,
-                                          lars=lars, lars_type=lars_type)
+                                          lars=lars, lars_type=lars_type,
+                                          target_modules=stochastic_modules, curv_interval=curv_interval)
 
         self.num_gmm_components = num_gmm_components
+        self._traced_model = None
+        self.prediction_cache = PredictiveCache(prediction_cache_bytes) if prediction_cache_bytes > 0 else None
+        # bumped by every change of the posterior (the key of the cached predictions)
+        self.posterior_version = 0
+        self.prefix_cached_forward = None
+        if stochastic_modules is not None:
+            # used as the forward of the model only while the MC samples are evaluated (see step and prediction)
+            self.prefix_cached_forward = PrefixCachedForward(model, stochastic_modules)
+        self.recycle_buffer = deque(maxlen=recycle_buffer_size) if recycle_buffer_size > 0 else None
+        self.recycle_stats = {'ess': 0., 'num_fresh': 0, 'num_recycled': 0}
+        self.control_variate_stats = {'grad_var': 0., 'grad_var_cv': 0., 'variance_reduction': 0.}
+        self.health_monitor = HealthMonitor(enabled=monitor_health)
+        self._kernels = {'sample': gmm_transform_noise, 'deltas': gmm_deltas, 'prec': gmm_prec_update,
+                         'mean': gmm_mean_update, 'pais': gmm_pais_update}
+        if compile_step:
+            # the shapes of the params vary, so that one graph is compiled for all of them
+            # (the noise is drawn outside the graphs by the per-layer generators)
+            self._kernels = {name: torch.compile(kernel, fullgraph=True, dynamic=True)
+                             for name, kernel in self._kernels.items()}
         self.defaults['std_scale'] = std_scale
+        self.defaults['dataset_size'] = dataset_size
+        self.defaults['prior_variance'] = prior_variance
         self.defaults['num_gmm_components'] = num_gmm_components
         self.defaults['kl_weighting'] = kl_weighting
         self.defaults['warmup_kl_weighting_init'] = warmup_kl_weighting_init
@@ -97,9 +181,17 @@ class VIOptimizer(SecondOrderOptimizer):
         self.defaults['val_num_mc_samples'] = val_num_mc_samples
         self.defaults['total_steps'] = total_steps
         self.defaults['seed_base'] = seed
+        self.defaults['mc_group_id'] = 0
+        self.defaults['deterministic_tol'] = deterministic_tol
+        self.defaults['recycle_ess_threshold'] = recycle_ess_threshold
+        self.defaults['control_variates'] = control_variates
+        self.defaults['linearized_baseline'] = linearized_baseline
 
         for group in self.param_groups:
             group['std_scale'] = 0 if group['l2_reg'] == 0 else std_scale
+            # zero-mean Gaussian prior with prior_variance until the posterior is folded into it
+            group['prior_mean'] = None
+            group['prior_prec'] = None
             # group['mean'] = [[torch.ones_like(p)*0.3 for _ in range(num_gmm_components)] for p in group['params']]
             group['mean'] = [[p.data.detach().clone()+i*.1 for i in range(num_gmm_components)] for p in group['params']]
 
@@ -110,6 +202,7 @@ class VIOptimizer(SecondOrderOptimizer):
             self.update_cov(group)
             group['pais'] = [[torch.ones_like(p)/num_gmm_components for _ in range(num_gmm_components)]
                              for p in group['params']]
+            self.update_frozen(group)
 
             self.init_buffer(group['mean'])
             group['acc_delta'] = MixtureAccumulator(num_gmm_components)
@@ -128,6 +221,27 @@ class VIOptimizer(SecondOrderOptimizer):
                 state['momentum_buffer'] = torch.zeros_like(p.data)
                 state['grad_ema_buffer'] = torch.zeros_like(p.data)
 
+    def _group_state_keys(self, group):
+        # the buffers are kept for the mean of each component
+        return [m for m_list in group['mean'] for m in m_list]
+
+    def _load_group_postprocess(self, group):
+        # the GMM (mean, prec, pais) is loaded, and the covariance and the deterministic params are derived from it
+        self.update_cov(group)
+        self.update_frozen(group)
+
+    def load_group_state(self, index, group_state, param_states):
+        super(VIOptimizer, self).load_group_state(index, group_state, param_states)
+        # the samples and predictions of the previous posterior are discarded
+        if self.recycle_buffer is not None:
+            self.recycle_buffer.clear()
+        if self.prediction_cache is not None:
+            self.prediction_cache.clear()
+        self.bump_posterior_version()
+        group = self.param_groups[index]
+        for p, m_list in zip(group['params'], group['mean']):
+            p.data.copy_(m_list[0].data)
+
     def zero_grad(self):
         r"""Clears the gradients of all optimized :class:`torch.Tenfsor` s."""
         for group in self.param_groups:
@@ -139,19 +253,75 @@ class VIOptimizer(SecondOrderOptimizer):
 
         super(VIOptimizer, self).zero_grad()
 
-    def calculate_deltas(self, means, covs, pais, params):
+    def calculate_deltas(self, means, covs, pais, params, frozen=None):
         num_gmm_components = len(means[0])
+        if frozen is None:
+            frozen = [None] * len(params)
         deltas = []
-        for p, mean_list, cov_list, pai_list in zip(params, means, covs, pais):
+        for p, mean_list, cov_list, pai_list, fr in zip(params, means, covs, pais, frozen):
             p_value = p.data.detach()
-            down = gmm(p_value, mean_list, cov_list, pai_list)
-            value = [gaussian(p_value, mean_list[i], cov_list[i])/down for i in range(num_gmm_components)]
-            if torch.isnan(torch.sum(torch.stack(value))):
-                print("inside calculate_deltas")
+            if fr is not None:
+                # deterministic elements are fixed to the mean where all the components coincide (delta = 1)
+                index = fr[0]
+                ones = torch.ones_like(p_value)
+                if len(index) == 0:
+                    deltas.append([ones for _ in range(num_gmm_components)])
+                    continue
+                p_value = p_value.view(-1)[index]
+                mean_list, cov_list, pai_list = [[t.view(-1)[index] for t in t_list]
+                                                 for t_list in (mean_list, cov_list, pai_list)]
+            value = list(self._kernels['deltas'](p_value, mean_list, cov_list, pai_list).unbind(0))
+            if fr is not None:
+                value = [ones.view(-1).index_copy(0, index, v).view_as(ones) for v in value]
             deltas.append(value)
 
         return deltas
 
+    def track_posterior_health(self, group, deltas):
+        monitor = self.health_monitor
+        if not monitor.enabled:
+            return
+        for key, t_lists in [('deltas', deltas), ('mean', group['mean']), ('prec', group['prec']),
+                             ('pais', group['pais'])]:
+            monitor.track(key, [t for t_list in t_lists for t in t_list])
+        std_norm = group['curv'].std_norm()
+        if isinstance(std_norm, torch.Tensor):
+            monitor.track('std_norm', std_norm)
+
+    def update_frozen(self, group):
+        """Updates the params which are treated as deterministic (see deterministic_tol).
+
+        group['frozen'] holds, for each param, None (no deterministic element) or a pair of
+            the indices of the stochastic elements (flattened) and the mean of the posterior.
+        """
+        tol = self.defaults['deterministic_tol']
+        if tol == 0:
+            group['frozen'] = [None] * len(group['params'])
+            return
+
+        moments_list = self._group_moments(group)
+        stochastic = [(moments.var.sqrt() > moments.mean.abs().mul(tol)).view(-1) for moments in moments_list]
+        # the numbers of the stochastic elements of all the params are copied to the host at once
+        counts = torch.stack([s.sum() for s in stochastic]).tolist()
+        frozen = []
+        for moments, s, count in zip(moments_list, stochastic, counts):
+            if count == len(s):
+                frozen.append(None)
+                continue
+            frozen.append((_true_indices(s, count), moments.mean))
+        group['frozen'] = frozen
+
+    def frozen_fraction(self):
+        """Returns the fraction of the params which are treated as deterministic."""
+        num_frozen, num_params = 0, 0
+        for group in self.param_groups:
+            for p, fr in zip(group['params'], group['frozen']):
+                num_params += p.numel()
+                if fr is not None:
+                    num_frozen += p.numel() - len(fr[0])
+
+        return num_frozen / num_params if num_params > 0 else 0
+
     @property
     def seed(self):
         return self.optim_state['step'] + self.defaults['seed_base']
@@ -163,36 +333,71 @@ class VIOptimizer(SecondOrderOptimizer):
         if torch.cuda.is_available():
             torch.cuda.manual_seed_all(seed)
 
-    def sample_params(self):
+    def mc_generator(self, layer, mc_index=0, stream=TRAIN_STREAM, step=None):
+        """Returns a generator for the noise of a layer in an MC sample, without touching the global RNG.
+
+        The generator is seeded by a counter-based key of (seed, mc_group_id, step, layer, MC index, stream),
+            so that the noise of each (layer, MC sample) is reproducible regardless of the order (or the
+            thread/process) in which the samples are drawn.
+
+        Arguments:
+            layer (int): index of the param group
+            mc_index (int, optional): index of the MC sample in the step
+            stream (int, optional): purpose of the noise (TRAIN_STREAM or EVAL_STREAM)
+            step (int, optional): step of the optimizer (the current step is used if None)
+        """
+        group = self.param_groups[layer]
+        step = self.optim_state['step'] if step is None else step
+        generator = torch.Generator(device=group['params'][0].device)
+        generator.manual_seed(stream_seed(self.defaults['seed_base'], self.defaults['mc_group_id'],
+                                          step, layer, mc_index, stream))
+        return generator
+
+    def sample_params(self, mc_index=0, stream=TRAIN_STREAM):
+
+        sample = self._kernels['sample']
+        for layer, group in enumerate(self.param_groups):
+            std_scale = torch.as_tensor(group['std_scale'])
+            generator = self.mc_generator(layer, mc_index, stream)
+
+            for params, means, covs, pais, frozen in zip(group['params'], group['mean'], group['cov'],
+                                                         group['pais'], group['frozen']):  # sample from GMM for each param
+                if frozen is None:
+                    noise, selected_comp = draw_gmm_noise(means, pais, generator)
+                    params.data.copy_(sample(means, covs, noise, selected_comp, std_scale))
+                    continue
+
+                # sample only the stochastic elements
+                index, mean = frozen
+                params.data.copy_(mean)
+                if len(index) > 0:
+                    means, covs, pais = [[t.view(-1)[index] for t in t_list] for t_list in (means, covs, pais)]
+                    noise, selected_comp = draw_gmm_noise(means, pais, generator)
+                    params.data.view(-1)[index] = sample(means, covs, noise, selected_comp, std_scale)
+
+    def sample_bank(self, num_samples, seed=None):
+        """Draws a bank of params from the posterior without touching the global RNG.
+
+        Arguments:
+            num_samples (int): number of samples for each param
+            seed (int, optional): seed of the generator (self.seed is used if None)
+
+        Returns:
+            dict: torch.nn.Module -> list of samples (num_samples x param shape) of its params
+        """
+        device = self.param_groups[0]['params'][0].device
+        generator = torch.Generator(device=device)
+        generator.manual_seed(self.seed if seed is None else seed)
 
+        bank = {}
         for group in self.param_groups:
             std_scale = group['std_scale']
+            bank[group['curv'].module] = [
+                torch.stack([sample_gmm(means, covs, pais, std_scale, generator) for _ in range(num_samples)])
+                for means, covs, pais in zip(group['mean'], group['cov'], group['pais'])]
+
+        return bank
 
-            for params, means, covs, pais in zip(group['params'], group['mean'],
-                                                 group['cov'], group['pais']):  # sample from GMM for each param
-                # torch.stack([pp.view(-1) for pp in pai])
-                # noise = torch.randn_like(means[0])
-                # params.data.copy_(
-                #     torch.addcmul(means[0], group['std_scale'], noise,
-                #                   torch.sqrt(covs[0])))
-                noise = torch.randn_like(params)
-                stacked_pais = torch.stack(pais).view(self.num_gmm_components, -1)
-                selected_comp = torch.multinomial(stacked_pais.T, 1)
-                # selected_comp = torch.zeros_like(selected_comp)
-                stacked_means = torch.stack(means).view(self.num_gmm_components, -1)  # ([mm.view(-1) for mm in m])
-                stacked_cv = torch.stack(covs).view(self.num_gmm_components, -1)  # torch.stack([ss.view(-1) for ss in std])
-                mask = torch.zeros_like(stacked_means).scatter_(0,selected_comp.T, 1.)
-                selected_mean = torch.sum(stacked_means.mul(mask), dim=0)
-
-                selected_cov = torch.sum(stacked_cv.mul(mask), dim=0)
-                std = torch.sqrt(selected_cov)
-
-                gg = torch.addcmul(selected_mean.reshape_as(noise), std_scale, noise,
-                                   std.reshape_as(noise))
-                params.data.copy_(gg)
-                # print("%%%%% Sample %%%%%")
-                # print(gg)
-                # p.data.copy_(m[0])
     def sample_params1(self):
 
         for group in self.param_groups:
@@ -236,6 +441,196 @@ class VIOptimizer(SecondOrderOptimizer):
             if group['std_scale'] > 0:
                 group['std_scale'] = std_scale
 
+    def set_dataset_size(self, dataset_size):
+        """Rescales the prior term and the std of the samples for a new (effective) dataset size."""
+        if dataset_size <= 0:
+            raise ValueError("Invalid dataset size: {}".format(dataset_size))
+
+        rate = self.defaults['dataset_size'] / dataset_size
+        self.defaults['dataset_size'] = dataset_size
+        self.defaults['l2_reg'] *= rate
+        self.defaults['std_scale'] *= math.sqrt(rate)
+        for group in self.param_groups:
+            group['l2_reg'] *= rate
+            group['std_scale'] *= math.sqrt(rate)
+            if group['prior_mean'] is not None:
+                # the precision of the folded prior is relative to the dataset size
+                self.update_cov(group)
+        self.bump_posterior_version()
+
+    def bump_posterior_version(self):
+        """Marks the posterior as changed, so that the cached predictions of the previous one are not reused.
+
+        It is called by the methods of the optimizer which change the posterior, and has to be called
+            after the posterior (e.g., group['mean'] or group['std_scale']) is modified directly.
+        """
+        self.posterior_version += 1
+
+    def fold_posterior_into_prior(self):
+        """Replaces the prior by the current posterior (moment-matched to a diagonal Gaussian).
+
+        The precision of the prior is kept relative to 1 / prior_variance (the scale of l2_reg), i.e.,
+            the prior term of the surrogate loss becomes l2_reg * prior_prec * (p - prior_mean) ** 2.
+        Note that this switches the semantics of the prior term (and of its gradient) for good: before the first
+            fold it is the zero-mean l2 prior on the (detached) params, after it a Gaussian around the folded mean
+            which is differentiated through the samples (see prior_term).
+        The folded prior already accounts for the data seen so far, so the (effective) dataset size has to count
+            only the data seen after the fold, i.e., it has to be reset by the caller (see set_dataset_size and
+            StreamingVI), otherwise the same data is counted twice.
+        The precision of the folded prior is also added to that of the posterior (see update_cov), so that
+            the std of the samples does not jump when the dataset size (and std_scale with it) is reset.
+        """
+        for group, moments in zip(self.param_groups, self.posterior_moments().values()):
+            if group['l2_reg'] == 0:
+                continue
+            group['prior_mean'] = [mo.mean.clone() for mo in moments]
+            group['prior_prec'] = [mo.var.clamp(min=1e-30).reciprocal().mul(self.defaults['prior_variance'])
+                                   for mo in moments]
+            self.update_cov(group)
+        self.bump_posterior_version()
+
+    def _log_sampling_density(self, group, params, frozen=None):
+        # element-wise log density of the distribution which the stochastic elements (see update_frozen)
+        # of the params are sampled from (see sample_gmm)
+        var_scale = group['std_scale'] ** 2
+        if frozen is None:
+            frozen = group['frozen']
+        log_q = []
+        for p, m_list, c_list, pai_list, fr in zip(params, group['mean'], group['cov'], group['pais'], frozen):
+            if fr is not None:
+                index = fr[0]
+                p = p.view(-1)[index]
+                m_list, c_list, pai_list = [[t.view(-1)[index] for t in t_list]
+                                            for t_list in (m_list, c_list, pai_list)]
+            log_q.append(log_gmm_density(p, m_list, [c * var_scale for c in c_list], pai_list))
+
+        return log_q
+
+    def _recycle_entry(self):
+        entry = []
+        for group in self.param_groups:
+            params = [p.data.clone() for p in group['params']]
+            log_q = self._log_sampling_density(group, params) if group['std_scale'] > 0 else None
+            # the densities are compared on the elements which were sampled
+            entry.append({'params': params, 'log_q': log_q, 'frozen': group['frozen'],
+                          'grads': [p.grad.data.clone() for p in group['params']],
+                          'curv': [c.clone() for c in group['curv'].data]})
+        return entry
+
+    def recycled_samples(self):
+        """Returns the buffered samples with their (self-normalized) importance weights per layer.
+
+        The weights are computed for each layer (param group) separately, as a joint weight over all the
+            params of the network degenerates to a single sample. They are accumulated on the device and
+            copied to the host at once.
+        None is returned when the effective sample size of any layer is below the threshold
+            (see recycle_ess_threshold), i.e., fresh samples have to be drawn.
+        """
+        buffer = self.recycle_buffer
+        if buffer is None or len(buffer) == 0:
+            return None
+
+        log_weights = []
+        for i, group in enumerate(self.param_groups):
+            if group['std_scale'] == 0 or any(entry[i]['log_q'] is None for entry in buffer):
+                continue
+            group_log_weights = []
+            for entry in buffer:
+                sample = entry[i]
+                log_q = self._log_sampling_density(group, sample['params'], sample['frozen'])
+                log_weight = 0
+                for lq, lq_old in zip(log_q, sample['log_q']):
+                    log_weight = log_weight + (lq - lq_old).sum()
+                group_log_weights.append(log_weight)
+            log_weights.append((i, torch.stack(group_log_weights).double()))
+
+        uniform = [1 / len(buffer)] * len(buffer)
+        weights = [uniform for _ in self.param_groups]
+        ess = float(len(buffer))
+        if len(log_weights) > 0:
+            # a single device-to-host copy
+            stacked = torch.softmax(torch.stack([lw for _, lw in log_weights]), dim=1).cpu()
+            ess = (1 / stacked.pow(2).sum(dim=1)).min().item()
+            for (i, _), group_weights in zip(log_weights, stacked.tolist()):
+                weights[i] = group_weights
+
+        self.recycle_stats['ess'] = ess
+        if ess < self.defaults['recycle_ess_threshold'] * len(buffer):
+            return None
+
+        return [(entry, [group_weights[j] for group_weights in weights]) for j, entry in enumerate(buffer)]
+
+    def closed_form_surrogate(self):
+        """Returns the expectation of the surrogate loss (entropy term - prior term) under the posterior.
+
+        The entropy of each element (a mixture) is approximated by
+            sum_k pai_k * (entropy of the k-th component - log pai_k), which is exact for a single component.
+        """
+        ent, reg = 0., 0.
+        for group in self.param_groups:
+            var_scale = group['std_scale'] ** 2
+            for i, (means, covs, pais, fr) in enumerate(zip(group['mean'], group['cov'], group['pais'],
+                                                            group['frozen'])):
+                # E[log N(p; mean_k, cov_k)] for p ~ N(mean_k, var_scale * cov_k)
+                log_q = sum([pai * (torch.log(pai.clamp(min=1e-30))
+                                    - 0.5 * torch.log(2 * math.pi * cov) - 0.5 * var_scale)
+                             for pai, cov in zip(pais, covs)])
+                first_moment = sum([pai * m for pai, m in zip(pais, means)]).view(-1)
+                second_moment = sum([pai * (var_scale * cov + m ** 2) for pai, m, cov in zip(pais, means, covs)])
+                if fr is not None:
+                    index, mean = fr
+                    log_q = log_q.view(-1)[index]
+                    first_moment = mean.view(-1).index_copy(0, index, first_moment[index])
+                    second_moment = mean.pow(2).view(-1).index_copy(0, index, second_moment.view(-1)[index])
+                if group['prior_mean'] is not None:
+                    prior_mean, prior_prec = group['prior_mean'][i].view(-1), group['prior_prec'][i].view(-1)
+                    second_moment = prior_prec * (second_moment.view(-1) - 2 * prior_mean * first_moment
+                                                  + prior_mean ** 2)
+                ent += log_q.sum()
+                reg += group['l2_reg'] * second_moment.sum()
+
+        return (ent - reg).detach()
+
+    def _linearized_baselines(self):
+        # curvature (of the previous step) and mean of the posterior of each param
+        baselines = []
+        for group in self.param_groups:
+            data = group['curv'].data
+            if data is None:
+                baselines.append(None)
+                continue
+            means = [m.mean for m in self._group_moments(group)]
+            baselines.append(([c.detach().clone() for c in data], means))
+
+        return baselines
+
+    def _surrogate_scores(self, ent_loss):
+        params = [p for group in self.param_groups for p in group['params']]
+        if not torch.is_tensor(ent_loss) or not ent_loss.requires_grad:
+            return [None] * len(params)
+        return list(torch.autograd.grad(ent_loss, params, retain_graph=True, allow_unused=True))
+
+    def _apply_control_variates(self, closed_form, scores, baselines, cv_stats):
+        index = 0
+        grads, grads_cv = [], []
+        for i, group in enumerate(self.param_groups):
+            baseline = baselines[i] if baselines is not None else None
+            for j, p in enumerate(group['params']):
+                grad = p.grad.data
+                # grad without the control variates (the entropy term adds -d(log q)/d(params))
+                raw = grad.clone()
+                if closed_form and scores[index] is not None:
+                    raw.sub_(scores[index])
+                if baseline is not None:
+                    # curv * (params - mean) has zero mean under the posterior
+                    grad.sub_(baseline[0][j] * (p.data - baseline[1][j]))
+                grads.append(raw)
+                grads_cv.append(grad.clone())
+                index += 1
+
+        cv_stats[0].update(grads)
+        cv_stats[1].update(grads_cv)
+
     def backward_postprocess(self):  # acc_grad => group[target].grad
         for group in self.param_groups:
             acc_grads = group['acc_grads'].get()
@@ -262,54 +657,92 @@ class VIOptimizer(SecondOrderOptimizer):
 
         m = self.defaults['num_mc_samples']
         n = self.defaults['acc_steps']
+        is_curv_step = self.is_curv_step()
+        self.enable_curvature_update(is_curv_step)
 
         acc_loss = TensorAccumulator()
         acc_prob = TensorAccumulator()
 
-        self.set_random_seed()
+        recycled = self.recycled_samples()
+        num_fresh = m if recycled is None else 1
+        self.recycle_stats['num_fresh'] = num_fresh
+        self.recycle_stats['num_recycled'] = 0 if recycled is None else len(recycled)
 
-        for _ in range(m):
+        use_cv = self.defaults['control_variates'] or self.defaults['linearized_baseline']
+        if use_cv:
+            closed_form_surrogate = self.closed_form_surrogate() if self.defaults['control_variates'] else None
+            baselines = self._linearized_baselines() if self.defaults['linearized_baseline'] else None
+            cv_stats = _GradVariance(), _GradVariance()
 
-            # sampling
-            self.sample_params()
+        # the deterministic prefix (see stochastic_modules) is evaluated once for all the MC samples
+        with _prefix_cached_forward(self.model, self.prefix_cached_forward):
+            for i in range(num_fresh):
 
-            # forward and backward
-            ent_loss = 0
-            reg_loss = 0
-            for group in self.param_groups:
-                params = group['params']
-                group['q_entropy'] = [log_gmm(p, m_list, s_list, pai_list) for p, m_list, s_list, pai_list
-                                      in zip(params, group['mean'], group['cov'], group['pais'])]  # pais or log_pais
-                ent_loss += torch.sum(torch.stack([torch.sum(g) for g in group['q_entropy']]))
-                reg_loss += sum([torch.sum(group['l2_reg'] * p.data ** 2) for p in params])
-                # reg_loss += torch.sum(torch.stack([group['l2_reg'] * p.data ** 2 for p in params]))
-
-            surrogate_loss = ent_loss-reg_loss
-            loss, output, network_loss = closure(surrogate_loss)
-            # for p in params:
-            #     print(p.grad)
-                # p.grad.add_(group['l2_reg'], p.data)  # Add derivative of prior
-
-            acc_loss.update(loss, scale=1/m)
-            if output.ndim == 2:
-                prob = F.softmax(output, dim=1)
-            elif output.ndim == 1:
-                prob = torch.sigmoid(output)
-            else:
-                raise ValueError(f'Invalid ndim {output.ndim}')
-            acc_prob.update(prob, scale=1/n)
-
-            # accumulate
-            for group in self.param_groups:
-                params = group['params']
-                grads = [p.grad.data for p in params]
-                # print("%%%%%%%%%%%% this is grad %%%%%%%%%%%")
-                # print(grads)
-                group['acc_grads'].update(grads, scale=1/m/n)
-                group['acc_curv'].update(group['curv'].data, scale=1/m/n)
-                delta = self.calculate_deltas(group['mean'],
-                                              group['cov'], group['pais'], params)
-                group['acc_delta'].update(delta, scale=1/m/n)
+                # sampling
+                self.sample_params(mc_index=i)
+
+                # forward and backward
+                ent_loss, reg_loss = self.surrogate_terms()
+
+                surrogate_loss = ent_loss-reg_loss
+                if use_cv:
+                    # the gradients of the MC terms which are replaced by the control variates
+                    scores = None
+                    if closed_form_surrogate is not None:
+                        scores = self._surrogate_scores(ent_loss)
+                        surrogate_loss = closed_form_surrogate
+                        if torch.is_tensor(reg_loss) and reg_loss.requires_grad:
+                            # the folded prior pulls the samples to its mean (its gradient does not have zero mean),
+                            # so that only its value is replaced
+                            surrogate_loss = surrogate_loss - (reg_loss - reg_loss.detach())
+                loss, output, network_loss = closure(surrogate_loss)
+                if use_cv:
+                    self._apply_control_variates(closed_form_surrogate is not None, scores, baselines, cv_stats)
+                # for p in params:
+                #     print(p.grad)
+                    # p.grad.add_(group['l2_reg'], p.data)  # Add derivative of prior
+
+                if self.recycle_buffer is not None:
+                    self.recycle_buffer.append(self._recycle_entry())
+
+                acc_loss.update(loss, scale=1/num_fresh)
+                self.health_monitor.track('loss', loss)
+                if output.ndim == 2:
+                    prob = F.softmax(output, dim=1)
+                elif output.ndim == 1:
+                    prob = torch.sigmoid(output)
+                else:
+                    raise ValueError(f'Invalid ndim {output.ndim}')
+                acc_prob.update(prob, scale=1/n)
+
+                # accumulate
+                for group in self.param_groups:
+                    params = group['params']
+                    grads = [p.grad.data for p in params]
+                    # print("%%%%%%%%%%%% this is grad %%%%%%%%%%%")
+                    # print(grads)
+                    self.health_monitor.track('grads', grads)
+                    group['acc_grads'].update(grads, scale=1/m/n)
+                    group['acc_curv'].update(group['curv'].data, scale=1/m/n)
+                    delta = self.calculate_deltas(group['mean'],
+                                                  group['cov'], group['pais'], params, group['frozen'])
+                    group['acc_delta'].update(delta, scale=1/m/n)
+
+        if recycled is not None:
+            # the recycled samples take the weight of the (m - 1) samples which are not evaluated
+            for entry, weights in recycled:
+                for group, sample, weight in zip(self.param_groups, entry, weights):
+                    scale = weight * (m - num_fresh) / m / n
+                    group['acc_grads'].update(sample['grads'], scale=scale)
+                    group['acc_curv'].update(sample['curv'], scale=scale)
+                    delta = self.calculate_deltas(group['mean'], group['cov'], group['pais'],
+                                                  sample['params'], group['frozen'])
+                    group['acc_delta'].update(delta, scale=scale)
+
+        if use_cv:
+            grad_var, grad_var_cv = cv_stats[0].get(), cv_stats[1].get()
+            self.control_variate_stats = {'grad_var': grad_var, 'grad_var_cv': grad_var_cv,
+                                          'variance_reduction': 1 - grad_var_cv / grad_var if grad_var > 0 else 0.}
 
         loss, prob = acc_loss.get(), acc_prob.get()
 
@@ -320,6 +753,50 @@ class VIOptimizer(SecondOrderOptimizer):
         else:
             self.optim_state['acc_step'] = 0
 
+        self.update_posterior(loss, is_curv_step)
+
+        return loss, prob, network_loss
+
+    def surrogate_terms(self):
+        """Returns the entropy and prior terms of the surrogate loss for the current (sampled) params."""
+        ent_loss = 0
+        reg_loss = 0
+        for group in self.param_groups:
+            params = group['params']
+            # the deterministic elements only add a constant (with zero gradient at the mean)
+            group['q_entropy'] = []
+            for p, m_list, s_list, pai_list, fr in zip(params, group['mean'], group['cov'], group['pais'],
+                                                       group['frozen']):
+                if fr is not None:
+                    index = fr[0]
+                    if len(index) == 0:
+                        continue
+                    p = p.view(-1)[index]
+                    m_list, s_list, pai_list = [[t.view(-1)[index] for t in t_list]
+                                                for t_list in (m_list, s_list, pai_list)]
+                group['q_entropy'].append(log_gmm(p, m_list, s_list, pai_list))  # pais or log_pais
+            if len(group['q_entropy']) > 0:
+                ent_loss += torch.sum(torch.stack([torch.sum(g) for g in group['q_entropy']]))
+            reg_loss += self.prior_term(group, params)
+            # reg_loss += torch.sum(torch.stack([group['l2_reg'] * p.data ** 2 for p in params]))
+
+        return ent_loss, reg_loss
+
+    def prior_term(self, group, params):
+        """Returns the prior term of the surrogate loss of a group for the params (of the same shapes or stacked).
+
+        It is the l2 prior (without gradient) until the posterior is folded into the prior,
+            and the Gaussian folded prior afterwards (see fold_posterior_into_prior).
+        """
+        if group['prior_mean'] is None:
+            # the l2 prior does not give a gradient through the samples
+            return sum([torch.sum(group['l2_reg'] * p.data ** 2) for p in params])
+        # the prior folded from the posterior (see fold_posterior_into_prior) pulls the params to its mean
+        return sum([torch.sum(group['l2_reg'] * prec * (p - mean) ** 2)
+                    for p, mean, prec in zip(params, group['prior_mean'], group['prior_prec'])])
+
+    def update_posterior(self, loss, is_curv_step=True):
+        """Updates the posterior with the accumulated gradients, curvatures and deltas (acc_grads, etc.)."""
         self.backward_postprocess()
         self.optim_state['step'] += 1
 
@@ -331,10 +808,12 @@ class VIOptimizer(SecondOrderOptimizer):
             # print(group["cov"])
             # print("P" * 10)
             deltas = group['acc_delta'].get()
-            self.update_prec(group, deltas)
-            self.update_cov(group)
+            if is_curv_step:
+                self.update_prec(group, deltas)
+                self.update_cov(group)
             self.update_mean(group, deltas)
             self.update_pais(group, loss, deltas)
+            self.track_posterior_health(group, deltas)
 
             # copy mean to param
             params = group['params']
@@ -344,33 +823,176 @@ class VIOptimizer(SecondOrderOptimizer):
 
             self.adjust_kl_weighting()
 
+        for group in self.local_param_groups:
+            self.update_frozen(group)
 
-        return loss, prob, network_loss
+        self.enable_curvature_update()
+        self.bump_posterior_version()
+        self.health_monitor.step()
+
+    def ensemble_step(self, data, target, criterion=F.cross_entropy, per_layer=False):
+        """Performs a single optimization step with component-coherent samples of the mixture.
+
+        Instead of selecting a component for each element (see step()), each of the K members of an ensemble
+            uses one component for the whole network (or, with per_layer, one for each layer so that every
+            component of a layer is used by one member). The members are evaluated in parallel by
+            torch.func.vmap over the K stacked params, and the per-example gradients give the gradient and
+            the (diagonal) curvature of each component, which are weighted by the responsibility of
+            the component for the sampled params.
+        The entropy term is not evaluated (its gradient has zero mean) and acc_steps is not applied.
+            The gradient of the prior term is that of step() (see prior_term).
+            As the examples are evaluated separately, BatchNorm in training mode is not supported.
+
+        Arguments:
+            data (torch.Tensor): inputs
+            target (torch.Tensor): targets
+            criterion (callable, optional): loss function (with mean reduction) of output and target
+            per_layer (bool, optional): whether the component is selected for each layer
 
-    def update_prec(self, group, deltas):
+        Returns:
+            tuple: loss, predictive probabilities and the loss of each member
+        """
+        num_components = self.num_gmm_components
+        generators = [self.mc_generator(layer) for layer in range(len(self.param_groups))]
+
+        # component used by each member in each group
+        if per_layer:
+            assignments = [torch.randperm(num_components, generator=g, device=g.device) for g in generators]
+        else:
+            assignments = [torch.arange(num_components, device=g.device) for g in generators]
+
+        names = {p: name for name, p in self.model.named_parameters()}
+        stacked = {}
+        for group, assignment, generator in zip(self.param_groups, assignments, generators):
+            for p, means, covs in zip(group['params'], group['mean'], group['cov']):
+                mean = torch.stack([means[k] for k in assignment.tolist()]).detach()
+                std = torch.stack([covs[k] for k in assignment.tolist()]).sqrt()
+                noise = torch.randn(mean.shape, generator=generator, device=mean.device, dtype=mean.dtype)
+                stacked[names[p]] = torch.addcmul(mean, noise, std, value=group['std_scale'])
+
+        def example_loss(params, x, t):
+            output = functional_call(self.model, params, (x.unsqueeze(0),))
+            return criterion(output, t.unsqueeze(0)), output.squeeze(0)
+
+        per_example = vmap(grad_and_value(example_loss, has_aux=True), in_dims=(None, 0, 0), randomness='different')
+        with _functional_forward(self.model):
+            grads, (losses, outputs) = vmap(per_example, in_dims=(0, None, None),
+                                            randomness='different')(stacked, data, target)
+
+        # the gradients of the prior term of each member (the same term as that of step())
+        prior_grads = {}
+        for group in self.param_groups:
+            member_params = [stacked[names[p]].detach().requires_grad_() for p in group['params']]
+            reg = self.prior_term(group, member_params)
+            if isinstance(reg, torch.Tensor) and reg.requires_grad:
+                for p, g in zip(group['params'], torch.autograd.grad(reg, member_params)):
+                    prior_grads[names[p]] = g
+
+        # responsibility of the component of each member for the sampled params
+        log_densities = [self._member_log_densities(group, [stacked[names[p]] for p in group['params']])
+                         for group in self.param_groups]
+        if not per_layer:
+            total = sum(log_densities)
+            log_densities = [total] * len(self.param_groups)
+
+        network_loss = losses.mean(dim=1)
+        loss = network_loss.mean()
+
+        for group, assignment, log_density in zip(self.param_groups, assignments, log_densities):
+            order = torch.argsort(assignment)  # member of each component
+            resp = torch.softmax(log_density, dim=1)[order, torch.arange(num_components, device=order.device)]
+            deltas, curv_data = [], []
+            for p, m_list in zip(group['params'], group['mean']):
+                g = grads[names[p]]
+                mean_grads, curvs = g.mean(dim=1), g.pow(2).mean(dim=1)
+                if names[p] in prior_grads:
+                    mean_grads = mean_grads + prior_grads[names[p]]
+                mean_grads, curvs = mean_grads[order], curvs[order]
+                for k, m in enumerate(m_list):
+                    m.grad = mean_grads[k].clone()
+                deltas.append([torch.ones_like(p).mul(r) for r in resp.tolist()])
+                curv_data.append(list(curvs))
+            group['curv'].data = [torch.stack(c_list).mean(dim=0) for c_list in curv_data]
+
+            self.update_prec(group, deltas, curv_data)
+            self.update_cov(group)
+            self.update_mean(group, deltas)
+            self.update_pais(group, loss, deltas)
+            self.track_posterior_health(group, deltas)
+
+            # copy mean to param
+            for p, m_list in zip(group['params'], group['mean']):
+                p.data.copy_(m_list[0].data)
+                p.grad = m_list[0].grad.clone()
+
+        self.optim_state['step'] += 1
+        self.adjust_kl_weighting()
+        for group in self.param_groups:
+            self.update_frozen(group)
+        self.bump_posterior_version()
+        self.health_monitor.step()
+
+        if outputs.ndim == 3:
+            prob = F.softmax(outputs, dim=2).mean(dim=0)
+        elif outputs.ndim == 2:
+            prob = torch.sigmoid(outputs).mean(dim=0)
+        else:
+            raise ValueError(f'Invalid ndim {outputs.ndim}')
+
+        return loss.detach(), prob.detach(), network_loss.detach()
+
+    def _member_log_densities(self, group, stacked_params):
+        # log density of the params of each member (rows) under each component (columns) of the group
+        num_components = self.num_gmm_components
+        var_scale = group['std_scale'] ** 2
+        if var_scale == 0:
+            # deterministic members belong to their own components
+            return torch.eye(num_components, device=group['params'][0].device).log()
+
+        log_density, pai_sum, numel = 0, 0, 0
+        for params, means, covs, pais in zip(stacked_params, group['mean'], group['cov'], group['pais']):
+            x = params.detach().view(num_components, 1, -1)
+            mean = torch.stack(means).view(1, num_components, -1)
+            cov = torch.stack(covs).view(1, num_components, -1) * var_scale
+            log_density = log_density + log_gaussian(x, mean, cov).sum(dim=2)
+            pai_sum = pai_sum + torch.stack([pai.sum() for pai in pais])
+            numel += params[0].numel()
+
+        # the weight of each component is averaged over the elements of the group
+        return log_density + (pai_sum / numel).log()
+
+    def update_prec(self, group, deltas, curv_data=None):
         # prec = group['prec']
         beta = 0.01
         # delta = group['acc_delta']
+        if curv_data is None:
+            # the curvature is shared by the components
+            curv_data = [[d] * self.num_gmm_components for d in group['curv'].data]
 
         if group['prec'] is None or beta == 1:
-            group['prec'] = [[d.clone() for _ in range(self.num_gmm_components)] for d in group['curv'].data]
+            group['prec'] = [[d.clone() for d in d_list] for d_list in curv_data]
         else:
-            h_hess = group['curv'].data
-
-            group['prec'] = [[(hh*beta*d).add(e) for e, d in zip(e_list, d_list)]
-                        for e_list, hh, d_list in zip(group['prec'] , h_hess, deltas)]  # update rule
+            group['prec'] = [list(self._kernels['prec'](e_list, hh_list, d_list, beta))
+                             for e_list, hh_list, d_list in zip(group['prec'], curv_data, deltas)]  # update rule
 
     def update_cov(self, group):
-        group['cov'] = [[1 / e for e in prec_list] for prec_list in group['prec']]
+        if group['prior_mean'] is None:
+            group['cov'] = [[1 / e for e in prec_list] for prec_list in group['prec']]
+            return
+
+        # the precision of the folded prior (in the scale of prec, see prior_term) adds to that of the data
+        group['cov'] = [[1 / (e + group['l2_reg'] * prior_prec) for e in prec_list]
+                        for prec_list, prior_prec in zip(group['prec'], group['prior_prec'])]
 
     def update_mean(self, group, deltas):
         means = group['mean']
         # deltas = group['acc_delta']._accumulation
         cov = group['cov']
+        lr = torch.as_tensor(group['lr'])
         for m_list, d_list, cov_list in zip(means, deltas, cov):
             for m, d, inv in zip(m_list, d_list, cov_list):
                 grad = m.grad
-                m.data.add_(-group['lr'], d * grad * inv)  #HERE: * group['ratio']
+                m.data.copy_(self._kernels['mean'](m.data, d, grad, inv, lr))  #HERE: * group['ratio']
                 # print("%%%%%%%% update value of mean %%%%%%%%")
                 # print(d * grad * inv)
                 # print(inv)
@@ -378,66 +1000,166 @@ class VIOptimizer(SecondOrderOptimizer):
                 # print(d)
 
     def update_pais(self, group, output, deltas):
-        num_components = self.defaults['num_gmm_components']
         # deltas = group['acc_delta']._accumulation
-        pais1 = group['pais']
-        rhos1 = [[torch.log(p)-torch.log(p_list[-1]) for p in p_list] for p_list in pais1]
         # beta = 0.001#self.defaults['lr']
-        delta_K = [d_list[-1] for d_list in deltas] #last component for all param
+        output = torch.as_tensor(output).detach()
+        lr = torch.as_tensor(group['lr'])
+        pais = [self._kernels['pais'](pai_list, d_list, output, lr) for pai_list, d_list in zip(group['pais'], deltas)]
 
-        delta_diff = []
-
-        for d_list, dk in zip(deltas, delta_K):
-            delta_diff.append([d - dk for d in d_list])
-
-        rhos = [[(r - d)*output*group['lr'] for r, d in zip(r_list, d_list)] for r_list, d_list in zip(rhos1, delta_diff)]
-        pais = [torch.softmax(torch.stack(r_list), dim=0) for r_list in rhos]
-        # if torch.isnan(torch.sum(torch.stack(pais))):
-        if torch.isnan(sum([torch.sum(p) for p in pais])):
-            print("booya")
-
-        group['pais'] = [[pai_list[i].data.detach() for i in range(num_components)] for pai_list in pais]
+        group['pais'] = [list(pai_list.detach().unbind(0)) for pai_list in pais]
 
     def prediction(self, data, mc=None, keep_probs=False):
 
-        self.set_random_seed(self.optim_state['step'])
+        mc_samples = self.defaults['val_num_mc_samples'] if mc is None else mc
+
+        cache = self.prediction_cache
+        if cache is not None:
+            # the step selects the random streams of the samples
+            key = cache.key(data, (self.posterior_version, self.optim_state['step']), mc_samples, keep_probs,
+                            self.model.training)
+            cached = cache.get(key)
+            if cached is not None:
+                return cached
 
         acc_prob = TensorAccumulator()
         probs = []
 
-        mc_samples = self.defaults['val_num_mc_samples'] if mc is None else mc
-
         use_mean = mc_samples == 0
         n = 1 if use_mean else mc_samples
 
-        for _ in range(n):
+        with _prefix_cached_forward(self.model, self.prefix_cached_forward):
+            for i in range(n):
 
-            if use_mean:
-                self.copy_mean_to_params()
-            else:
-                # sampling
-                self.sample_params()
+                if use_mean:
+                    self.copy_mean_to_params()
+                else:
+                    # sampling
+                    self.sample_params(mc_index=i, stream=EVAL_STREAM)
 
-            output = self.model(data)
-            if output.ndim == 2:
-                prob = F.softmax(output, dim=1)
-            elif output.ndim == 1:
-                prob = torch.sigmoid(output)
-            else:
-                raise ValueError(f'Invalid ndim {output.ndim}')
+                output = self.model(data)
+                if output.ndim == 2:
+                    prob = F.softmax(output, dim=1)
+                elif output.ndim == 1:
+                    prob = torch.sigmoid(output)
+                else:
+                    raise ValueError(f'Invalid ndim {output.ndim}')
 
-            acc_prob.update(prob, scale=1/n)
-            if keep_probs:
-                probs.append(prob)
+                acc_prob.update(prob, scale=1/n)
+                if keep_probs:
+                    probs.append(prob)
 
         self.copy_mean_to_params()
 
         prob = acc_prob.get()
+        ret = (prob, probs) if keep_probs else prob
+
+        if cache is not None:
+            cache.put(key, ret)
+
+        return ret
+
+    def posterior_moments(self):
+        """Returns the mean and variance of the (GMM) posterior of the params for each layer.
+
+        The variance includes std_scale, i.e., it is the variance of the params drawn by sample_params().
+
+        Returns:
+            dict: torch.nn.Module -> list of Moments of its params
+        """
+        return {group['curv'].module: self._group_moments(group) for group in self.param_groups}
+
+    def _group_moments(self, group):
+        std_scale = group['std_scale']
+        moments = []
+        for means, covs, pais in zip(group['mean'], group['cov'], group['pais']):
+            mean = sum([pai * m for pai, m in zip(pais, means)])
+            second_moment = sum([pai * (std_scale ** 2 * cov + m ** 2) for pai, m, cov in zip(pais, means, covs)])
+            var = (second_moment - mean ** 2).clamp(min=0)
+            moments.append(Moments(mean.detach(), var.detach()))
+
+        return moments
+
+    def analytic_prediction(self, data, last_layer_only=False):
+        """Approximates the posterior predictive without MC sampling.
+
+        The mean and variance of the activations are propagated through the model
+            (Linear, Conv2d and ReLU layers) and the output is squashed by the probit approximation.
+
+        Arguments:
+            data (torch.Tensor): a batch of inputs
+            last_layer_only (bool, optional): whether only the last layer is treated as stochastic
+                (the other layers use the posterior mean)
+        """
+        moments = self.posterior_moments()
+        if last_layer_only:
+            last_module = self.param_groups[-1]['curv'].module
+            moments = {module: [m if module is last_module else Moments(m.mean, torch.zeros_like(m.var))
+                                for m in module_moments]
+                       for module, module_moments in moments.items()}
+
+        if self._traced_model is None:
+            self._traced_model = symbolic_trace(self.model)
+
+        mean, var = propagate_moments(self._traced_model, data, moments)
+
+        return probit_approximation(mean, var)
+
+    def export_predictive(self, num_samples=None, seed=None):
+        """Builds a standalone module which computes the MC-averaged predictive in a single graph.
+
+        The params are drawn once into a fixed bank (see sample_bank()) and stored as buffers
+            of the returned module, which has no dependency on this optimizer.
+
+        Arguments:
+            num_samples (int, optional): number of MC samples (val_num_mc_samples is used if None)
+            seed (int, optional): seed of the generator for the samples
+
+        Example:
+            >>> predictive = optimizer.export_predictive()
+            >>> torch.jit.save(torch.jit.script(predictive), 'predictive.pt')
+            >>> # without torchsso
+            >>> prob = torch.jit.load('predictive.pt')(data)
+        """
+        num_samples = self.defaults['val_num_mc_samples'] if num_samples is None else num_samples
+        if num_samples < 1:
+            raise ValueError("Invalid number of MC samples: {}".format(num_samples))
+
+        return build_posterior_predictive(self.model, self.sample_bank(num_samples, seed))
+
+    def cascade_prediction(self, data, threshold, criterion='margin', mc=None):
+        """Predicts with the mean network and re-evaluates only uncertain inputs with MC samples.
+
+        Arguments:
+            data (torch.Tensor): a batch of inputs
+            threshold (float): inputs whose margin falls below (criterion='margin')
+                or whose entropy exceeds (criterion='entropy') this value take the MC path
+            criterion (str, optional): confidence measure of the mean prediction ('margin' or 'entropy')
+            mc (int, optional): number of MC samples for the uncertain inputs
+                (val_num_mc_samples is used if None)
+
+        Returns:
+            prob (torch.Tensor): mean-network probabilities merged with the MC probabilities
+            mc_fraction (float): fraction of inputs which took the MC path (0 for an empty batch)
+        """
+        if criterion not in ['margin', 'entropy']:
+            raise ValueError("Invalid criterion: {}".format(criterion))
+
+        prob = self.prediction(data, mc=0)
 
-        if keep_probs:
-            return prob, probs
+        if criterion == 'margin':
+            uncertain = prediction_margin(prob) < threshold
         else:
-            return prob
+            uncertain = prediction_entropy(prob) > threshold
+
+        indices = torch.nonzero(uncertain, as_tuple=False).view(-1)
+        if len(indices) > 0:
+            prob = prob.clone()
+            prob[indices] = self.prediction(data[indices], mc=mc)
+
+        # no input takes the MC path of an empty batch
+        mc_fraction = len(indices) / len(data) if len(data) > 0 else 0.
+
+        return prob, mc_fraction
 
 
 class VOGN(VIOptimizer):
@@ -464,7 +1186,8 @@ class DistributedVIOptimizer(DistributedSecondOrderOptimizer, VIOptimizer):
 
     def __init__(self, *args, mc_group_id=0, **kwargs):
         super(DistributedVIOptimizer, self).__init__(*args, **kwargs)
-        self.defaults['seed_base'] += mc_group_id * self.defaults['total_steps']
+        # the MC groups draw the noise from disjoint streams
+        self.defaults['mc_group_id'] = mc_group_id
 
     @property
     def actual_optimizer(self):
@@ -492,8 +1215,141 @@ class DistributedVIOptimizer(DistributedSecondOrderOptimizer, VIOptimizer):
         return ret
 
 
+@contextmanager
+def _functional_forward(model):
+    # disables the hooks (curvature) of the model
+    hooks = []
+    for module in model.modules():
+        hooks.append((module, module._forward_hooks, module._backward_hooks))
+        module._forward_hooks, module._backward_hooks = type(module._forward_hooks)(), \
+            type(module._backward_hooks)()
+    try:
+        yield
+    finally:
+        for module, forward_hooks, backward_hooks in hooks:
+            module._forward_hooks, module._backward_hooks = forward_hooks, backward_hooks
+
+
+@contextmanager
+def _prefix_cached_forward(model, prefix_cached_forward):
+    # model(data) evaluates the deterministic prefix only once for the same data in the block
+    # (see stochastic_modules), and the forward of the model is restored afterwards
+    if prefix_cached_forward is None:
+        yield
+        return
+    forward = model.__dict__.pop('forward', None)
+    model.forward = prefix_cached_forward
+    try:
+        yield
+    finally:
+        del model.forward
+        if forward is not None:
+            model.forward = forward
+        prefix_cached_forward.clear()
+
+
+class _GradVariance(object):
+    # total (summed over the elements) variance of the gradients over the MC samples
+
+    def __init__(self):
+        self._sum = None
+        self._sq_sum = None
+        self._count = 0
+
+    def update(self, grads):
+        if self._sum is None:
+            self._sum = [g.clone() for g in grads]
+            self._sq_sum = [g ** 2 for g in grads]
+        else:
+            for s, sq, g in zip(self._sum, self._sq_sum, grads):
+                s.add_(g)
+                sq.add_(g ** 2)
+        self._count += 1
+
+    def get(self):
+        if self._count < 2:
+            return 0.
+        n = self._count
+        return sum([(sq / n - (s / n) ** 2).clamp(min=0).sum().item() for s, sq in zip(self._sum, self._sq_sum)])
+
+
+_MASK64 = (1 << 64) - 1
+
+
+def _splitmix64(x):
+    x = (x + 0x9E3779B97F4A7C15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+def stream_seed(*counters):
+    """Returns a (64-bit) seed of the random stream keyed by the counters, e.g., (seed, step, layer, MC index)."""
+    key = 0
+    for c in counters:
+        key = _splitmix64(key ^ (int(c) & _MASK64))
+    return key
+
+
+def draw_gmm_noise(means, pais, generator=None):
+    # standard normal noise and the selected component of each element
+    num_gmm_components = len(means)
+    noise = torch.randn(means[0].shape, generator=generator, device=means[0].device, dtype=means[0].dtype)
+    stacked_pais = torch.stack(pais).view(num_gmm_components, -1)
+    selected_comp = torch.multinomial(stacked_pais.T, 1, generator=generator)
+    return noise, selected_comp
+
+
+def sample_gmm(means, covs, pais, std_scale, generator=None):
+    # select a component for each element, then sample from the selected Gaussian
+    noise, selected_comp = draw_gmm_noise(means, pais, generator)
+    return gmm_transform_noise(means, covs, noise, selected_comp, std_scale)
+
+
+def _true_indices(flags, count):
+    # indices of the True elements of a flat bool tensor, whose number is known, without a device-to-host sync
+    position = torch.where(flags, flags.long().cumsum(0) - 1, torch.full_like(flags, count, dtype=torch.long))
+    index = torch.empty(count + 1, dtype=torch.long, device=flags.device)
+    index.scatter_(0, position, torch.arange(len(flags), device=flags.device))
+    return index[:count]
+
+
+def gmm_transform_noise(means, covs, noise, selected_comp, std_scale):
+    num_gmm_components = len(means)
+    stacked_means = torch.stack(means).view(num_gmm_components, -1)
+    stacked_cv = torch.stack(covs).view(num_gmm_components, -1)
+    mask = torch.zeros_like(stacked_means).scatter_(0, selected_comp.T, 1.)
+    selected_mean = torch.sum(stacked_means.mul(mask), dim=0)
+    selected_cov = torch.sum(stacked_cv.mul(mask), dim=0)
+    std = torch.sqrt(selected_cov)
+
+    return selected_mean.reshape_as(noise) + noise * std.reshape_as(noise) * std_scale
+
+
+def gmm_deltas(x, means, covs, pais):
+    # density of each component relative to the mixture density at x (stacked along dim 0)
+    densities = torch.stack([gaussian(x, mu, cov) for (mu, cov) in zip(means, covs)])
+    return densities / torch.sum(torch.stack(pais) * densities, dim=0)
+
+
+def gmm_prec_update(precs, curvs, deltas, beta):
+    return [(hh * beta * d).add(e) for e, hh, d in zip(precs, curvs, deltas)]
+
+
+def gmm_mean_update(mean, delta, grad, cov, lr):
+    return mean - lr * delta * grad * cov
+
+
+def gmm_pais_update(pais, deltas, loss, lr):
+    # natural-gradient step on the log-ratios of the mixture weights to the last one
+    log_pais = torch.log(torch.stack(pais))
+    stacked_deltas = torch.stack(deltas)
+    rhos = ((log_pais - log_pais[-1]) - (stacked_deltas - stacked_deltas[-1])) * loss * lr
+    return torch.softmax(rhos, dim=0)
+
+
 def gaussian(x, mean, cov):
-    return (1 / torch.sqrt(torch.FloatTensor([2*math.pi])*cov)) * torch.exp(-((x - mean) ** 2.) / (2 * cov))
+    return (1 / torch.sqrt(2 * math.pi * cov)) * torch.exp(-((x - mean) ** 2.) / (2 * cov))
 
 def gmm(x, means, covs, pais):
     return sum([pai * gaussian(x, mu, cov) for (pai, mu, cov) in zip(pais, means, covs)])
@@ -508,5 +1364,11 @@ def log_gmm(x, means, covs, log_pais):
     log_weights = log_normalize(torch.stack(log_pais))
     return torch.logsumexp(component_log_densities + log_weights, axis=-1, keepdims=False)
 
+def log_gmm_density(x, means, covs, pais):
+    # log density of each element under its own mixture (components are stacked along dim 0)
+    component_log_densities = torch.stack([log_gaussian(x, mu, cov) for (mu, cov) in zip(means, covs)])
+    log_weights = torch.log(torch.stack(pais))
+    return torch.logsumexp(component_log_densities + log_weights, dim=0)
+
 def log_normalize(x):
-    return x - torch.logsumexp(x, 0)
\ No newline at end of file
+    return x - torch.logsumexp(x, 0)
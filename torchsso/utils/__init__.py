@@ -2,3 +2,10 @@ from torchsso.utils.logger import Logger  # NOQA
 from torchsso.utils.inv_cupy import inv  # NOQA
 from torchsso.utils.cholesky_cupy import cholesky  # NOQA
 from torchsso.utils.accumulator import TensorAccumulator, MixtureAccumulator  # NOQA
+from torchsso.utils.posterior_snapshot import PosteriorSnapshot, save_posterior_snapshot  # NOQA
+from torchsso.utils.predictive_cache import PredictiveCache  # NOQA
+from torchsso.utils.prefix_cache import PrefixCachedForward  # NOQA
+from torchsso.utils.health_monitor import HealthMonitor  # NOQA
+from torchsso.utils.checkpoint import AsyncCheckpointWriter, LazyCheckpoint, read_checkpoint  # NOQA
+from torchsso.utils.shared_posterior import SharedPosterior  # NOQA
+from torchsso.utils.timing import TimedClosure  # NOQA
@@ -0,0 +1,381 @@
+import hashlib
+import io
+import json
+import os
+import threading
+
+import torch
+
+CHECKPOINT_VERSION = 1
+_LATEST = 'latest'
+
+
+def _fsync_dir(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _atomic_write(path, data):
+    # the file appears (by rename) only after its content is on the disk
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(path))
+
+
+def _update_digest(h, value):
+    # digest of the structure and the raw bytes of the tensors (without serializing them)
+    if isinstance(value, torch.Tensor):
+        h.update('tensor{}{}'.format(value.dtype, tuple(value.shape)).encode('utf-8'))
+        h.update(value.contiguous().view(-1).view(torch.uint8).numpy())
+    elif isinstance(value, dict):
+        h.update(b'{')
+        for key, v in value.items():
+            h.update(repr(key).encode('utf-8'))
+            _update_digest(h, v)
+        h.update(b'}')
+    elif isinstance(value, (list, tuple)):
+        h.update(b'[')
+        for v in value:
+            _update_digest(h, v)
+        h.update(b']')
+    else:
+        h.update(repr(value).encode('utf-8'))
+
+
+def _shard_digest(shard):
+    h = hashlib.blake2b(digest_size=16)
+    _update_digest(h, shard)
+    return h.hexdigest()
+
+
+def checkpoint_shards(model, optimizer=None, include_inverses=True, **extra):
+    r"""Splits the state of a model and its (second-order) optimizer into per-layer shards.
+
+    The shard 'layer{i}' holds the params/buffers of the layer of the i-th param group and its optimizer state
+        (hyperparams, posterior, curvature and buffers), 'model' the rest of the model and 'meta' the rest of
+        the optimizer state, the names of the layers and the extra values (e.g., epoch).
+    The tensors are not copied, i.e., the shards refer to the live state.
+
+    Returns:
+        dict: name -> shard
+    """
+    model_state = model.state_dict(keep_vars=True)
+    shards = {}
+    meta = {'extra': extra}
+
+    if optimizer is not None:
+        state_dict = optimizer.state_dict(include_inverses=include_inverses, copy_tensors=False)
+        names = {module: name for name, module in model.named_modules()}
+        state = state_dict.pop('state')
+        groups = state_dict.pop('param_groups')
+        meta['modules'] = []
+        offset = 0
+        for i, (group, group_state) in enumerate(zip(optimizer.param_groups, groups)):
+            num_states = len(optimizer._group_state_keys(group))
+            shard = {'group': group_state, 'state': state[offset:offset + num_states], 'model': {}}
+            offset += num_states
+
+            meta['modules'].append(names[group['curv'].module])
+            prefix = meta['modules'][-1] + '.'
+            for key in [key for key in model_state if key.startswith(prefix)]:
+                shard['model'][key] = model_state.pop(key)
+            shards['layer{}'.format(i)] = shard
+        meta['optimizer'] = state_dict
+        meta['num_groups'] = len(groups)
+
+    shards['model'] = model_state
+    shards['meta'] = meta
+
+    return shards
+
+
+class AsyncCheckpointWriter(object):
+    r"""Writes sharded checkpoints of a model and its optimizer from a background thread.
+
+    save() only copies the state into host buffers (reused by the following checkpoints), and the shards
+        are serialized, fsync'ed and atomically renamed into the directory by a background thread.
+        A checkpoint is a manifest ('{tag}.json') of the shard files, which is written after all of them,
+        so that an interrupted save never leaves a partial checkpoint.
+    With incremental, a shard whose content has not changed since the last checkpoint (e.g., a frozen layer
+        or an inverse which has not been refreshed) is neither serialized nor written again but shared
+        by the manifests. The change is detected by a digest of the raw bytes of the snapshot
+        (the version counters of the tensors are not bumped by the in-place updates through .data),
+        i.e., the skip saves the serialization and the write, but not the copy into the host buffers.
+    With keep_last, the manifests of the older checkpoints written by this writer are removed, together with
+        their shard files which are not referred by any other manifest in the directory.
+
+    Args:
+        directory (str): directory of the checkpoints
+        incremental (bool, optional): whether the unchanged shards are skipped
+        keep_last (int, optional): number of the checkpoints which are kept (all if None)
+
+    Example:
+        >>> writer = AsyncCheckpointWriter(os.path.join(args.out, 'checkpoints'), keep_last=3)
+        >>> writer.save(model, optimizer, tag='epoch{}'.format(epoch), epoch=epoch)
+        >>> writer.close()
+    """
+
+    def __init__(self, directory, incremental=True, keep_last=None):
+        if keep_last is not None and keep_last < 1:
+            raise ValueError("Invalid keep_last: {}".format(keep_last))
+
+        self.directory = directory
+        self.incremental = incremental
+        self.keep_last = keep_last
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._buffers = {}
+        self._tags = []
+        self._thread = None
+        self._error = None
+
+        self.written_shards = []
+        self.skipped_shards = []
+
+    def _snapshot(self, value, path):
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+            buf = self._buffers.get(path, None)
+            if buf is None or buf.shape != value.shape or buf.dtype != value.dtype:
+                buf = torch.empty(value.shape, dtype=value.dtype,
+                                  pin_memory=value.is_cuda and torch.cuda.is_available())
+                self._buffers[path] = buf
+            buf.copy_(value, non_blocking=True)
+            return buf
+        if isinstance(value, dict):
+            return {key: self._snapshot(v, path + (key,)) for key, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self._snapshot(v, path + (i,)) for i, v in enumerate(value)]
+        return value
+
+    def save(self, model, optimizer=None, tag=None, include_inverses=True, **extra):
+        """Starts writing a checkpoint (waiting for the previous one) and returns its tag."""
+        self.wait()
+        if tag is None:
+            step = 0 if optimizer is None else optimizer.optim_state['step']
+            tag = 'step{}'.format(step)
+
+        shards = checkpoint_shards(model, optimizer, include_inverses, **extra)
+        snapshot = {name: self._snapshot(shard, (name,)) for name, shard in shards.items()}
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+        self._thread = threading.Thread(target=self._write, args=(tag, snapshot), daemon=True)
+        self._thread.start()
+
+        return tag
+
+    def _write(self, tag, snapshot):
+        try:
+            written, skipped = [], []
+            files = {}
+            for name, shard in snapshot.items():
+                filename = '{}.{}.pt'.format(name, _shard_digest(shard))
+                files[name] = filename
+
+                path = os.path.join(self.directory, filename)
+                if self.incremental and os.path.exists(path):
+                    # the same content has already been written
+                    skipped.append(name)
+                    continue
+                f = io.BytesIO()
+                torch.save(shard, f)
+                _atomic_write(path, f.getvalue())
+                written.append(name)
+
+            manifest = {'version': CHECKPOINT_VERSION, 'tag': tag, 'shards': files}
+            _atomic_write(os.path.join(self.directory, tag + '.json'),
+                          json.dumps(manifest, indent=4).encode('utf-8'))
+            _atomic_write(os.path.join(self.directory, _LATEST), tag.encode('utf-8'))
+
+            if tag in self._tags:
+                self._tags.remove(tag)
+            self._tags.append(tag)
+            self._remove_old_checkpoints()
+            self.written_shards, self.skipped_shards = written, skipped
+        except Exception as e:
+            self._error = e
+
+    def _remove_old_checkpoints(self):
+        if self.keep_last is None or len(self._tags) <= self.keep_last:
+            return
+        removed = set()
+        for tag in self._tags[:-self.keep_last]:
+            removed.update(read_manifest(self.directory, tag)['shards'].values())
+            os.remove(os.path.join(self.directory, tag + '.json'))
+        self._tags = self._tags[-self.keep_last:]
+
+        # the shards of the removed checkpoints which are not referred by any manifest in the directory
+        # (including those of the other runs)
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    removed.difference_update(json.load(f)['shards'].values())
+            except (OSError, ValueError, KeyError):
+                # keep all the shards if a manifest cannot be read
+                return
+        for filename in removed:
+            path = os.path.join(self.directory, filename)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def wait(self):
+        """Waits for the checkpoint being written (and raises the error of the writer, if any)."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Failed to write the checkpoint: {}'.format(error))
+
+    def close(self):
+        self.wait()
+        self._buffers = {}
+
+
+def read_manifest(directory, tag=None):
+    if tag is None:
+        with open(os.path.join(directory, _LATEST)) as f:
+            tag = f.read().strip()
+    with open(os.path.join(directory, tag + '.json')) as f:
+        manifest = json.load(f)
+    if manifest.get('version', None) != CHECKPOINT_VERSION:
+        raise ValueError("Invalid checkpoint version: {}".format(manifest.get('version', None)))
+
+    return manifest
+
+
+def _load_shard(directory, filename, map_location, mmap=False):
+    path = os.path.join(directory, filename)
+    if mmap:
+        return torch.load(path, map_location=map_location, mmap=True)
+    return torch.load(path, map_location=map_location)
+
+
+def read_checkpoint(directory, tag=None, map_location='cpu'):
+    r"""Reads a checkpoint written by AsyncCheckpointWriter (the latest one if tag is None).
+
+    Returns:
+        dict: 'model' (state_dict of the model), 'optimizer' (state_dict of the optimizer, if saved)
+            and the extra values passed to save()
+    """
+    manifest = read_manifest(directory, tag)
+    shards = {name: _load_shard(directory, filename, map_location)
+              for name, filename in manifest['shards'].items()}
+
+    meta = shards['meta']
+    checkpoint = dict(meta['extra'])
+    model_state = dict(shards['model'])
+
+    if 'optimizer' in meta:
+        optimizer_state = dict(meta['optimizer'])
+        optimizer_state['param_groups'] = []
+        optimizer_state['state'] = []
+        for i in range(meta['num_groups']):
+            shard = shards['layer{}'.format(i)]
+            optimizer_state['param_groups'].append(shard['group'])
+            optimizer_state['state'].extend(shard['state'])
+            model_state.update(shard['model'])
+        checkpoint['optimizer'] = optimizer_state
+
+    checkpoint['model'] = model_state
+
+    return checkpoint
+
+
+class LazyCheckpoint(object):
+    r"""Memory-mapped checkpoint written by AsyncCheckpointWriter, which is loaded layer by layer on demand.
+
+    The shard files are memory-mapped (torch.load with mmap=True) only when they are first used,
+        so that the pages of the tensors are read from the disk only when they are touched.
+    attach() loads the small state (the rest of the model, the step and the hyperparams) at once,
+        and defers the state of each layer until its first use, i.e., the first forward of the layer or
+        the first access to its param group of the optimizer, so that an evaluation or a partial resume
+        reads only the layers which it uses.
+
+    Args:
+        directory (str): directory of the checkpoints
+        tag (str, optional): tag of the checkpoint (the latest one if None)
+        map_location (optional): map_location of torch.load
+
+    Example:
+        >>> checkpoint = LazyCheckpoint(os.path.join(args.out, 'checkpoints'))
+        >>> checkpoint.attach(model, optimizer)
+        >>> start_epoch = checkpoint['epoch']
+    """
+
+    def __init__(self, directory, tag=None, map_location='cpu'):
+        self.directory = directory
+        self.map_location = map_location
+        self.manifest = read_manifest(directory, tag)
+        self.meta = self._load_shard('meta')
+
+        self._model = None
+        self._optimizer = None
+        self._handles = {}
+        self.loaded_layers = set()
+
+    def _load_shard(self, name):
+        return _load_shard(self.directory, self.manifest['shards'][name], self.map_location, mmap=True)
+
+    def __getitem__(self, key):
+        return self.meta['extra'][key]
+
+    @property
+    def num_layers(self):
+        return len(self.meta.get('modules', []))
+
+    def attach(self, model, optimizer=None):
+        """Loads the state other than that of the layers, and the state of each layer at its first use."""
+        if optimizer is not None:
+            if 'optimizer' not in self.meta:
+                raise ValueError('The checkpoint has no optimizer state.')
+            if self.meta['num_groups'] != len(optimizer.param_groups):
+                raise ValueError("Invalid number of param groups: {}".format(self.meta['num_groups']))
+            optimizer._load_meta_state(self.meta['optimizer'])
+        model.load_state_dict(self._load_shard('model'), strict=False)
+
+        self._model = model
+        self._optimizer = optimizer
+        modules = dict(model.named_modules())
+        for i, name in enumerate(self.meta.get('modules', [])):
+            if i in self.loaded_layers:
+                continue
+            self._handles[i] = modules[name].register_forward_pre_hook(
+                lambda module, inputs, index=i: self.materialize(index))
+            if optimizer is not None:
+                optimizer.set_lazy_group_state(i, lambda index=i: self.materialize(index))
+
+    def materialize(self, index=None):
+        """Loads the state of a layer (all the layers if index is None) if it has not been loaded."""
+        if index is None:
+            for i in range(self.num_layers):
+                self.materialize(i)
+            return
+        if index in self.loaded_layers:
+            return
+        self.loaded_layers.add(index)
+
+        handle = self._handles.pop(index, None)
+        if handle is not None:
+            handle.remove()
+        shard = self._load_shard('layer{}'.format(index))
+        if self._model is not None:
+            self._model.load_state_dict(shard['model'], strict=False)
+        if self._optimizer is not None:
+            self._optimizer.load_group_state(index, shard['group'], shard['state'])
@@ -0,0 +1,107 @@
+import math
+
+import torch
+
+
+def _nonfinite_stats(tensors):
+    # [num NaN, num Inf] (int64) and [min, max] (of the finite elements) of the tensors,
+    # reduced per tensor (without concatenating them)
+    counts, ranges = [], []
+    for t in tensors:
+        t = t.detach()
+        num_nan = torch.isnan(t).sum()
+        num_inf = torch.isinf(t).sum()
+        t_min = torch.nan_to_num(t, nan=math.inf, posinf=math.inf, neginf=math.inf).min()
+        t_max = torch.nan_to_num(t, nan=-math.inf, posinf=-math.inf, neginf=-math.inf).max()
+        counts.append(torch.stack([num_nan, num_inf]))
+        ranges.append(torch.stack([t_min.float(), t_max.float()]))
+    if len(tensors) == 1:
+        return counts[0], ranges[0]
+    ranges = torch.stack(ranges)
+    return torch.stack(counts).sum(dim=0), torch.stack([ranges[:, 0].min(), ranges[:, 1].max()])
+
+
+class HealthMonitor(object):
+    r"""Numerical-health monitor whose statistics are accumulated on the device without host syncs.
+
+    The number of NaN/Inf elements (int64) and the min/max of the finite elements of the tracked tensors
+        are accumulated into device-side counters (per name), and are copied to the host
+        only when flush() is called, e.g., at the log interval, or every flush_interval steps.
+    A non-finite value is reported (raised as FloatingPointError if raise_on_nonfinite) at the flush,
+        i.e., lazily (up to flush_interval steps after it appeared).
+
+    Args:
+        enabled (bool, optional): whether the tensors are tracked (nothing is computed if False)
+        flush_interval (int, optional): interval (steps) of the automatic flush (None for flushing manually)
+        raise_on_nonfinite (bool, optional): whether a FloatingPointError is raised at the flush
+            when non-finite values have been tracked
+
+    Example:
+        >>> monitor = HealthMonitor(flush_interval=100, raise_on_nonfinite=True)
+        >>> monitor.track('loss', loss)
+        >>> monitor.step()
+    """
+
+    def __init__(self, enabled=True, flush_interval=None, raise_on_nonfinite=False):
+        if flush_interval is not None and flush_interval < 1:
+            raise ValueError("Invalid flush interval: {}".format(flush_interval))
+
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.raise_on_nonfinite = raise_on_nonfinite
+
+        self._stats = {}
+        self._num_steps = 0
+        self.last_stats = {}
+
+    def track(self, name, tensors):
+        if not self.enabled:
+            return
+        if isinstance(tensors, torch.Tensor):
+            tensors = [tensors]
+        else:
+            tensors = [t for t in tensors if t is not None]
+        if len(tensors) == 0:
+            return
+
+        counts, ranges = _nonfinite_stats(tensors)
+        old = self._stats.get(name, None)
+        if old is not None:
+            old_counts, old_ranges = old
+            counts, ranges = counts.to(old_counts.device), ranges.to(old_ranges.device)
+            counts = old_counts + counts
+            ranges = torch.stack([torch.minimum(old_ranges[0], ranges[0]), torch.maximum(old_ranges[1], ranges[1])])
+        self._stats[name] = (counts, ranges)
+
+    def step(self):
+        if not self.enabled or self.flush_interval is None:
+            return
+        self._num_steps += 1
+        if self._num_steps % self.flush_interval == 0:
+            self.flush()
+
+    def flush(self):
+        """Returns (and resets) the statistics of each name, with one copy to the host.
+
+        Returns:
+            dict: name -> {'nan': int, 'inf': int, 'min': float, 'max': float}
+        """
+        if len(self._stats) == 0:
+            self.last_stats = {}
+            return self.last_stats
+
+        names = list(self._stats.keys())
+        device = self._stats[names[0]][0].device
+        counts = torch.stack([self._stats[name][0].to(device) for name in names]).cpu().tolist()
+        ranges = torch.stack([self._stats[name][1].to(device) for name in names]).cpu().tolist()
+        self._stats = {}
+
+        self.last_stats = {name: {'nan': c[0], 'inf': c[1], 'min': r[0], 'max': r[1]}
+                           for name, c, r in zip(names, counts, ranges)}
+
+        if self.raise_on_nonfinite:
+            bad = [name for name, s in self.last_stats.items() if s['nan'] > 0 or s['inf'] > 0]
+            if len(bad) > 0:
+                raise FloatingPointError("Non-finite values in: {}".format(', '.join(bad)))
+
+        return self.last_stats
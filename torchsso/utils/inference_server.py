@@ -0,0 +1,158 @@
+import asyncio
+
+import torch
+from torchsso.utils.posterior_predictive import prediction_entropy
+
+
+class _Request(object):
+
+    def __init__(self, data, future):
+        self.data = data
+        self.future = future
+
+
+class PredictiveServer(object):
+    r"""Local asyncio server for the posterior predictive with dynamic batching.
+
+    Concurrent requests are collected into a micro-batch until either max_batch_size inputs
+        are queued or max_latency seconds have passed since the first request of the batch.
+        A request which does not fit into the micro-batch starts the next one
+        (and a request larger than max_batch_size is evaluated alone).
+    The pending requests (queued or being evaluated) fail with RuntimeError when the server is stopped.
+    Each micro-batch is evaluated by a single call of the predictive (in a worker thread,
+        so that the event loop keeps queuing requests).
+
+    Args:
+        predictive (callable): function which maps a batch of inputs to predictive probabilities,
+            e.g., the module built by torchsso.optim.VIOptimizer.export_predictive(),
+            whose sample bank is then shared by all the requests
+        max_batch_size (int, optional): max number of inputs in a micro-batch
+        max_latency (float, optional): max waiting time (sec) of a micro-batch
+
+    Example:
+        >>> server = PredictiveServer(optimizer.export_predictive())
+        >>> await server.start()
+        >>> prob, entropy = await server.predict(data)
+        >>> await server.stop()
+    """
+
+    def __init__(self, predictive, max_batch_size=128, max_latency=5e-3):
+        if max_batch_size < 1:
+            raise ValueError("Invalid max_batch_size: {}".format(max_batch_size))
+        if max_latency < 0:
+            raise ValueError("Invalid max_latency: {}".format(max_latency))
+
+        self.predictive = predictive
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        self._queue = None
+        self._worker = None
+        # the requests taken from the queue but not answered yet
+        self._batch = []
+        self._next_request = None
+
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_inputs = 0
+        self.last_batch_size = 0
+        self.max_queue_depth = 0
+
+    @property
+    def queue_depth(self):
+        return 0 if self._queue is None else self._queue.qsize()
+
+    def metrics(self):
+        return {'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'num_requests': self.num_requests,
+                'num_batches': self.num_batches,
+                'last_batch_size': self.last_batch_size,
+                'mean_batch_size': self.num_inputs / self.num_batches if self.num_batches > 0 else 0}
+
+    async def start(self):
+        assert self._worker is None, 'The server has already been started.'
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.ensure_future(self._serve())
+
+    async def stop(self):
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+
+        pending = list(self._batch)
+        if self._next_request is not None:
+            pending.append(self._next_request)
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        self._batch, self._next_request = [], None
+        for r in pending:
+            if not r.future.done():
+                r.future.set_exception(RuntimeError('The server has been stopped.'))
+
+    async def predict(self, data: torch.Tensor):
+        r"""Returns the predictive probabilities and entropy of a batch of inputs."""
+        assert self._worker is not None, 'The server has not been started yet.'
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Request(data, future))
+        self.num_requests += 1
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+        return await future
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if self._next_request is not None:
+                request, self._next_request = self._next_request, None
+            else:
+                request = await self._queue.get()
+            batch = self._batch = [request]
+            batch_size = len(request.data)
+            deadline = loop.time() + self.max_latency
+
+            while batch_size < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if batch_size + len(request.data) > self.max_batch_size:
+                    # the first request of the next micro-batch
+                    self._next_request = request
+                    break
+                batch.append(request)
+                batch_size += len(request.data)
+
+            self.num_batches += 1
+            self.num_inputs += batch_size
+            self.last_batch_size = batch_size
+
+            try:
+                results = await loop.run_in_executor(None, self._evaluate, [r.data for r in batch])
+            except Exception as e:
+                for r in batch:
+                    if not r.future.done():
+                        r.future.set_exception(e)
+                self._batch = []
+                continue
+
+            for r, result in zip(batch, results):
+                if not r.future.done():
+                    r.future.set_result(result)
+            self._batch = []
+
+    def _evaluate(self, inputs):
+        with torch.no_grad():
+            prob = self.predictive(torch.cat(inputs))
+            entropy = prediction_entropy(prob)
+
+        sizes = [len(data) for data in inputs]
+        return list(zip(torch.split(prob, sizes), torch.split(entropy, sizes)))
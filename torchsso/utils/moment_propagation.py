@@ -0,0 +1,166 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.fx import GraphModule, Interpreter, symbolic_trace
+
+_RELU_FUNCTIONS = (F.relu, torch.relu)
+_SHAPE_FUNCTIONS = (torch.flatten, torch.reshape, torch.squeeze, torch.unsqueeze, torch.transpose)
+_SHAPE_METHODS = ('view', 'reshape', 'flatten', 'squeeze', 'unsqueeze', 'transpose', 'permute', 'contiguous')
+_SIZE_METHODS = ('size', 'dim')
+
+
+class Moments(object):
+    r"""Element-wise mean and variance of a random tensor."""
+
+    def __init__(self, mean, var):
+        self.mean = mean
+        self.var = var
+
+    def apply(self, fn):
+        return Moments(fn(self.mean), fn(self.var))
+
+
+class MomentInterpreter(Interpreter):
+    r"""Runs a traced model on (mean, variance) pairs instead of tensors.
+
+    Weights and activations are assumed to be independent Gaussians, so that
+        only Linear, Conv2d, ReLU and shape operations are supported.
+
+    Args:
+        graph_module (torch.fx.GraphModule): traced model
+        moments (dict): torch.nn.Module -> list of Moments of its params
+            (modules which are not in the dict are treated as deterministic)
+    """
+
+    def __init__(self, graph_module: GraphModule, moments: dict):
+        super(MomentInterpreter, self).__init__(graph_module)
+        self.moments = moments
+
+    def param_moments(self, module):
+        moments = self.moments.get(module, None)
+        if moments is None:
+            moments = [Moments(p.data, torch.zeros_like(p.data)) for p in module.parameters()]
+        return moments
+
+    def placeholder(self, target, args, kwargs):
+        data = super(MomentInterpreter, self).placeholder(target, args, kwargs)
+        if isinstance(data, torch.Tensor) and data.is_floating_point():
+            return Moments(data, torch.zeros_like(data))
+        return data
+
+    def call_module(self, target, args, kwargs):
+        x = args[0] if len(args) > 0 else None
+        if not isinstance(x, Moments):
+            return super(MomentInterpreter, self).call_module(target, args, kwargs)
+
+        module = self.fetch_attr(target)
+        if isinstance(module, nn.Linear):
+            return linear_moments(x, *self.param_moments(module))
+        elif isinstance(module, nn.Conv2d):
+            return conv2d_moments(x, module, *self.param_moments(module))
+        elif isinstance(module, nn.ReLU):
+            return relu_moments(x)
+        elif isinstance(module, nn.Flatten):
+            return x.apply(module)
+        elif isinstance(module, nn.Dropout):
+            return x
+        else:
+            raise ValueError(f'Unsupported module class: {module.__class__}.')
+
+    def call_function(self, target, args, kwargs):
+        x = args[0] if len(args) > 0 else None
+        if not isinstance(x, Moments):
+            return super(MomentInterpreter, self).call_function(target, args, kwargs)
+
+        if target in _RELU_FUNCTIONS:
+            return relu_moments(x)
+        elif target in _SHAPE_FUNCTIONS:
+            return x.apply(lambda t: target(t, *args[1:], **kwargs))
+        elif target is F.dropout:
+            return x
+        else:
+            raise ValueError(f'Unsupported function: {target}.')
+
+    def call_method(self, target, args, kwargs):
+        x = args[0]
+        if not isinstance(x, Moments):
+            return super(MomentInterpreter, self).call_method(target, args, kwargs)
+
+        if target in _SIZE_METHODS:
+            return getattr(x.mean, target)(*args[1:], **kwargs)
+        elif target == 'relu':
+            return relu_moments(x)
+        elif target in _SHAPE_METHODS:
+            return x.apply(lambda t: getattr(t, target)(*args[1:], **kwargs))
+        else:
+            raise ValueError(f'Unsupported method: {target}.')
+
+
+def linear_moments(x, weight, bias=None):
+    mean = F.linear(x.mean, weight.mean, None if bias is None else bias.mean)
+    var = F.linear(x.var, weight.mean ** 2) + F.linear(x.mean ** 2 + x.var, weight.var)
+    if bias is not None:
+        var = var + bias.var
+
+    return Moments(mean, var)
+
+
+def conv2d_moments(x, conv2d, weight, bias=None):
+    kwargs = dict(stride=conv2d.stride, padding=conv2d.padding,
+                  dilation=conv2d.dilation, groups=conv2d.groups)
+    mean = F.conv2d(x.mean, weight.mean, None if bias is None else bias.mean, **kwargs)
+    var = F.conv2d(x.var, weight.mean ** 2, **kwargs) + F.conv2d(x.mean ** 2 + x.var, weight.var, **kwargs)
+    if bias is not None:
+        var = var + bias.var.view(1, -1, 1, 1)
+
+    return Moments(mean, var)
+
+
+def relu_moments(x, eps=1e-12):
+    # moments of a rectified Gaussian
+    std = x.var.clamp(min=eps).sqrt()
+    alpha = x.mean / std
+    cdf = 0.5 * (1 + torch.erf(alpha / math.sqrt(2)))
+    pdf = torch.exp(-0.5 * alpha ** 2) / math.sqrt(2 * math.pi)
+
+    mean = x.mean * cdf + std * pdf
+    second_moment = (x.mean ** 2 + x.var) * cdf + x.mean * std * pdf
+    var = (second_moment - mean ** 2).clamp(min=0)
+
+    return Moments(mean, var)
+
+
+def propagate_moments(model: nn.Module, data: torch.Tensor, moments=None):
+    r"""Propagates the mean and variance of the activations through the model in a single pass.
+
+    Args:
+        model (torch.nn.Module or torch.fx.GraphModule): model (or a traced one)
+            composed of Linear, Conv2d and ReLU layers
+        data (torch.Tensor): a batch of (deterministic) inputs
+        moments (dict, optional): torch.nn.Module -> list of Moments of its params
+
+    Returns:
+        mean and variance of the output
+    """
+    graph_module = model if isinstance(model, GraphModule) else symbolic_trace(model)
+    moments = {} if moments is None else moments
+
+    with torch.no_grad():
+        output = MomentInterpreter(graph_module, moments).run(data)
+
+    assert isinstance(output, Moments), 'The output of the model does not depend on the input.'
+
+    return output.mean, output.var
+
+
+def probit_approximation(mean, var):
+    r"""Approximates the expected sigmoid/softmax of Gaussian logits (MacKay, 1992)."""
+    logits = mean / torch.sqrt(1 + math.pi * var / 8)
+    if logits.ndim == 2:
+        return F.softmax(logits, dim=1)
+    elif logits.ndim == 1:
+        return torch.sigmoid(logits)
+    else:
+        raise ValueError(f'Invalid ndim {logits.ndim}')
@@ -0,0 +1,129 @@
+import copy
+from functools import reduce
+from typing import List, Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.fx import Graph, GraphModule, map_arg, symbolic_trace
+
+
+def repeat_batch(x: torch.Tensor, num_samples: int) -> torch.Tensor:
+    # n x * -> (num_samples)(n) x *
+    shape = list(x.shape)
+    return x.unsqueeze(0).expand([num_samples] + shape).reshape([-1] + shape[1:])
+
+
+def batched_linear(x: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor]) -> torch.Tensor:
+    # x: (num_samples)(n) x * x f_in, weight: num_samples x f_out x f_in, bias: num_samples x f_out
+    num_samples = weight.shape[0]
+    shape = list(x.shape)
+    out = torch.bmm(x.reshape([num_samples, -1, shape[-1]]), weight.transpose(1, 2))
+    if bias is not None:
+        out = out + bias.unsqueeze(1)
+    return out.reshape(shape[:-1] + [weight.shape[1]])
+
+
+def batched_conv2d(x: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor],
+                   stride: List[int], padding: List[int], dilation: List[int], groups: int) -> torch.Tensor:
+    # x: (num_samples)(n) x c_in x h_in x w_in, weight: num_samples x c_out x (c_in/groups) x k_h x k_w
+    # the samples are stacked along the channels and convolved as independent groups
+    num_samples, c_out = weight.shape[0], weight.shape[1]
+    c_in, h_in, w_in = x.shape[1], x.shape[2], x.shape[3]
+    n = x.shape[0] // num_samples
+    x = x.reshape([num_samples, n, c_in, h_in, w_in]).transpose(0, 1).reshape([n, num_samples * c_in, h_in, w_in])
+    weight = weight.reshape([num_samples * c_out] + list(weight.shape[2:]))
+    if bias is not None:
+        bias = bias.reshape([-1])
+    out = F.conv2d(x, weight, bias, stride, padding, dilation, groups * num_samples)
+    h_out, w_out = out.shape[2], out.shape[3]
+    return out.reshape([n, num_samples, c_out, h_out, w_out]).transpose(0, 1).reshape([-1, c_out, h_out, w_out])
+
+
+def predictive_mean(output: torch.Tensor, num_samples: int) -> torch.Tensor:
+    # (num_samples)(n) x * -> n x *
+    output = output.reshape([num_samples, -1] + list(output.shape[1:]))
+    if output.dim() == 3:
+        prob = F.softmax(output, dim=2)
+    elif output.dim() == 2:
+        prob = torch.sigmoid(output)
+    else:
+        raise ValueError('Invalid ndim of the output')
+    return prob.mean(dim=0)
+
+
+def prediction_margin(prob: torch.Tensor) -> torch.Tensor:
+    if prob.ndim == 1:
+        return torch.abs(2 * prob - 1)
+    top2 = torch.topk(prob, 2, dim=1)[0]
+    return top2[:, 0] - top2[:, 1]
+
+
+def prediction_entropy(prob: torch.Tensor, eps: float = 1e-12) -> torch.Tensor:
+    if prob.ndim == 1:
+        prob = torch.stack([prob, 1 - prob], dim=1)
+    return -torch.sum(prob * torch.log(prob.clamp(min=eps)), dim=1)
+
+
+def build_posterior_predictive(model: nn.Module, bank: dict):
+    r"""Builds a standalone module which averages the predictive over a bank of sampled params.
+
+    The input batch is repeated for every sample and Linear/Conv2d layers are evaluated
+        with batched weights, so that all the MC samples are computed in a single graph
+        without sampling, copying params or reseeding.
+    The returned torch.fx.GraphModule can be scripted (torch.jit.script) or exported (torch.export),
+        and the scripted module can be loaded without torchsso.
+
+    Args:
+        model (torch.nn.Module): model composed of Linear/Conv2d and param-free layers
+        bank (dict): torch.nn.Module -> list of samples (num_samples x param shape) of its params
+            (e.g., torchsso.optim.VIOptimizer.sample_bank())
+    """
+    graph_module = symbolic_trace(model)
+    modules = dict(graph_module.named_modules())
+    num_samples = next(iter(bank.values()))[0].shape[0]
+
+    graph = Graph()
+    attrs = {}
+    env = {}
+    data_node = None
+
+    for node in graph_module.graph.nodes:
+        if node.op == 'placeholder':
+            new_node = graph.node_copy(node)
+            if data_node is None:
+                data_node = new_node
+                new_node = graph.call_function(repeat_batch, (new_node, num_samples))
+            env[node] = new_node
+        elif node.op == 'call_module' and modules[node.target] in bank:
+            module = modules[node.target]
+            x = env[node.args[0]]
+            samples = {}
+            for (name, _), param_samples in zip(module.named_parameters(), bank[module]):
+                attr = 'samples_{}_{}'.format(node.target.replace('.', '_'), name)
+                attrs[attr] = param_samples.detach().clone()
+                samples[name] = graph.get_attr(attr)
+            weight, bias = samples['weight'], samples.get('bias', None)
+
+            if isinstance(module, nn.Linear):
+                env[node] = graph.call_function(batched_linear, (x, weight, bias))
+            elif isinstance(module, nn.Conv2d):
+                assert not isinstance(module.padding, str), 'String padding is not supported.'
+                args = (x, weight, bias, list(module.stride), list(module.padding),
+                        list(module.dilation), module.groups)
+                env[node] = graph.call_function(batched_conv2d, args)
+            else:
+                raise ValueError(f'Unsupported module class: {module.__class__}.')
+        elif node.op == 'call_module':
+            attrs[node.target] = copy.deepcopy(modules[node.target])
+            env[node] = graph.node_copy(node, lambda n: env[n])
+        elif node.op == 'get_attr':
+            attrs[node.target] = copy.deepcopy(reduce(getattr, node.target.split('.'), graph_module))
+            env[node] = graph.node_copy(node, lambda n: env[n])
+        elif node.op == 'output':
+            output = map_arg(node.args[0], lambda n: env[n])
+            graph.output(graph.call_function(predictive_mean, (output, num_samples)))
+        else:
+            env[node] = graph.node_copy(node, lambda n: env[n])
+
+    return GraphModule(attrs, graph, class_name='PosteriorPredictive')
@@ -0,0 +1,158 @@
+import os
+import json
+import struct
+
+import numpy as np
+import torch
+
+SNAPSHOT_MAGIC = b'TSSOPOST'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ALIGNMENT = 64
+
+# magic, version, index size (bytes)
+_HEADER_FORMAT = '<8sIQ'
+_HEADER_SIZE = struct.calcsize(_HEADER_FORMAT)
+
+
+def _align(offset, alignment=SNAPSHOT_ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def save_posterior_snapshot(optimizer, path):
+    r"""Exports the (GMM) posterior of torchsso.optim.VIOptimizer into a memory-mappable file.
+
+    The file consists of a fixed-size header, a JSON index keyed by parameter name and
+        the raw tensors (means, scales and mixture weights of each component), each of which
+        starts at an aligned offset. The scale already includes std_scale,
+        i.e., a sample is mean + scale * noise for the selected component.
+
+    Args:
+        optimizer (torchsso.optim.VIOptimizer): optimizer which manages the posterior
+        path (str): output file path
+    """
+    names = {p: name for name, p in optimizer.model.named_parameters()}
+
+    index = {'version': SNAPSHOT_VERSION,
+             'num_gmm_components': optimizer.num_gmm_components,
+             'step': optimizer.optim_state['step'],
+             'params': {}}
+    arrays = []
+    offset = 0
+
+    def add_array(tensor):
+        nonlocal offset
+        array = np.ascontiguousarray(tensor.detach().cpu().numpy())
+        offset = _align(offset)
+        arrays.append((offset, array))
+        entry_offset = offset
+        offset += array.nbytes
+        return entry_offset
+
+    for group in optimizer.param_groups:
+        std_scale = group['std_scale']
+        for p, means, covs, pais in zip(group['params'], group['mean'], group['cov'], group['pais']):
+            assert p in names, 'All the params managed by the optimizer have to be in the model.'
+            index['params'][names[p]] = {
+                'shape': list(p.shape),
+                'dtype': np.dtype(np.float32).str,
+                'mean': [add_array(m.float()) for m in means],
+                'scale': [add_array(torch.sqrt(cov).mul(std_scale).float()) for cov in covs],
+                'pai': [add_array(pai.float()) for pai in pais],
+            }
+
+    index_bytes = json.dumps(index).encode('utf-8')
+    data_start = _align(_HEADER_SIZE + len(index_bytes))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack(_HEADER_FORMAT, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(index_bytes)))
+        f.write(index_bytes)
+        for array_offset, array in arrays:
+            f.seek(data_start + array_offset)
+            f.write(array.tobytes())
+        f.truncate(data_start + _align(offset))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+
+
+class PosteriorSnapshot(object):
+    r"""Read-only view of a posterior exported by save_posterior_snapshot().
+
+    The file is memory-mapped (copy-on-write), so the tensors are not copied on opening
+        and the pages are shared among the processes which open the same file.
+
+    Args:
+        path (str): snapshot file path
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            magic, version, index_size = struct.unpack(_HEADER_FORMAT, f.read(_HEADER_SIZE))
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError('Invalid posterior snapshot: {}'.format(path))
+            if version > SNAPSHOT_VERSION:
+                raise ValueError('Unsupported posterior snapshot version: {}'.format(version))
+            index = json.loads(f.read(index_size).decode('utf-8'))
+
+        self.path = path
+        self.index = index
+        self.version = version
+        self._data_start = _align(_HEADER_SIZE + index_size)
+        self._buffer = np.memmap(path, dtype=np.uint8, mode='c')
+
+    @property
+    def num_gmm_components(self):
+        return self.index['num_gmm_components']
+
+    @property
+    def step(self):
+        return self.index['step']
+
+    @property
+    def names(self):
+        return list(self.index['params'].keys())
+
+    def _tensor(self, name, key):
+        entry = self.index['params'][name]
+        dtype = np.dtype(entry['dtype'])
+        numel = int(np.prod(entry['shape']))
+        tensors = []
+        for offset in entry[key]:
+            start = self._data_start + offset
+            array = self._buffer[start:start + numel * dtype.itemsize].view(dtype)
+            tensors.append(torch.from_numpy(array).view(entry['shape']))
+        return tensors
+
+    def mean(self, name):
+        return self._tensor(name, 'mean')
+
+    def scale(self, name):
+        return self._tensor(name, 'scale')
+
+    def pai(self, name):
+        return self._tensor(name, 'pai')
+
+    def sample(self, name, generator=None):
+        r"""Draws a sample of the param in the same way as VIOptimizer.sample_params()."""
+        k = self.num_gmm_components
+        means, scales, pais = self.mean(name), self.scale(name), self.pai(name)
+
+        stacked_pais = torch.stack(pais).view(k, -1)
+        selected_comp = torch.multinomial(stacked_pais.T, 1, generator=generator)
+        mask = torch.zeros_like(stacked_pais).scatter_(0, selected_comp.T, 1.)
+        selected_mean = torch.sum(torch.stack(means).view(k, -1).mul(mask), dim=0)
+        selected_scale = torch.sum(torch.stack(scales).view(k, -1).mul(mask), dim=0)
+
+        noise = torch.randn(selected_mean.shape, generator=generator, dtype=selected_mean.dtype)
+        return torch.addcmul(selected_mean, selected_scale, noise).view(means[0].shape)
+
+    def load_into(self, model, sample=False, generator=None):
+        r"""Copies the mean (of the first component) or a sample of each param into the model."""
+        with torch.no_grad():
+            for name, p in model.named_parameters():
+                if name not in self.index['params']:
+                    continue
+                value = self.sample(name, generator) if sample else self.mean(name)[0]
+                p.data.copy_(value)
@@ -0,0 +1,101 @@
+import hashlib
+from collections import OrderedDict
+
+import torch
+
+
+def _nbytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    elif isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    return 0
+
+
+def _clone(value):
+    if isinstance(value, torch.Tensor):
+        return value.clone()
+    elif isinstance(value, (tuple, list)):
+        return type(value)(_clone(v) for v in value)
+    return value
+
+
+class PredictiveCache(object):
+    r"""LRU cache of predictions bounded by the total size (bytes) of the cached tensors.
+
+    Entries are keyed by a digest of the input together with the posterior version
+        (see VIOptimizer.posterior_version) and the MC settings, so that a cached prediction is
+        reused only while the posterior has not been changed.
+    get() returns copies of the cached tensors, so that the cache is not modified through them.
+
+    Args:
+        max_bytes (int): budget for the cached tensors
+    """
+
+    def __init__(self, max_bytes):
+        if max_bytes <= 0:
+            raise ValueError("Invalid max_bytes: {}".format(max_bytes))
+
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def digest(data: torch.Tensor):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(str((tuple(data.shape), data.dtype)).encode('utf-8'))
+        h.update(data.detach().cpu().contiguous().numpy().tobytes())
+        return h.hexdigest()
+
+    def key(self, data, version, *settings):
+        return (self.digest(data), version) + tuple(settings)
+
+    def get(self, key):
+        value = self._entries.get(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return _clone(value[0])
+
+    def put(self, key, value):
+        nbytes = _nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self._nbytes -= self._entries.pop(key)[1]
+
+        self._entries[key] = (value, nbytes)
+        self._nbytes += nbytes
+
+        while self._nbytes > self.max_bytes:
+            _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+            self._nbytes -= evicted_nbytes
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hit_rate, 'entries': len(self), 'nbytes': self.nbytes}
@@ -0,0 +1,97 @@
+import torch
+import torch.nn as nn
+from torch.fx import Interpreter, symbolic_trace
+
+
+def _is_under(target, names):
+    return any(target == name or target.startswith(name + '.') for name in names)
+
+
+class _PrefixCachedInterpreter(Interpreter):
+
+    def __init__(self, prefix_cache):
+        super(_PrefixCachedInterpreter, self).__init__(prefix_cache.graph_module)
+        self.prefix_cache = prefix_cache
+
+    def run_node(self, n):
+        cache = self.prefix_cache
+        if n not in cache.prefix:
+            return super(_PrefixCachedInterpreter, self).run_node(n)
+
+        if cache.hit:
+            # only the values consumed by the suffix are needed
+            return cache.values.get(n, None)
+
+        with torch.no_grad():
+            value = super(_PrefixCachedInterpreter, self).run_node(n)
+        if n in cache.boundary:
+            cache.values[n] = value
+
+        return value
+
+
+class PrefixCachedForward(object):
+    r"""Forward of a model whose deterministic prefix is evaluated once for the same input.
+
+    The model is traced by torch.fx and split into the ops which depend on the stochastic
+        layers (suffix) and the others (prefix). The values of the prefix consumed by the suffix
+        are cached (without autograd history) while the model is called with the same input
+        tensors in the same mode and the params (and buffers) of the prefix are not modified
+        in place (checked by their versions, e.g., by load_state_dict()), e.g., for all the MC samples
+        of a step or of a prediction, and only the suffix is evaluated for each call.
+    The prefix has to be deterministic, i.e., its params are not sampled nor trained through
+        this forward. It is called explicitly (it does not replace the forward of the model).
+
+    Args:
+        model (torch.nn.Module): model to be evaluated
+        stochastic_modules (list): names of the stochastic layers (or of their parents)
+    """
+
+    def __init__(self, model: nn.Module, stochastic_modules):
+        self.model = model
+        self.graph_module = symbolic_trace(model)
+
+        suffix = set()
+        for node in self.graph_module.graph.nodes:
+            if node.op in ['call_module', 'get_attr'] and _is_under(node.target, stochastic_modules):
+                suffix.add(node)
+            elif any(arg in suffix for arg in node.all_input_nodes):
+                suffix.add(node)
+
+        self.prefix = {node for node in self.graph_module.graph.nodes
+                       if node not in suffix and node.op not in ['placeholder', 'output']}
+        self.boundary = {node for node in self.prefix
+                         if any(user not in self.prefix for user in node.users)}
+
+        self.stochastic_modules = stochastic_modules
+
+        self.hit = False
+        self.values = {}
+        self._inputs = None
+        self._training = None
+
+    def prefix_state(self):
+        # params and buffers of the prefix (read at each call, as they may be replaced, e.g., by pruning)
+        model = self.model
+        return [t for name, t in list(model.named_parameters()) + list(model.named_buffers())
+                if not _is_under(name, self.stochastic_modules)]
+
+    def clear(self):
+        self.values = {}
+        self._inputs = None
+
+    def __call__(self, *args, **kwargs):
+        if len(kwargs) > 0:
+            return type(self.model).forward(self.model, *args, **kwargs)
+
+        inputs = [(arg, arg._version) if isinstance(arg, torch.Tensor) else (arg, None) for arg in args]
+        inputs += [(t, t._version) for t in self.prefix_state()]
+        self.hit = self._inputs is not None and self._training == self.model.training \
+            and len(inputs) == len(self._inputs) \
+            and all(a is b and v == w for (a, v), (b, w) in zip(inputs, self._inputs))
+        if not self.hit:
+            self.values = {}
+            self._inputs = inputs
+            self._training = self.model.training
+
+        return _PrefixCachedInterpreter(self).run(*args)
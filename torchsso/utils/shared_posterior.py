@@ -0,0 +1,81 @@
+import torch
+import torch.multiprocessing as mp
+
+POSTERIOR_KEYS = ['mean', 'cov', 'pais']
+PRIOR_KEYS = ['prior_mean', 'prior_prec']
+
+
+def fork_context(owner):
+    r"""Returns the fork context of multiprocessing for the worker processes of owner.
+
+    The workers inherit the model and the optimizer (with the hooks of the curvatures), which cannot be
+        pickled for spawn/forkserver, so that they are forked. As a forked child cannot use (or safely inherit)
+        the CUDA context of the parent, the workers have to be started before CUDA is initialized.
+
+    Args:
+        owner (str): name of the class which starts the workers (for the error message)
+    """
+    if torch.cuda.is_initialized():
+        raise RuntimeError('{} has to be created before CUDA is initialized.'.format(owner))
+    return mp.get_context('fork')
+
+
+class SharedPosterior(object):
+    r"""Buffers in shared memory through which worker processes read the posterior of VIOptimizer.
+
+    The main process copies the posterior (mean, covariance and mixture weights, and optionally the folded
+        prior) into the buffers by publish(), and the optimizer in each worker (forked from the main process)
+        reads them through views of the buffers set by attach().
+
+    Args:
+        optimizer (torchsso.optim.VIOptimizer): optimizer whose posterior is shared
+        prior (bool, optional): whether the folded prior (see VIOptimizer.fold_posterior_into_prior) is shared
+    """
+
+    def __init__(self, optimizer, prior=False):
+        K = optimizer.num_gmm_components
+        self.buffers = {key: [[torch.zeros(K, *p.shape).share_memory_() for p in group['params']]
+                              for group in optimizer.param_groups]
+                        for key in POSTERIOR_KEYS}
+        if prior:
+            for key in PRIOR_KEYS:
+                self.buffers[key] = [[torch.zeros(p.shape).share_memory_() for p in group['params']]
+                                     for group in optimizer.param_groups]
+
+    def publish(self, optimizer):
+        """Copies the current posterior of the optimizer to the buffers.
+
+        Returns:
+            list: whether the prior of each param group is folded (None if the prior is not shared)
+        """
+        folded = None
+        with torch.no_grad():
+            for i, group in enumerate(optimizer.param_groups):
+                for key in POSTERIOR_KEYS:
+                    for buf, t_list in zip(self.buffers[key][i], group[key]):
+                        buf.copy_(torch.stack([t.detach() for t in t_list]))
+            if PRIOR_KEYS[0] in self.buffers:
+                folded = []
+                for i, group in enumerate(optimizer.param_groups):
+                    folded.append(group['prior_mean'] is not None)
+                    if not folded[-1]:
+                        continue
+                    for key in PRIOR_KEYS:
+                        for buf, t in zip(self.buffers[key][i], group[key]):
+                            buf.copy_(t)
+
+        return folded
+
+    def attach(self, optimizer, folded=None):
+        """Makes the optimizer (in a worker process) read the posterior from the buffers.
+
+        Args:
+            optimizer (torchsso.optim.VIOptimizer): copy of the optimizer in the worker
+            folded (list, optional): return value of publish(), for which the folded prior is attached
+        """
+        for i, group in enumerate(optimizer.param_groups):
+            for key in POSTERIOR_KEYS:
+                group[key] = [list(buf.unbind(0)) for buf in self.buffers[key][i]]
+            if folded is not None:
+                for key in PRIOR_KEYS:
+                    group[key] = list(self.buffers[key][i]) if folded[i] else None
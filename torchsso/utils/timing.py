@@ -0,0 +1,29 @@
+import time
+
+import torch
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+class TimedClosure(object):
+    r"""Closure which measures the wall time (with the device synchronized) of the wrapped closure.
+
+    Args:
+        closure (callable): closure passed to optimizer.step()
+    """
+
+    def __init__(self, closure):
+        self.closure = closure
+        self.time = 0.
+        self.num_calls = 0
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        ret = self.closure(*args, **kwargs)
+        synchronize()
+        self.time += time.perf_counter() - start
+        self.num_calls += 1
+        return ret